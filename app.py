@@ -1,7 +1,15 @@
 import dash
 import dash_bootstrap_components as dbc
 
+from utils import metrics, profiling
+
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.FLATLY], 
                 suppress_callback_exceptions=True)
 
-server = app.server
\ No newline at end of file
+server = app.server
+
+# Per-callback call counts, latencies and response sizes on /metrics
+metrics.instrument(app)
+
+# cProfile dumps of selected callbacks, when switched on in the environment
+profiling.instrument(app)
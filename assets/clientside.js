@@ -0,0 +1,130 @@
+/*
+ * Clientside callbacks
+ *
+ * Callbacks that only reformat their input run in the browser, so dragging a
+ * slider updates its labels without a round trip to the server. The labels
+ * of the time sliders are looked up in tables kept in a dcc.Store on each
+ * page.
+ */
+
+// Format a number with thousands separators like Python's '{:,}'.format
+function withCommas(value) {
+    return Number(value).toLocaleString('en-US', {maximumFractionDigits: 20});
+}
+
+var MONTH_NAMES = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+                   'August', 'September', 'October', 'November', 'December'];
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    search: {
+        price_range_display: function(price_range) {
+            var min_price = withCommas(price_range[0]) + " kr.";
+            var max_price = withCommas(price_range[1]) + " kr.";
+            if (price_range[1] === 10000000) {
+                max_price = max_price + " +";
+            }
+            return [min_price, max_price];
+        },
+
+        room_range_display: function(room_range) {
+            var min_room = room_range[0];
+            var max_room = room_range[1];
+            if (max_room === 9) {
+                max_room = String(max_room) + "+";
+            }
+            return [min_room, max_room];
+        },
+
+        house_size_range_display: function(size_range) {
+            var min_size = String(size_range[0]) + " m2";
+            var max_size = String(size_range[1]) + " m2";
+            if (max_size === "250 m2") {
+                max_size = max_size + "+";
+            }
+            return [min_size, max_size];
+        },
+
+        lot_size_range_display: function(size_range) {
+            var min_size = String(size_range[0]) + " m2";
+            var max_size = withCommas(size_range[1]) + " m2";
+            if (max_size === "10,000 m2") {
+                max_size = max_size + "+";
+            }
+            return [min_size, max_size];
+        },
+
+        build_year_range_display: function(year_range) {
+            var min_year = String(year_range[0]);
+            var max_year = String(year_range[1]);
+            if (min_year === "1900") {
+                min_year = min_year + " or before";
+            }
+            if (max_year === "2020") {
+                max_year = "2021";
+            }
+            return [min_year, max_year];
+        },
+
+        time_range_display: function(time_range, months) {
+            return [months[Math.trunc(time_range[0])], months[Math.trunc(time_range[1])]];
+        },
+
+        next_filter_sequence: function() {
+            // Increasing for the whole life of the browser window, so page
+            // views never see a number go back
+            window.filter_sequence = (window.filter_sequence || 0) + 1;
+            return window.filter_sequence;
+        },
+
+        tab_content: function(active_tab) {
+            var graph_ids = {
+                "tab-1": "price-hist-fig",
+                "tab-2": "number-of-sales-fig",
+                "tab-3": "m2prices-fig"
+            };
+            if (!(active_tab in graph_ids)) {
+                return "";
+            }
+            return {
+                namespace: "dash_core_components",
+                type: "Graph",
+                props: {id: graph_ids[active_tab]}
+            };
+        }
+    },
+
+    m2prices: {
+        title_for_month: function(month, dates) {
+            var time = dates[month];
+            var month_name = MONTH_NAMES[parseInt(time.slice(-2), 10) - 1];
+            return month_name + " " + time.slice(0, 4);
+        },
+
+        house_size_range_display: function(size_range, max_size) {
+            var min_size = String(size_range[0]) + " m2";
+            var max_size_label = String(size_range[1]) + " m2";
+            if (size_range[1] === max_size) {
+                max_size_label = max_size_label + " +";
+            }
+            return [min_size, max_size_label];
+        },
+
+        build_year_range_display: function(year_range, min_year) {
+            var min_year_label = String(year_range[0]);
+            if (year_range[0] === min_year) {
+                min_year_label = min_year_label + " or before";
+            }
+            return [min_year_label, String(year_range[1])];
+        }
+    },
+
+    totalsales: {
+        title_for_quarter: function(date, quarters) {
+            var quarter = quarters[date];
+            if (date === quarters.length - 1) {
+                quarter = quarter + " (*)";
+            }
+            return quarter;
+        }
+    }
+});
@@ -0,0 +1,266 @@
+'''Latency and payload benchmark for the Dash callbacks
+
+Calls every server-side callback registered on the app with the recorded
+inputs in benchmarks/recorded_inputs.json and reports the wall time per
+callback (p50/p95, including the JSON serialization Dash does) and the size
+of the serialized response.
+
+Each callback is swept one input at a time: it is first called with the
+first recorded value of every input, then with every other recorded value of
+one input while the rest keep their first value. Inputs that are the output
+of another callback (like the filtered-data store) use a sample of what that
+callback returned during its own sweep. The session id and filter sequence
+number of the search page are recorded as null, so no call is dropped as
+superseded by a newer filter state (see utils/coalescing.py).
+
+Run from the root of the repository:
+
+    python benchmarks/callbacks.py --output results.json
+    python benchmarks/callbacks.py --baseline results.json
+
+With --baseline the results are compared to a stored run and the command
+exits with status 1 if a callback got slower or its response got larger
+than the tolerances allow.
+'''
+import argparse
+import copy
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from dash.exceptions import PreventUpdate  # noqa: E402
+from plotly.io.json import to_json_plotly  # noqa: E402
+
+RECORDED_INPUTS = os.path.join("benchmarks", "recorded_inputs.json")
+
+
+def callback_name(callback):
+    '''Return the module qualified name of the function behind a callback'''
+    func = callback.__wrapped__
+    return f"{func.__module__}.{func.__name__}"
+
+
+def server_callbacks(app):
+    '''Return a list of (name, output, callback entry) for the server-side
+    callbacks'''
+    callbacks = []
+    for output, entry in app.callback_map.items():
+        if 'callback' in entry:
+            callbacks.append((callback_name(entry['callback']), output, entry))
+    return callbacks
+
+
+def argument_ids(entry):
+    return [f"{item['id']}.{item['property']}" for item in entry['inputs'] + entry['state']]
+
+
+def output_ids(output):
+    if output.startswith('..'):
+        return output.strip('.').split('...')
+    return [output]
+
+
+def sweep(values):
+    '''Yield argument lists changing one argument at a time'''
+    defaults = [options[0] for options in values]
+    yield defaults
+    for i, options in enumerate(values):
+        for option in options[1:]:
+            yield defaults[:i] + [option] + defaults[i + 1:]
+
+
+def sample(values, count):
+    '''Return at most count values spread evenly over values'''
+    if len(values) <= count:
+        return values
+    positions = np.linspace(0, len(values) - 1, count).round().astype(int)
+    return [values[i] for i in sorted(set(positions))]
+
+
+def clear_caches():
+    '''Empty the figure caches and the filter result store'''
+    from utils import figure_cache
+    from pages import salesprices_and_overview
+    for cache in figure_cache.caches.values():
+        cache.clear()
+    salesprices_and_overview.search_data.get().results.clear()
+
+
+def run_callback(func, arguments, repeat, cold):
+    '''Call func with arguments repeat times and return the measurements and
+    the serialized response'''
+    times, sizes, errors, prevented, payloads = [], [], 0, 0, []
+    for _ in range(repeat):
+        if cold:
+            clear_caches()
+        # Callbacks may change their (State) arguments, like Dash allows
+        args = copy.deepcopy(arguments)
+        start = time.perf_counter()
+        try:
+            result = func(*args)
+            payload = to_json_plotly(result)
+        except PreventUpdate:
+            prevented += 1
+            continue
+        except Exception:
+            errors += 1
+            continue
+        times.append(time.perf_counter() - start)
+        sizes.append(len(payload.encode('utf-8')))
+        payloads.append(payload)
+    return times, sizes, errors, prevented, payloads[:1]
+
+
+def summarize(times, sizes, errors, prevented):
+    times_ms = np.array(times) * 1000
+    return {
+        'calls': len(times),
+        'errors': errors,
+        'prevented': prevented,
+        'p50_ms': round(float(np.percentile(times_ms, 50)), 3) if len(times) else None,
+        'p95_ms': round(float(np.percentile(times_ms, 95)), 3) if len(times) else None,
+        'bytes_p50': int(np.percentile(sizes, 50)) if sizes else None,
+        'bytes_max': int(max(sizes)) if sizes else None,
+    }
+
+
+def run(recorded, repeat=3, cold=False, max_produced=12):
+    import index  # noqa: F401 (registers every callback)
+    from app import app
+    from utils import startup
+
+    # Load the data of every page first, so the first calls do not pay for it
+    startup.warm_up(background=False)
+
+    values = dict(recorded)
+    pending = server_callbacks(app)
+    # Outputs that are inputs of other callbacks without recorded values
+    needed = {i for _, _, entry in pending for i in argument_ids(entry)} - set(values)
+    report = {}
+    skipped = {}
+    while pending:
+        progress = False
+        for callback in list(pending):
+            name, output, entry = callback
+            ids = argument_ids(entry)
+            if not all(i in values for i in ids):
+                continue
+            pending.remove(callback)
+            progress = True
+            func = entry['callback'].__wrapped__
+            times, sizes, errors, prevented, produced = [], [], 0, 0, []
+            for arguments in sweep([values[i] for i in ids]):
+                measured = run_callback(func, arguments, repeat, cold)
+                times += measured[0]
+                sizes += measured[1]
+                errors += measured[2]
+                prevented += measured[3]
+                produced += measured[4]
+            report[name] = summarize(times, sizes, errors, prevented)
+            # Outputs feeding other callbacks become their recorded inputs
+            # (as the browser would send them back, decoded from JSON)
+            outputs = output_ids(output)
+            if len(outputs) == 1 and outputs[0] in needed and produced:
+                unique = list(dict.fromkeys(produced))
+                values[outputs[0]] = [json.loads(payload) for payload in sample(unique, max_produced)]
+        if not progress:
+            for name, _, entry in pending:
+                missing = [i for i in argument_ids(entry) if i not in values]
+                skipped[name] = f"no recorded values for {', '.join(missing)}"
+            break
+    return report, skipped
+
+
+def compare(report, baseline, time_tolerance, size_tolerance, min_ms=1.0):
+    '''Return the regressions of report compared to baseline'''
+    regressions = []
+    for name, result in sorted(report.items()):
+        before = baseline.get('callbacks', {}).get(name)
+        if not before or result['p50_ms'] is None or before['p50_ms'] is None:
+            continue
+        if (result['p50_ms'] > min_ms
+                and result['p50_ms'] > before['p50_ms'] * (1 + time_tolerance)):
+            regressions.append(f"{name}: p50 {before['p50_ms']:.1f} ms -> {result['p50_ms']:.1f} ms")
+        if result['bytes_max'] > before['bytes_max'] * (1 + size_tolerance):
+            regressions.append(f"{name}: max response {before['bytes_max']:,} B -> {result['bytes_max']:,} B")
+    return regressions
+
+
+def print_report(report, skipped, baseline=None):
+    header = f"{'callback':62s} {'calls':>5s} {'p50 ms':>9s} {'p95 ms':>9s} {'p50 bytes':>11s} {'max bytes':>11s}"
+    print(header)
+    print("-" * len(header))
+    for name, result in sorted(report.items()):
+        if result['calls'] == 0:
+            print(f"{name:62s} {0:5d}  (errors: {result['errors']}, prevented: {result['prevented']})")
+            continue
+        line = (f"{name:62s} {result['calls']:5d} {result['p50_ms']:9.2f} {result['p95_ms']:9.2f} "
+                f"{result['bytes_p50']:11,d} {result['bytes_max']:11,d}")
+        before = (baseline or {}).get('callbacks', {}).get(name)
+        if before and before['p50_ms']:
+            line += f"  ({result['p50_ms'] / before['p50_ms']:.2f}x time"
+            line += f", {result['bytes_max'] / before['bytes_max']:.2f}x bytes)"
+        print(line)
+    for name, reason in sorted(skipped.items()):
+        print(f"{name:62s} skipped: {reason}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--inputs', default=RECORDED_INPUTS, help="recorded inputs (JSON)")
+    parser.add_argument('--repeat', type=int, default=3, help="calls per set of inputs")
+    parser.add_argument('--cold', action='store_true', help="empty the caches before every call")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare against results written by --output")
+    parser.add_argument('--time-tolerance', type=float, default=0.25,
+                        help="allowed relative increase of the p50 time (default 0.25)")
+    parser.add_argument('--size-tolerance', type=float, default=0.05,
+                        help="allowed relative increase of the largest response (default 0.05)")
+    args = parser.parse_args()
+
+    with open(args.inputs, "r", encoding="utf-8") as f:
+        recorded = json.load(f)
+    report, skipped = run(recorded, repeat=args.repeat, cold=args.cold)
+    results = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'cold': args.cold,
+        },
+        'callbacks': report,
+        'skipped': skipped,
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        settings = {key: baseline.get('meta', {}).get(key) for key in ('repeat', 'cold')}
+        if settings != {'repeat': args.repeat, 'cold': args.cold}:
+            print(f"Warning: the baseline was run with {settings}, the caches make "
+                  f"runs with other settings incomparable\n")
+    print_report(report, skipped, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+    if baseline:
+        regressions = compare(report, baseline, args.time_tolerance, args.size_tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("\nNo regressions")
+
+
+if __name__ == "__main__":
+    main()
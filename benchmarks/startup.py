@@ -0,0 +1,45 @@
+'''Startup time of the app
+
+Imports the app with every page and then builds the data and layout of every
+page, and reports the time each step took:
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --cold
+
+With --cold the binary caches in data/cache are removed first, so the data
+is parsed and derived from the CSV files again (as on a first start).
+'''
+import argparse
+import os
+import shutil
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cold', action='store_true', help="remove the data caches first")
+    args = parser.parse_args()
+
+    if args.cold:
+        from utils.sales_data import CACHE_DIR
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+    start = time.perf_counter()
+    import index  # noqa: F401 (registers every callback)
+    imported = time.perf_counter()
+    from utils import startup
+    startup.warm_up(background=False)
+    warmed_up = time.perf_counter()
+
+    print(startup.report())
+    print(f"\nReady to serve after {(imported - start) * 1000:.1f} ms, "
+          f"every page loaded after {(warmed_up - start) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+'''Concurrent throughput check against a running server
+
+Replays a filtering interaction on the search page against a server started
+with serve.py: a user moves one of the filters (apply_filters) and the
+browser then requests every server-side callback that depends on the
+filtered data, with the returned handle. Several simulated users do this
+concurrently for a fixed time, and the interactions per second and the
+request latencies are reported for each number of users.
+
+To check that adding workers scales the throughput, run it against the
+server started with one worker and again with more workers:
+
+    WEB_WORKERS=1 python serve.py
+    python benchmarks/throughput.py --users 1,2,4,8
+
+    WEB_WORKERS=4 python serve.py
+    python benchmarks/throughput.py --users 1,2,4,8
+
+With enough users to keep every worker busy, the interactions per second
+should grow with the number of workers, up to the number of CPU cores.
+'''
+import argparse
+import json
+import os
+import random
+import threading
+import time
+
+import numpy as np
+import requests
+
+RECORDED_INPUTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recorded_inputs.json")
+
+FILTERED_DATA = "filtered-data.data"
+
+
+def argument_id(item):
+    return f"{item['id']}.{item['property']}"
+
+
+def outputs_of(output):
+    '''Return the outputs of a callback in the request format'''
+    if output.startswith('..'):
+        return [dict(zip(('id', 'property'), part.split('.')))
+                for part in output.strip('.').split('...')]
+    component, prop = output.split('.')
+    return {'id': component, 'property': prop}
+
+
+def request_body(callback, values):
+    return {
+        'output': callback['output'],
+        'outputs': outputs_of(callback['output']),
+        'inputs': [dict(item, value=values[argument_id(item)]) for item in callback['inputs']],
+        'state': [dict(item, value=values[argument_id(item)]) for item in callback['state']],
+        'changedPropIds': [argument_id(callback['inputs'][0])],
+    }
+
+
+class Interaction:
+    '''The callbacks requested when a filter on the search page changes'''
+
+    def __init__(self, dependencies, recorded):
+        self.recorded = recorded
+        server_side = [c for c in dependencies if not c.get('clientside_function')]
+        self.apply_filters = next(c for c in server_side if c['output'] == FILTERED_DATA)
+        self.dependents = [c for c in server_side
+                           if FILTERED_DATA in map(argument_id, c['inputs'])]
+
+    def run(self, session, url, rng):
+        '''Run one interaction and return the latency of each request'''
+        values = {key: options[0] for key, options in self.recorded.items()}
+        changed = argument_id(rng.choice(self.apply_filters['inputs']))
+        values[changed] = rng.choice(self.recorded[changed])
+        latencies = []
+        start = time.perf_counter()
+        response = session.post(url, json=request_body(self.apply_filters, values))
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+        component, prop = FILTERED_DATA.split('.')
+        values[FILTERED_DATA] = response.json()['response'][component][prop]
+        for callback in self.dependents:
+            start = time.perf_counter()
+            response = session.post(url, json=request_body(callback, values))
+            if response.status_code != 204:     # 204: PreventUpdate
+                response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+
+def measure(interaction, url, users, duration, seed=0):
+    '''Run users concurrent users for duration seconds and return
+    (interactions, errors, latencies)'''
+    deadline = time.perf_counter() + duration
+    lock = threading.Lock()
+    totals = {'interactions': 0, 'errors': 0, 'latencies': []}
+
+    def user(number):
+        rng = random.Random(seed + number)
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            try:
+                latencies = interaction.run(session, url, rng)
+            except requests.RequestException:
+                with lock:
+                    totals['errors'] += 1
+                continue
+            with lock:
+                totals['interactions'] += 1
+                totals['latencies'] += latencies
+
+    threads = [threading.Thread(target=user, args=(number,)) for number in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return totals['interactions'], totals['errors'], totals['latencies']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default="http://127.0.0.1:8050", help="address of the server")
+    parser.add_argument('--users', default="1,2,4,8", help="numbers of concurrent users to try")
+    parser.add_argument('--duration', type=float, default=10, help="seconds per number of users")
+    parser.add_argument('--inputs', default=RECORDED_INPUTS, help="recorded inputs (JSON)")
+    args = parser.parse_args()
+
+    with open(args.inputs, "r", encoding="utf-8") as f:
+        recorded = json.load(f)
+    dependencies = requests.get(args.url + "/_dash-dependencies").json()
+    interaction = Interaction(dependencies, recorded)
+    url = args.url + "/_dash-update-component"
+    # Warm up the caches of the workers
+    measure(interaction, url, 1, min(args.duration, 2))
+
+    print(f"{'users':>5s} {'interactions/s':>15s} {'p50 ms':>9s} {'p95 ms':>9s} {'errors':>7s}")
+    for users in [int(users) for users in args.users.split(',')]:
+        interactions, errors, latencies = measure(interaction, url, users, args.duration)
+        latencies_ms = np.array(latencies or [np.nan]) * 1000
+        print(f"{users:5d} {interactions / args.duration:15.2f} {np.percentile(latencies_ms, 50):9.1f} "
+              f"{np.percentile(latencies_ms, 95):9.1f} {errors:7d}")
+
+
+if __name__ == "__main__":
+    main()
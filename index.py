@@ -1,8 +1,20 @@
 from dash import Input, Output, dcc, html
 import dash_bootstrap_components as dbc
 
-from app import app
-from pages import m2prices, totalsales, salesprices_and_overview
+from utils import startup
+
+with startup.timed("import: app"):
+    from app import app
+from utils import ingest
+
+# Importing a page registers its callbacks. Its data and layout are only built
+# when it is first shown (or warmed up)
+with startup.timed("import: pages.m2prices"):
+    from pages import m2prices
+with startup.timed("import: pages.totalsales"):
+    from pages import totalsales
+with startup.timed("import: pages.salesprices_and_overview"):
+    from pages import salesprices_and_overview
 
 # Setting the main layout with a fixed navbar at the top
 navbar = dbc.Navbar(
@@ -42,15 +54,22 @@ app.layout = dbc.Container(
     )
 def render_page_content(pathname):
     if pathname == "/":
-        return salesprices_and_overview.page
+        return salesprices_and_overview.layout()
     elif pathname == "/page-1":
-        return m2prices.page1
+        return m2prices.layout()
     elif pathname == "/page-2":
-        return totalsales.page0
+        return totalsales.layout()
     # If the user tries to reach a different page, return a 404 message
     else:
         return html.H1("404: Not found", className="text-danger")
 
 
 if __name__ == "__main__":
+    # Build the data of every page in the background, so the first visit of
+    # a page does not wait for it
+    startup.warm_up()
+    # Add the sales dropped in SALES_DROP_DIR while running (if set)
+    drop_directory = ingest.drop_directory()
+    if drop_directory:
+        drop_directory.start()
     app.run_server(debug=False)
\ No newline at end of file
@@ -1,132 +1,241 @@
-from dash import Input, Output, State, dcc, html, callback_context
+from dash import ClientsideFunction, Input, Output, State, dcc, html
 import dash_bootstrap_components as dbc
 
-import pandas as pd
-import json
+from datetime import datetime
+
+import numpy as np
 
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 
 from app import app
+from utils import aggregates, figure_cache, figure_encoding, geometry, ingest, startup
+from utils.filter_engine import TYPES
+from utils.zip_aggregation import BUILD_YEAR_STEP, SIZE_STEP, ZipMonthAggregator
 
 #
 # Loading the data
 #
 
-# Geojson file with the shape of the zip code areas on Fyn with a unique ID pr shape 
-with open('data/zip_code_areas_fyn_with_id.geojson', "r") as f:
-    zip_code_areas = json.load(f)
+class PageData:
+    '''The datasets shown on the page'''
 
-# Dataset with the average m2 price for houses sold on Fyn optimized for the choropleth map
-with open('data/m2prices_for_choropleth.csv', "r") as f:
-    m2prices_map = pd.read_csv(f)
+    def __init__(self, datasets, zip_code_areas, sales):
+        # The shape of the zip code areas on Fyn with a unique ID pr shape
+        # (simplified and shared with the other choropleth page)
+        self.zip_code_areas = zip_code_areas
+        # Dataset with the average m2 price for houses sold on Fyn optimized for the choropleth map
+        self.m2prices_map = datasets['m2prices_for_choropleth']
+        # Dataset with the average m2 price for houses sold on Fyn optimized for the line chart
+        m2prices_line_chart = datasets['m2prices_for_line_chart']
+        # A list with the months covered in the dataset (i.e. 2021-11)
+        self.dates = list(m2prices_line_chart['index'])
+        # The average m2 prices as a matrix with a row per month and a column
+        # per zip code, and the column of every zip code
+        zip_codes = [column for column in m2prices_line_chart.columns if column not in ('index', 'fyn')]
+        self.m2prices = m2prices_line_chart[zip_codes].to_numpy()
+        self.zip_columns = {int(zip_code): column for column, zip_code in enumerate(zip_codes)}
+        # The average m2 price for all of Fyn per month
+        self.fyn_m2prices = m2prices_line_chart['fyn'].to_numpy()
+        # Aggregates the m2 prices of the sales matching the filters of the
+        # choropleth per zip code and month (rows and columns), and the row of
+        # the zip code of every shape
+        months = np.array(self.dates, dtype='datetime64[M]').astype(np.int64)
+        self.aggregator = ZipMonthAggregator(sales, self.m2prices_map.zip_code.unique(), months)
+        self.area_rows = np.searchsorted(self.aggregator.zip_codes, self.m2prices_map.zip_code.to_numpy())
 
-# Dataset with the average m2 price for houses sold on Fyn optimized for the line chart
-with open('data/m2prices_for_line_chart.csv', 'r') as f:
-    m2prices_line_chart = pd.read_csv(f)
-    
 
-#
-#   Helper functions
-#
-def translate_zips_to_ids_and_colors(zips):
-    '''Return a list with the IDs corresponding to the zip codes in zips'''
-    ids = []
-    colors = px.colors.qualitative.Vivid    # 11 colors
-    for i, zip_code in enumerate(zips):
-        color_index = i % 11
-        color = colors[color_index]
-        zip_text = str(zip_code)
-        for item in zip_code_areas['features']:
-            if item['properties']['POSTNR_TXT'] == zip_text:
-                ids.append((item['id'], color))
-    return ids
+def load_page_data(sales):
+    '''Return the data of the page for the sales table'''
+    return PageData(aggregates.load(sales), geometry.zip_code_areas.get().geojson, sales)
+
+
+# Derived from the sales table shared by the pages (see utils/aggregates.py
+# and utils/ingest.py) when the page is first used (see utils/startup.py)
+page_data = startup.Lazy("data: pages.m2prices", lambda: load_page_data(ingest.sales.get()))
 
 
 #
 # Creating the content
 #
 
-# A list with the months covered in the dataset (i.e. 2021-11)
-dates = list(m2prices_map.columns)[4:-1]
-
-# Slider for choosing the month and year
-marks = {i: {'label': ""} for i in range(0, len(dates))}
-for i in range(0, len(dates), 2):
-    marks[i] = {'label': dates[i]}
-
-m2price_slider = dcc.Slider(id='month_slider',
-                       min=0, 
-                       max=len(dates)-1, 
-                       value=len(dates)-1,
-                       step=1,
-                       marks=marks,
-                       included=False)
-
-# Dropdown menu for selecting zip code areas
-zips_and_names = m2prices_map[['zip_code', 'name']].copy()
-zips_and_names.sort_values('zip_code', inplace=True)
-zips_and_names.drop_duplicates(inplace=True)
-zipped = zip(zips_and_names.zip_code, zips_and_names.name)
-dropdown_options = [{'label': str(z) + " " + name, 'value': z} for z, name in zipped]
-
-m2price_dropdown = dcc.Dropdown(id="zip_dropdown",
-                                options=dropdown_options,
-                                value=[5000, 5900],
-                                multi=True)
-
-# The content of page 1 styled to be two rows
-page1 = [
-        dbc.Container(
-            [   
-                html.H2("Average Price per m2"),         
-                html.H4(id="m2price_header", children="November 2021"),              
-                dcc.Graph(id='m2price_map'),
-            ],
-            style={'width':'50%', 'display':'inline-block', 'vertical-align':'top'}
-        ), 
-        dbc.Container(
-            [   
-                html.H4("Development over Time"),
-                html.Div("Choose Zip Code Areas", className="form-label"),
-                m2price_dropdown,
-                dcc.Graph(id="m2price_plot")
-            ], 
-            style={'width':'50%','display':'inline-block', 'vertical-align':'top'}
+def map_filter_rows(aggregator):
+    '''Return the rows of filters choosing the sales averaged on the map,
+    with the sliders spanning the sales in aggregator'''
+    min_size, max_size = aggregator.size_range
+    min_year, max_year = aggregator.build_year_range
+    return [
+        dbc.Row(
+        [
+            dbc.Col(
+            [
+                dbc.Label("Type", style={"margin-bottom": 0}),
+                dbc.Checklist(
+                    id="m2price_type_choice",
+                    options=[{"label": name, "value": name} for name in TYPES],
+                    value=list(TYPES),
+                    inline=True),
+            ], style={'margin-bottom': '10px'}
+            ),
+        ]
         ),
-        dbc.Container(
-            [  
-                html.Div("Choose Month", className="form-label"),
-                
-                m2price_slider
-            ],
+        dbc.Row(
+        [
+            dbc.Col(
+            [ 
+                dbc.Label("House Size", style={"margin-bottom": 0}),
+                html.Div(
+                    [html.Div(f"{min_size} m2",
+                              id="m2price_house_size_slider_min",
+                              style={"display": "inline-block", "width": "50%", "text-align": "left", "opacity": "50%"}),
+                    html.Div(f"{max_size} m2 +",
+                             id="m2price_house_size_slider_max",
+                             style={"display": "inline-block", "width": "50%", "text-align": "right", "opacity": "50%"})]
+                    ),
+                dcc.RangeSlider(id="m2price_house_size_slider", 
+                min=min_size, 
+                max=max_size, 
+                value=[min_size, max_size],
+                step=SIZE_STEP,
+                allowCross=False,
+                tooltip={"placement": "bottom"}),
+            ], style={'margin-bottom': '10px'}
+            ), 
+            dbc.Col(
+            [
+                dbc.Label("Build Year", style={"margin-bottom": 0}),
+                html.Div(
+                    [html.Div(f"{min_year} or before",
+                              id="m2price_build_year_slider_min",
+                              style={"display": "inline-block", "width": "50%", "text-align": "left", "opacity": "50%"}),
+                    html.Div(f"{max_year}",
+                             id="m2price_build_year_slider_max",
+                             style={"display": "inline-block", "width": "50%", "text-align": "right", "opacity": "50%"})]
+                    ),
+                dcc.RangeSlider(id="m2price_build_year_slider", 
+                min=min_year, 
+                max=max_year, 
+                value=[min_year, max_year],
+                step=BUILD_YEAR_STEP,
+                allowCross=False,
+                tooltip={"placement": "bottom"}) 
+            ], style={'margin-bottom': '10px'}
+            )
+        ]
         ),
     ]
 
+
+def build_page(data):
+    '''Return the content of the page for data'''
+    dates = data.dates
+
+    # Slider for choosing the month and year
+    marks = {i: {'label': ""} for i in range(0, len(dates))}
+    for i in range(0, len(dates), 2):
+        marks[i] = {'label': dates[i]}
+
+    m2price_slider = dcc.Slider(id='month_slider',
+                           min=0, 
+                           max=len(dates)-1, 
+                           value=len(dates)-1,
+                           step=1,
+                           marks=marks,
+                           included=False)
+
+    # Dropdown menu for selecting zip code areas
+    zips_and_names = data.m2prices_map[['zip_code', 'name']].copy()
+    zips_and_names.sort_values('zip_code', inplace=True)
+    zips_and_names.drop_duplicates(inplace=True)
+    zipped = zip(zips_and_names.zip_code, zips_and_names.name)
+    dropdown_options = [{'label': str(z) + " " + name, 'value': z} for z, name in zipped]
+
+    m2price_dropdown = dcc.Dropdown(id="zip_dropdown",
+                                    options=dropdown_options,
+                                    value=[5000, 5900],
+                                    multi=True)
+
+    # The content of page 1 styled to be two rows
+    return [
+            dbc.Container(
+                [   
+                    html.H2("Average Price per m2"),         
+                    # The title of the last month, as title_for_month in
+                    # assets/clientside.js makes it
+                    html.H4(id="m2price_header",
+                            children=datetime.strptime(dates[-1], "%Y-%m").strftime("%B %Y")),
+                    *map_filter_rows(data.aggregator),
+                    dcc.Graph(id='m2price_map'),
+                ],
+                style={'width':'50%', 'display':'inline-block', 'vertical-align':'top'}
+            ), 
+            dbc.Container(
+                [   
+                    html.H4("Development over Time"),
+                    html.Div("Choose Zip Code Areas", className="form-label"),
+                    m2price_dropdown,
+                    dcc.Graph(id="m2price_plot")
+                ], 
+                style={'width':'50%','display':'inline-block', 'vertical-align':'top'}
+            ),
+            dbc.Container(
+                [  
+                    html.Div("Choose Month", className="form-label"),
+                    
+                    m2price_slider
+                ],
+            ),
+            # Labels of the month slider, used by the clientside callbacks
+            dcc.Store(id="month_labels", data=dates),
+        ]
+
+
+page1 = startup.Lazy("layout: pages.m2prices", lambda: build_page(page_data.get()))
+
+
+def layout():
+    '''Return the content of the page'''
+    return page1.get()
+
+
+@ingest.on_new_sales
+def add_sales(sales):
+    '''Swap in the data and the content of the page for sales, the sales
+    table with new sales added, and drop the figures of the old data'''
+    page_data.update(lambda data: load_page_data(sales))
+    page1.update(lambda content: build_page(page_data.get()))
+    for figure in (m2prices_base_choropleth, update_choropleth_with_m2_prices,
+                   update_line_chart_with_m2_prices):
+        figure.cache.clear()
+
+
 #
 #   Callbacks
 #
 
-@app.callback(
-    Output("m2price_map", "figure"),
-    Input("zip_dropdown", "value"),
-    Input("month_slider", "value"),
-    )
-def update_choropleth_with_m2_prices(selected_zips, month):
-    '''Create and update the choropleth map of Fyn with the average m2 price'''
-    selected_month = "2021-11"
-    selected_month = dates[month]
+# One entry per month and choice of filters
+@figure_cache.memoize(max_entries=64)
+def m2prices_base_choropleth(month, type_choices, house_size_range, build_year_range):
+    '''Create the choropleth map of Fyn with the average m2 price in month
+    of the sales matching the filters, without the selected zip code areas'''
+    data = page_data.get()
+    m2prices_map = data.m2prices_map
+    # The average m2 price in the month of every shape, aggregated over the
+    # sales matching the filters
+    aggregator = data.aggregator
+    mask = aggregator.mask(type_choices, house_size_range, build_year_range)
+    m2prices = aggregator.means(mask)[data.area_rows, month]
     # Change the coloring according to the chosen month
-    fig = px.choropleth(m2prices_map,
-                geojson=zip_code_areas, 
-                color=selected_month, 
-                locations='id',
+    fig = px.choropleth(geojson=data.zip_code_areas, 
+                color=m2prices, 
+                locations=m2prices_map.id,
                 projection="mercator",
                 range_color=[0,35000],
                 color_continuous_scale=[[0, 'white'], [1, '#222222']],
                 height=550,
                 template='simple_white',
-                labels={selected_month: 'Average price per m2 in DKK'})
+                labels={'color': 'Average price per m2 in DKK'})
     # Zoom in on Fyn
     fig.update_geos(fitbounds="locations", visible=False)
     # Remove margins
@@ -139,8 +248,8 @@ def update_choropleth_with_m2_prices(selected_zips, month):
     fig.update_traces(hovertemplate='<b>%{customdata}</b><br>%{z: .2f} kr.', 
                       customdata=m2prices_map.pretty_name)
     # Color NaN areas grey (and still make the hover data look nice)
-    nan_areas = m2prices_map[m2prices_map[selected_month].isna()]
-    fig.add_trace(go.Choropleth(geojson = zip_code_areas,
+    nan_areas = m2prices_map[np.isnan(m2prices)]
+    fig.add_trace(go.Choropleth(geojson = data.zip_code_areas,
                                 locationmode = "geojson-id",
                                 locations = nan_areas.id,
                                 z = [1] * len(nan_areas.id),
@@ -153,36 +262,57 @@ def update_choropleth_with_m2_prices(selected_zips, month):
                                 text = ['No sales'] * len(nan_areas.id),
                                 customdata = nan_areas.pretty_name
                                 ))
-    # Highlight selected zips on the map
-    id_color_pairs = translate_zips_to_ids_and_colors(selected_zips)
-    for ic in id_color_pairs:
-        fig.add_trace(go.Choropleth(geojson=zip_code_areas,
-                                    locationmode="geojson-id",
-                                    locations=[ic[0]],
-                                    z = [1],
-                                    colorscale = [[0, 'rgba(0,0,0,0)'],[1, 'rgba(0,0,0,0)']],
-                                    colorbar=None,
-                                    showscale =False,
-                                    marker = {"line": {"color": ic[1], "width": 3}},
-                                    hoverinfo='skip'))
-    return  fig
+    return fig.to_plotly_json()
 
 
 @app.callback(
+    Output("m2price_map", "figure"),
+    Input("zip_dropdown", "value"),
+    Input("month_slider", "value"),
+    Input("m2price_type_choice", "value"),
+    Input("m2price_house_size_slider", "value"),
+    Input("m2price_build_year_slider", "value"),
+    )
+@figure_cache.memoize()
+@figure_encoding.encoded
+def update_choropleth_with_m2_prices(selected_zips, month, type_choices, house_size_range, build_year_range):
+    '''Create and update the choropleth map of Fyn with the average m2 price'''
+    # The map for the month and filters is cached separately from the
+    # selection, so changing the selected zips does not recompute it
+    # (the order the types are checked in does not change the map)
+    type_choices = tuple(sorted(type_choices or []))
+    fig = m2prices_base_choropleth(month, type_choices, house_size_range, build_year_range)
+    # Highlight selected zips on the map (one trace outlining all of them)
+    return geometry.with_highlight(fig, selected_zips)
+
+
+# Changing the title happens in the browser (see assets/clientside.js)
+app.clientside_callback(
+    ClientsideFunction(namespace="m2prices", function_name="title_for_month"),
     Output("m2price_header", "children"),
-    Input("month_slider", "value")
+    Input("month_slider", "value"),
+    State("month_labels", "data")
+    )
+
+
+# Showing the chosen house sizes and build years happens in the browser too,
+# with the ends of the sliders (which follow the sales) read off the sliders
+app.clientside_callback(
+    ClientsideFunction(namespace="m2prices", function_name="house_size_range_display"),
+    Output("m2price_house_size_slider_min", "children"),
+    Output("m2price_house_size_slider_max", "children"),
+    Input("m2price_house_size_slider", "value"),
+    State("m2price_house_size_slider", "max")
+    )
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace="m2prices", function_name="build_year_range_display"),
+    Output("m2price_build_year_slider_min", "children"),
+    Output("m2price_build_year_slider_max", "children"),
+    Input("m2price_build_year_slider", "value"),
+    State("m2price_build_year_slider", "min")
     )
-def update_title_to_match_chosen_month(month):
-    '''Change the title to show the chosen month and year.'''
-    title = "November 2021"
-    month_names = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 
-                   'August', 'September', 'October', 'November', 'December']
-    time = dates[month]
-    month_index = int(time[-2:]) - 1
-    month = month_names[month_index]
-    year = time[:4]
-    title = month + " " + year
-    return  title
 
 
 @app.callback(
@@ -200,49 +330,92 @@ def update_dropdown(clickData, selected_zips):
     return selected_zips
 
 
+# Styling of the line chart, resolved once (the chart is built as a plain
+# dictionary, see line_chart_figure)
+LINE_TEMPLATE = pio.templates['simple_white'].to_plotly_json()
+LINE_COLORS = px.colors.qualitative.Vivid
+
+
+def selected_columns(data, selected_zips):
+    '''Return the selected zip codes (ints or strings from the dropdown)
+    found in the data and their columns in data.m2prices, without repeats'''
+    zip_codes = []
+    for zip_code in selected_zips:
+        try:
+            zip_code = int(zip_code)
+        except (TypeError, ValueError):
+            continue
+        if zip_code in data.zip_columns and zip_code not in zip_codes:
+            zip_codes.append(zip_code)
+    return zip_codes, [data.zip_columns[zip_code] for zip_code in zip_codes]
+
+
+def line_chart_figure(dates, zip_codes, m2prices, fyn_m2prices, date):
+    '''Return the line chart (as a dictionary) of m2prices, with a row per
+    date in dates and a column per zip code in zip_codes
+
+    The lines are drawn like px.line draws them, with a vertical line at date
+    and the average m2 price for all of Fyn for reference. Building the
+    dictionary directly takes a fraction of the time plotly takes to build
+    and validate the same figure.
+    '''
+    data = []
+    for i, zip_code in enumerate(zip_codes):
+        name = str(zip_code)
+        data.append({'type': 'scatter',
+                     'mode': 'lines+markers',
+                     'x': dates,
+                     'y': m2prices[:, i],
+                     'name': name,
+                     'legendgroup': name,
+                     'line': {'color': LINE_COLORS[i % len(LINE_COLORS)], 'dash': 'solid'},
+                     'marker': {'symbol': 'circle'}})
+    # Add the average m2 price for all of Fyn for reference
+    data.append({'type': 'scatter',
+                 'mode': 'lines',
+                 'x': dates,
+                 'y': fyn_m2prices,
+                 'name': "All of Fyn",
+                 'marker': {'color': 'gray'},
+                 'opacity': 0.2})
+    legend = {'tracegroupgap': 0}
+    if zip_codes:
+        legend['title'] = {'text': 'Zip Code'}
+    layout = {'template': LINE_TEMPLATE,
+              'height': 500,
+              'hovermode': 'x',
+              'legend': legend,
+              'margin': {'l': 0, 'r': 0, 'b': 0, 't': 20, 'pad': 10},
+              'xaxis': {'title': {'text': 'Year and Month'}},
+              # Force the y-axis to always start at zero and change the ticks
+              # from the standard 10k to 10000
+              'yaxis': {'title': {'text': 'Average Price per m2 in DKK'},
+                        'range': [0, 35000],
+                        'rangemode': 'tozero',
+                        'tickformat': ',2f'},
+              # A vertical line showing the chosen month and year
+              'shapes': [{'type': 'line',
+                          'x0': date, 'x1': date, 'xref': 'x',
+                          'y0': 0, 'y1': 1, 'yref': 'y domain',
+                          'line': {'color': '#3498DB', 'dash': 'dash', 'width': 3}}]}
+    return {'data': data, 'layout': layout}
+
+
 @app.callback(
     Output("m2price_plot", "figure"),
     Input("zip_dropdown", "value"),
     Input("month_slider", "value"),
     )
+@figure_cache.memoize()
 def update_line_chart_with_m2_prices(selected_zips, month):
     '''Create and update the line chart showing the development in m2 prices
     in the selected zip code areas'''
-    # Draw a line for each of the selected zip code areas
-    fig = px.line(m2prices_line_chart, 
-                  x='index', 
-                  y=[str(i) for i in selected_zips],
-                  range_y=[0, 35000], 
-                  markers=True,
-                  template='simple_white',
-                  color_discrete_sequence=px.colors.qualitative.Vivid,
-                  height=500,
-                  labels={'index': 'Year and Month', 
-                          'value': 'Average Price per m2 in DKK',
-                          'variable': 'Zip Code'})
-    # Force the y-axis to always start at zero
-    fig.update_yaxes(rangemode="tozero")
-    # Change the ticks from the standard 10k to 10000
-    fig.update_layout(yaxis={'tickformat': ',2f'})
-    # Add a vertical line in the plot showing the chosen month and year
-    x_position = "2021-11"
-    x_position = dates[month]       
-    fig.add_vline(x=x_position, 
-                  line_width=3, 
-                  line_dash="dash", 
-                  line_color="#3498DB")
-    # Add the average m2 price for all of Fyn for reference
-    fig.add_trace(go.Scatter(mode='lines',
-                             x = m2prices_line_chart['index'],
-                             y = m2prices_line_chart['fyn'],
-                             name="All of Fyn",
-                             marker_color='gray',
-                             opacity=0.2))
-    # Make the hover text look nicer
-    fig.update_traces(hovertemplate=None)
-    fig.update_layout(hovermode="x")
-    fig.update_layout(margin=dict(l=0, r=0, b=0, t=20, pad=10))
-    return fig
+    data = page_data.get()
+    # Draw a line for each of the selected zip code areas, sliced out of the
+    # matrix of m2 prices
+    zip_codes, columns = selected_columns(data, selected_zips)
+    return line_chart_figure(data.dates, zip_codes, data.m2prices[:, columns],
+                             data.fyn_m2prices, data.dates[month])
 
 
 @app.callback(
@@ -250,6 +423,7 @@ def update_line_chart_with_m2_prices(selected_zips, month):
     Input("m2price_plot", "clickData")
 )
 def update_slider_on_plot_click(clickData):
+    dates = page_data.get().dates
     selected = len(dates) - 1
     if clickData:
         selected = dates.index(clickData['points'][0]['x'][0:7])
@@ -1,189 +1,274 @@
-from dash import Input, Output, State, dcc, html
+from dash import ClientsideFunction, Input, Output, State, dcc, html
 import dash_bootstrap_components as dbc
 
+import functools
+import uuid
+
 import numpy as np
-import pandas as pd
-import json
 
 import plotly.express as px
 import plotly.graph_objects as go
 
-from dateutil.parser import parse
-
 from app import app
+from utils import coalescing, figure_encoding, ingest, startup
+from utils.binning import UniformBins, trim_empty
+from utils.clustering import ClusterLevels, cell_size_for_zoom
+from utils.filter_engine import FilterEngine, canonical_state, viewport_from_relayout
+from utils.result_store import ResultStore
+from utils.sales_data import month_labels
 
 #
 #   Load data
 #
 
-sales = pd.read_csv("data/sales.csv")
-# Change to datetime format
-sales["datetimes"] = sales.salesDate.apply(parse)
+# Widths of the bins of the price histograms in the overview tabs
+PRICE_BIN_WIDTH = 250_000
+M2PRICE_BIN_WIDTH = 1_000
+
+#
+#   Map
+#
+
+MAP_CENTER = dict(lat=55.18, lon=10.3)
+MAP_ZOOM = 8.3
+MAP_COLOR_SCALE = [(0, "#440154"), (0.03, "#443983"),(0.125,"#31688e"),(0.25,"#21918c"), (0.5,"#35b779"), (25/36,"#90d743") , (1, "#fde725")]
+
+# The map shows clusters of sales (count and median price) instead of single
+# houses below this zoom level, or when more than MAX_MARKERS sales match
+CLUSTER_BELOW_ZOOM = 11
+MAX_MARKERS = 2_000
+
+# The columns shown by the markers. Every marker carries the row of its sale
+# in the sales table as customdata; the rest of the clicked house is looked
+# up in the table
+MARKER_COLUMNS = ['latitude', 'longitude', 'price', 'address']
+
+# The columns of the clicked house shown in the info card and the histograms
+HOUSE_COLUMNS = ['latitude', 'longitude', 'price', 'address', 'salesDate', 'rooms',
+                 'lotSize', 'buildYear', 'm2price', 'size', 'type']
+
+
+class SearchData:
+    '''Everything the page derives from the sales table
+
+    When sales are added a new instance is built and swapped in whole, so a
+    callback calling search_data.get() once works on one consistent version even
+    while the data changes. previous is the data of the sales before the rows
+    were added at the end, whose indexes are extended with the added rows
+    instead of built again.
+    '''
+
+    def __init__(self, sales, previous=None):
+        self.sales = sales
+        # The months covered by the sales, chosen with the time slider
+        self.months = month_labels(sales.month)
+        if previous is None:
+            # Columnar index answering the filters
+            self.engine = FilterEngine(sales, self.months)
+            # Fixed bins for the histograms in the overview tabs, counted on
+            # the server
+            self.price_bins = UniformBins.covering(sales.price, PRICE_BIN_WIDTH)
+            self.m2price_bins = UniformBins.covering(sales.m2price, M2PRICE_BIN_WIDTH)
+            # Clusters of the sales precomputed for a range of zoom levels
+            self.clusters = ClusterLevels(sales.latitude, sales.longitude, sales.price)
+        else:
+            added = slice(len(previous.sales), None)
+            self.engine = previous.engine.updated(sales, self.months)
+            self.price_bins = previous.price_bins.extended(sales.price.iloc[added])
+            self.m2price_bins = previous.m2price_bins.extended(sales.m2price.iloc[added])
+            self.clusters = previous.clusters.updated(sales.latitude, sales.longitude, sales.price)
+        self.month_bins = UniformBins(0, 1, len(self.months))
+        # Server-side cache of the filter results and their summaries,
+        # shared by all sessions. Only a handle to the result is sent through
+        # the "filtered-data" dcc.Store
+        self.results = ResultStore(lambda state: self.engine.query(**state),
+                                   summarize=self.summarize,
+                                   canonical=canonical_state,
+                                   name="search")
+
+    def summarize(self, rows):
+        '''Return the number of sales at rows and their histograms'''
+        return {'count': len(rows),
+                'price_counts': self.price_bins.counts(self.engine.columns['price'][rows]),
+                'm2price_counts': self.m2price_bins.counts(self.sales.m2price.to_numpy()[rows]),
+                'month_counts': self.month_bins.counts(self.engine.month_codes[rows])}
+
+
+# Derived from the sales table shared by the pages (see utils/ingest.py) when
+# the page is first used (see utils/startup.py)
+search_data = startup.Lazy("data: pages.salesprices_and_overview", lambda: SearchData(ingest.sales.get()))
+
+
+# Drops the filter results (and the figures depending on them) of a session
+# superseded by a newer filter state of the same session
+coalescer = coalescing.Coalescer("search")
+
+
+@ingest.on_new_sales
+def add_sales(sales):
+    '''Swap in the data of sales, the sales table with new sales added'''
+    search_data.update(lambda data: data if data.sales is sales else SearchData(sales, data))
 
 
 #
 #   Filters
 #
 
-months = ["2019-07", "2019-08", "2019-09", "2019-10", "2019-11", "2019-12", 
-          "2020-01", "2020-02", "2020-03", "2020-04", "2020-05", "2020-06",
-          "2020-07", "2020-08", "2020-09", "2020-10", "2020-11", "2020-12",
-          "2021-01", "2021-02", "2021-03", "2021-04", "2021-05", "2021-06",
-          "2021-07", "2021-08", "2021-09", "2021-10", "2021-11"]
-
-# marks for time slider in filter
-marks = {i: {'label': ""} for i in range(0, len(months))}
-for i in range(0, len(months), 6):
-    marks[i] = {'label': months[i]}
+def filter_rows(months):
+    '''Return the rows of filters, with the time slider covering months'''
+    # marks for time slider in filter
+    marks = {i: {'label': ""} for i in range(0, len(months))}
+    for i in range(0, len(months), 6):
+        marks[i] = {'label': months[i]}
 
-filters = [
-    dbc.Row(
-    [
-        dbc.Col(
-        [
-            dbc.Label("Type", style={"margin-bottom": 0}),
-            dbc.Checklist(
-                id="type-choice",
-                options=[
-                    {"label": "House", "value": "House"},
-                    {"label": "Apartment", "value": "Apartment"},
-                    {"label": "Cottage", "value": "Cottage"},
-                ],
-                value = ["House", "Apartment", "Cottage"],
-                inline=True),
-        ], style={'margin-bottom': '10px'}
-        ),
-        dbc.Col(),
-        dbc.Col(),
-    ]
-    ),
-    dbc.Row([
-        dbc.Col(
-        [
-            dbc.Label("Sales Price", style={"margin-bottom": 0}),
-            html.Div(
-                [html.Div("0 kr.",
-                          id="price-slider-min",
-                          style={"display": "inline-block", "width": "50%", "text-align": "left", "opacity": "50%"}),
-                html.Div("10,000,000 kr. +", 
-                         id="price-slider-max",
-                         style={"display": "inline-block", "width": "50%", "text-align": "right", "opacity": "50%"})]
-                ),
-            dcc.RangeSlider(id="price-slider", 
-            min=0, 
-            max=10_000_000, 
-            value=[0, 10_000_000],
-            step= 500_000,
-            allowCross=False,
-            tooltip={"placement": "bottom"}),
-        ], style={'margin-bottom': '10px'}
-        ), 
-        dbc.Col(
-        [ 
-            dbc.Label("House Size", style={"margin-bottom": 0}),
-            html.Div(
-                [html.Div("0 m2",
-                          id="house-size-slider-min",
-                          style={"display": "inline-block", "width": "50%", "text-align": "left", "opacity": "50%"}),
-                html.Div("250 m2 +",
-                         id="house-size-slider-max", 
-                         style={"display": "inline-block", "width": "50%", "text-align": "right", "opacity": "50%"})]
-                ),
-            dcc.RangeSlider(id="house-size-slider", 
-            min=0, 
-            max=250, 
-            value=[0, 250],
-            step= 10,
-            allowCross=False,
-            tooltip={"placement": "bottom"}),
-        ], style={'margin-bottom': '10px'}
-        ), 
-        dbc.Col(
-        [
-            dbc.Label("Build Year", style={"margin-bottom": 0}),
-            html.Div(
-                [html.Div("1900 or before",
-                          id="build-year-slider-min", 
-                          style={"display": "inline-block", "width": "50%", "text-align": "left", "opacity": "50%"}),
-                html.Div("2021",
-                         id="build-year-slider-max",
-                         style={"display": "inline-block", "width": "50%", "text-align": "right", "opacity": "50%"})]
-                ),
-            dcc.RangeSlider(id="build-year-slider", 
-            min=1900, 
-            max=2021, 
-            value=[1900, 2021],
-            step= 10,
-            allowCross=False,
-            tooltip={"placement": "bottom"}) 
-        ], style={'margin-bottom': '10px'}
-        )
-    ]
-    ),
-    dbc.Row([
-        dbc.Col(
+    return [
+        dbc.Row(
         [
-            dbc.Label("Time of Sale", style={"margin-bottom": 0}),
-            html.Div(
-                [html.Div("2019 - 07",
-                          id="time-slider-min",
-                          style={"display": "inline-block", "width": "50%", "text-align": "left", "opacity": "50%"}),
-                html.Div("2021 - 11", 
-                         id="time-slider-max",
-                         style={"display": "inline-block", "width": "50%", "text-align": "right", "opacity": "50%"})]
-                ),
-            dcc.RangeSlider(id="time-slider", 
-            min=0, 
-            max=len(months) - 1, 
-            value=[0, len(months) - 1],
-            step= 1,
-            allowCross=False,
-            marks = marks),
+            dbc.Col(
+            [
+                dbc.Label("Type", style={"margin-bottom": 0}),
+                dbc.Checklist(
+                    id="type-choice",
+                    options=[
+                        {"label": "House", "value": "House"},
+                        {"label": "Apartment", "value": "Apartment"},
+                        {"label": "Cottage", "value": "Cottage"},
+                    ],
+                    value = ["House", "Apartment", "Cottage"],
+                    inline=True),
+            ], style={'margin-bottom': '10px'}
+            ),
+            dbc.Col(),
+            dbc.Col(),
         ]
-        ), 
-        dbc.Col(
-        [ 
-            dbc.Label("Lot Size", style={"margin-bottom": 0}),
-            html.Div(
-                [html.Div("0 m2",
-                          id="lot-size-slider-min",
-                          style={"display": "inline-block", "width": "50%", "text-align": "left", "opacity": "50%"}),
-                html.Div("10,000 m2 +",
-                         id="lot-size-slider-max", 
-                         style={"display": "inline-block", "width": "50%", "text-align": "right", "opacity": "50%"})]
-                ),
-            dcc.RangeSlider(id="lot-size-slider", 
-            min=0, 
-            max=10_000, 
-            value=[0, 10_000],
-            step= 500,
-            allowCross=False,
-            tooltip={"placement": "bottom"},)
+        ),
+        dbc.Row([
+            dbc.Col(
+            [
+                dbc.Label("Sales Price", style={"margin-bottom": 0}),
+                html.Div(
+                    [html.Div("0 kr.",
+                              id="price-slider-min",
+                              style={"display": "inline-block", "width": "50%", "text-align": "left", "opacity": "50%"}),
+                    html.Div("10,000,000 kr. +", 
+                             id="price-slider-max",
+                             style={"display": "inline-block", "width": "50%", "text-align": "right", "opacity": "50%"})]
+                    ),
+                dcc.RangeSlider(id="price-slider", 
+                min=0, 
+                max=10_000_000, 
+                value=[0, 10_000_000],
+                step= 500_000,
+                allowCross=False,
+                tooltip={"placement": "bottom"}),
+            ], style={'margin-bottom': '10px'}
+            ), 
+            dbc.Col(
+            [ 
+                dbc.Label("House Size", style={"margin-bottom": 0}),
+                html.Div(
+                    [html.Div("0 m2",
+                              id="house-size-slider-min",
+                              style={"display": "inline-block", "width": "50%", "text-align": "left", "opacity": "50%"}),
+                    html.Div("250 m2 +",
+                             id="house-size-slider-max", 
+                             style={"display": "inline-block", "width": "50%", "text-align": "right", "opacity": "50%"})]
+                    ),
+                dcc.RangeSlider(id="house-size-slider", 
+                min=0, 
+                max=250, 
+                value=[0, 250],
+                step= 10,
+                allowCross=False,
+                tooltip={"placement": "bottom"}),
+            ], style={'margin-bottom': '10px'}
+            ), 
+            dbc.Col(
+            [
+                dbc.Label("Build Year", style={"margin-bottom": 0}),
+                html.Div(
+                    [html.Div("1900 or before",
+                              id="build-year-slider-min", 
+                              style={"display": "inline-block", "width": "50%", "text-align": "left", "opacity": "50%"}),
+                    html.Div("2021",
+                             id="build-year-slider-max",
+                             style={"display": "inline-block", "width": "50%", "text-align": "right", "opacity": "50%"})]
+                    ),
+                dcc.RangeSlider(id="build-year-slider", 
+                min=1900, 
+                max=2021, 
+                value=[1900, 2021],
+                step= 10,
+                allowCross=False,
+                tooltip={"placement": "bottom"}) 
+            ], style={'margin-bottom': '10px'}
+            )
         ]
-        ), 
-        dbc.Col(
-        [
-            dbc.Label("Number of Rooms", style={"margin-bottom": 0}),
-            html.Div(
-                [html.Div("0",
-                          id="room-slider-min",
-                          style={"display": "inline-block", "width": "50%", "text-align": "left", "opacity": "50%"}),
-                html.Div("9 +",
-                         id="room-slider-max",
-                         style={"display": "inline-block", "width": "50%", "text-align": "right", "opacity": "50%"})]
-                ),
-            dcc.RangeSlider(id="room-slider", 
-            min=0, 
-            max=9, 
-            value=[0, 9],
-            step= 1,
-            allowCross=False,
-            tooltip={"placement": "bottom"}), 
+        ),
+        dbc.Row([
+            dbc.Col(
+            [
+                dbc.Label("Time of Sale", style={"margin-bottom": 0}),
+                html.Div(
+                    [html.Div(months[0].replace("-", " - "),
+                              id="time-slider-min",
+                              style={"display": "inline-block", "width": "50%", "text-align": "left", "opacity": "50%"}),
+                    html.Div(months[-1].replace("-", " - "), 
+                             id="time-slider-max",
+                             style={"display": "inline-block", "width": "50%", "text-align": "right", "opacity": "50%"})]
+                    ),
+                dcc.RangeSlider(id="time-slider", 
+                min=0, 
+                max=len(months) - 1, 
+                value=[0, len(months) - 1],
+                step= 1,
+                allowCross=False,
+                marks = marks),
+            ]
+            ), 
+            dbc.Col(
+            [ 
+                dbc.Label("Lot Size", style={"margin-bottom": 0}),
+                html.Div(
+                    [html.Div("0 m2",
+                              id="lot-size-slider-min",
+                              style={"display": "inline-block", "width": "50%", "text-align": "left", "opacity": "50%"}),
+                    html.Div("10,000 m2 +",
+                             id="lot-size-slider-max", 
+                             style={"display": "inline-block", "width": "50%", "text-align": "right", "opacity": "50%"})]
+                    ),
+                dcc.RangeSlider(id="lot-size-slider", 
+                min=0, 
+                max=10_000, 
+                value=[0, 10_000],
+                step= 500,
+                allowCross=False,
+                tooltip={"placement": "bottom"},)
+            ]
+            ), 
+            dbc.Col(
+            [
+                dbc.Label("Number of Rooms", style={"margin-bottom": 0}),
+                html.Div(
+                    [html.Div("0",
+                              id="room-slider-min",
+                              style={"display": "inline-block", "width": "50%", "text-align": "left", "opacity": "50%"}),
+                    html.Div("9 +",
+                             id="room-slider-max",
+                             style={"display": "inline-block", "width": "50%", "text-align": "right", "opacity": "50%"})]
+                    ),
+                dcc.RangeSlider(id="room-slider", 
+                min=0, 
+                max=9, 
+                value=[0, 9],
+                step= 1,
+                allowCross=False,
+                tooltip={"placement": "bottom"}), 
+            ]
+            )
         ]
-        )
+        ),
     ]
-    ),
-]
 
 #
 #   Info table for selected house
@@ -232,144 +317,128 @@ stat_card = dbc.Card(
     ]
 )
 
-@app.callback(
+# Swapping the graph in the card happens in the browser (see assets/clientside.js)
+app.clientside_callback(
+    ClientsideFunction(namespace="search", function_name="tab_content"),
     Output("card-content", "children"), 
     Input("card-tabs", "active_tab")
 )
-def tab_content(active_tab):
-    content = ""
-    if active_tab == "tab-1":
-        content = dcc.Graph(id="price-hist-fig")
-    elif active_tab == "tab-2":
-        content = dcc.Graph(id="number-of-sales-fig")
-    elif active_tab == "tab-3":
-        content = dcc.Graph(id="m2prices-fig")
-    return content
 
 
 #
 #   Page layout
 #
 
-page = html.Div(
-    [
-        html.Div(
-            [
-                html.H2("Search in House Sales"),
-                dbc.Card(dbc.CardBody(filters)),
-                html.Div(id='result-count', 
-                         style={'font-size': '14px','font-weight':'bold','margin-bottom':'10px', 'color': "succes"})
-            ]
-        ),
-        html.Div(
-            [
-                dcc.Graph(id="map-fig"),
-            ],
-            style={'width': '60%', 'display': 'inline-block', 'vertical-align':'top', "padding-top": 30}
-        ),
-        html.Div(
-            [ 
-                html.H4("Overview of Search Result"),
-                stat_card,
-                html.Br(),
-                info_card
-            ],
-            style={'width': '40%', 'display': 'inline-block', 'vertical-align':'top'}
-        ),
-        dcc.Store(id="filtered-data")
-    ]
-)
+@functools.lru_cache(maxsize=4)
+def page_layout(months):
+    '''Return the page for the months (a tuple) covered by the data'''
+    return html.Div(
+        [
+            html.Div(
+                [
+                    html.H2("Search in House Sales"),
+                    dbc.Card(dbc.CardBody(filter_rows(months))),
+                    html.Div(id='result-count', 
+                             style={'font-size': '14px','font-weight':'bold','margin-bottom':'10px', 'color': "succes"})
+                ]
+            ),
+            html.Div(
+                [
+                    dcc.Graph(id="map-fig"),
+                ],
+                style={'width': '60%', 'display': 'inline-block', 'vertical-align':'top', "padding-top": 30}
+            ),
+            html.Div(
+                [ 
+                    html.H4("Overview of Search Result"),
+                    stat_card,
+                    html.Br(),
+                    info_card
+                ],
+                style={'width': '40%', 'display': 'inline-block', 'vertical-align':'top'}
+            ),
+            dcc.Store(id="filtered-data"),
+            # Labels of the time slider, used by the clientside callbacks
+            dcc.Store(id="month-labels", data=list(months))
+        ]
+    )
+
+
+def layout():
+    '''Return the page for the current data, with a new session id (see
+    utils/coalescing.py)'''
+    return html.Div([page_layout(tuple(search_data.get().months)),
+                     dcc.Store(id="session-id", data=uuid.uuid4().hex),
+                     # Sequence number of the latest filter state, set in the
+                     # browser
+                     dcc.Store(id="filter-sequence")])
+
 
 #
-#   6 callbacks for updating displays with chosen filter values
+#   6 clientside callbacks for updating displays with chosen filter values
+#   (see assets/clientside.js)
 #
 
 
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="search", function_name="price_range_display"),
     Output("price-slider-min", "children"),
     Output("price-slider-max", "children"),
     Input("price-slider", "value")
 )
-def update_chosen_price_range_display(price_range):
-    min_price = '{:,}'.format(price_range[0]) + " kr."
-    max_price = '{:,}'.format(price_range[1]) + " kr."
-    if price_range[1] == 10_000_000:
-        max_price = max_price + " +"
-    return min_price, max_price
 
 
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="search", function_name="room_range_display"),
     Output("room-slider-min", "children"),
     Output("room-slider-max", "children"),
     Input("room-slider", "value")
 )
-def update_chosen_room_range_display(room_range):
-    min_room = room_range[0]
-    max_room = room_range[1]
-    if max_room == 9:
-        max_room = str(max_room) + "+"
-    return min_room, max_room
 
 
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="search", function_name="house_size_range_display"),
     Output("house-size-slider-min", "children"),
     Output("house-size-slider-max", "children"),
     Input("house-size-slider", "value")
 )
-def update_chosen_house_size_range_display(size_range):
-    min_size= str(size_range[0]) + " m2"
-    max_size = str(size_range[1]) + " m2"
-    if max_size == "250 m2":
-        max_size = max_size + "+"
-    return min_size, max_size
 
 
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="search", function_name="lot_size_range_display"),
     Output("lot-size-slider-min", "children"),
     Output("lot-size-slider-max", "children"),
     Input("lot-size-slider", "value")
 )
-def update_chosen_lot_size_range_display(size_range):
-    min_size= str(size_range[0]) + " m2"
-    max_size = '{:,}'.format(size_range[1]) + " m2"
-    if max_size == "10,000 m2":
-        max_size = max_size + "+"
-    return min_size, max_size
 
 
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="search", function_name="build_year_range_display"),
     Output("build-year-slider-min", "children"),
     Output("build-year-slider-max", "children"),
     Input("build-year-slider", "value")
 )
-def update_chosen_build_year_size_range_display(year_range):
-    min_year = str(year_range[0])
-    max_year = str(year_range[1])
-    if min_year == "1900":
-        min_year = min_year + " or before"
-    if max_year == "2020":
-        max_year = "2021"
-    return min_year, max_year
 
 
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="search", function_name="time_range_display"),
     Output("time-slider-min", "children"),
     Output("time-slider-max", "children"),
-    Input("time-slider", "value")
+    Input("time-slider", "value"),
+    State("month-labels", "data")
 )
-def update_chosen_sales_time_range_display(time_range):
-    min_time = months[int(time_range[0])]
-    max_time = months[int(time_range[1])]
-    return min_time, max_time
 
 
 #
 #   Other callbacks
 #
 
-
-@app.callback(
-    Output("filtered-data", "data"),
+# Number every filter state in the order the browser sends them (see
+# assets/clientside.js), so a newer state handled first by the server is not
+# taken for an older one
+app.clientside_callback(
+    ClientsideFunction(namespace="search", function_name="next_filter_sequence"),
+    Output("filter-sequence", "data"),
     Input("price-slider", "value"),
     Input("time-slider", "value"),
     Input("house-size-slider", "value"),
@@ -377,91 +446,128 @@ def update_chosen_sales_time_range_display(time_range):
     Input("room-slider", "value"),
     Input("build-year-slider", "value"),
     Input("type-choice", "value"),
-    Input("map-fig", 'relayoutData')
+    Input("map-fig", 'relayoutData'),
 )
-def apply_filters(price_range, time_range, house_size_range, lot_size_range, 
-                  room_range, build_year_range, type_choices, zoom_range):
-    df = sales
-    
-    # Filter on type of house
-    df = df[df['type'].isin(type_choices)]
-    
-    # Filter on price
-    if price_range[1] == 10_000_000:
-        df = df[df.price >= price_range[0]]
-    else:
-        df = df[df.price.between(*price_range)]
-    
-    # Filter on time of sale
-    min_time = months[int(time_range[0])]
-    max_time = months[int(time_range[1])]
-    df = df[df['datetimes'].between(min_time, max_time)]
-
-    # Filter on house size
-    if house_size_range[1] == 250:
-        df = df[df['size'] >= house_size_range[0]]
-    else:
-        df = df[df['size'].between(*house_size_range)]
-    
-    # Filter on lot size
-    if lot_size_range[1] == 10_000:
-        df = df[df.lotSize >= lot_size_range[0]]
-    else:
-        df = df[df.lotSize.between(*lot_size_range)]
-    
-    # Filter on number of rooms
-    if room_range[0] == 0 and room_range[1]==9:
-        df = df    
-    elif room_range[1] == 9:
-        df = df[df.rooms >= room_range[0]]
-    else:
-        df = df[df.rooms.between(*room_range)]
-    
-    # Filter on year build
-    if build_year_range[0] == 1900 and build_year_range[1] != 2020:
-        df = df[df.buildYear <= build_year_range[1]]
-    elif build_year_range[1] == 2020 and build_year_range[0] != 1900:
-        df = df[df.buildYear >= build_year_range[0]]
-    else:
-        df = df[df.buildYear.between(*build_year_range)]
-    
-    if zoom_range and "mapbox._derived" in zoom_range:
-        
-        min_longitude = zoom_range["mapbox._derived"]['coordinates'][0][0]
-        max_longitude = zoom_range["mapbox._derived"]['coordinates'][1][0]
-        
-        min_latitude = zoom_range["mapbox._derived"]['coordinates'][2][1]
-        max_latitude = zoom_range["mapbox._derived"]['coordinates'][0][1]
-
-        df = df[df.latitude.between(min_latitude, max_latitude)]
-        df = df[df.longitude.between(min_longitude, max_longitude)]
-        
-    return df.to_json()
 
 
 @app.callback(
-    Output("map-fig", "figure"),
-    Input("filtered-data", "data"),
-    Input("map-fig", "clickData")
+    Output("filtered-data", "data"),
+    Input("price-slider", "value"),
+    Input("time-slider", "value"),
+    Input("house-size-slider", "value"),
+    Input("lot-size-slider", "value"),
+    Input("room-slider", "value"),
+    Input("build-year-slider", "value"),
+    Input("type-choice", "value"),
+    Input("map-fig", 'relayoutData'),
+    Input("filter-sequence", "data"),
+    State("session-id", "data")
 )
-def update_map(data, clickData):
-    df = pd.read_json(data)
-    color_scale = [(0, "#440154"), (0.03, "#443983"),(0.125,"#31688e"),(0.25,"#21918c"), (0.5,"#35b779"), (25/36,"#90d743") , (1, "#fde725")]
+def apply_filters(price_range, time_range, house_size_range, lot_size_range, 
+                  room_range, build_year_range, type_choices, zoom_range, sequence, session):
+    coalescer.begin(session, sequence)
+    viewport = viewport_from_relayout(zoom_range)
+    state = {'price_range': price_range,
+             'time_range': time_range,
+             'house_size_range': house_size_range,
+             'lot_size_range': lot_size_range,
+             'room_range': room_range,
+             'build_year_range': build_year_range,
+             'type_choices': sorted(type_choices),
+             'viewport': list(viewport) if viewport else None}
+    handle = search_data.get().results.put(state)
+    # Only the latest filter state of the session gets its figures drawn
+    coalescer.finish(session, sequence)
+    return dict(handle, session=session, sequence=sequence)
+
+
+def clicked_house(clickData, sales):
+    '''Return the columns of the house clicked on the map as a dict, or None
+    if no house (or a cluster of houses) was clicked'''
+    if not clickData:
+        return None
+    # Rows keep their positions when sales are added, so the row of a marker
+    # drawn before still points at the same house
+    row = clickData['points'][0].get('customdata')
+    if isinstance(row, bool) or not isinstance(row, int) or not 0 <= row < len(sales):
+        return None
+    # Missing values (like the build year of some houses) are shown empty,
+    # as None, instead of as "nan"
+    return {name: None if isinstance(value, float) and np.isnan(value) else value
+            for name, value in sales.row(row, HOUSE_COLUMNS).items()}
+
+
+def map_zoom(relayoutData):
+    '''Return the current zoom level of the map'''
+    if relayoutData and "mapbox.zoom" in relayoutData:
+        return relayoutData["mapbox.zoom"]
+    return MAP_ZOOM
+
+
+def marker_figure(sales, rows):
+    '''Return the map with a marker for each of the sales at rows'''
+    df = sales.take(rows, MARKER_COLUMNS)
     fig = px.scatter_mapbox(df, 
                             lat="latitude", 
                             lon="longitude", 
                             color="price",
                             height=840,
-                            zoom=8.3,
-                            center=dict(lat=55.18,lon=10.3),
-                            hover_data=['salesDate', 'rooms', 'lotSize','buildYear', 'm2price', 'size', 'type'],
+                            zoom=MAP_ZOOM,
+                            center=MAP_CENTER,
                             labels={"price": "Price in DKK"},
                             template="simple_white",
                             range_color=[1e5, 10_000_000],
-                            color_continuous_scale=color_scale
+                            color_continuous_scale=MAP_COLOR_SCALE
                             )
     fig.update_traces(hovertemplate='<b>%{text}</b><br>Price %{marker.color: ,} kr.',
-                      text=df.address)
+                      text=df.address,
+                      customdata=rows)
+    # Making markers bigger
+    fig.update_traces(marker={'size': 8})
+    return fig
+
+
+def cluster_figure(clusters, rows, zoom):
+    '''Return the map with the sales at rows grouped in clusters sized for
+    the zoom level'''
+    level = clusters.level_for(cell_size_for_zoom(zoom))
+    groups = clusters.clusters(level, rows)
+    # Marker area grows with the number of sales in the cluster
+    sizes = np.clip(6 + 2 * np.sqrt(groups['count']), 8, 40)
+    fig = go.Figure(go.Scattermapbox(lat=groups['latitude'],
+                                     lon=groups['longitude'],
+                                     mode='markers',
+                                     marker=dict(size=sizes, 
+                                                 color=groups['median'], 
+                                                 coloraxis='coloraxis',
+                                                 opacity=0.8),
+                                     text=groups['count'],
+                                     hovertemplate='<b>%{text:,} sales</b><br>'
+                                                   'Median price %{marker.color:,.0f} kr.<extra></extra>',
+                                     showlegend=False))
+    fig.update_layout(height=840,
+                      template="simple_white",
+                      mapbox=dict(center=MAP_CENTER, zoom=MAP_ZOOM),
+                      coloraxis=dict(cmin=1e5, cmax=10_000_000, colorscale=MAP_COLOR_SCALE))
+    return fig
+
+
+@app.callback(
+    Output("map-fig", "figure"),
+    Input("filtered-data", "data"),
+    Input("map-fig", "clickData"),
+    State("map-fig", "relayoutData")
+)
+@figure_encoding.encoded
+def update_map(data, clickData, relayoutData):
+    coalescer.check(data)
+    current = search_data.get()
+    rows = current.results.rows(data)
+    zoom = map_zoom(relayoutData)
+    if zoom < CLUSTER_BELOW_ZOOM or len(rows) > MAX_MARKERS:
+        fig = cluster_figure(current.clusters, rows, zoom)
+    else:
+        fig = marker_figure(current.sales, rows)
     #fig.update_layout(mapbox_style="open-street-map")
     fig.update_layout(mapbox_style="carto-positron")
     # Move colorbar to the left
@@ -473,38 +579,61 @@ def update_map(data, clickData):
 ))
     # Change ticks on colorbar away from 3M to 3,000,000
     fig.update_coloraxes(colorbar_tickformat=',')
-    # Making markers bigger
-    fig.update_traces(marker={'size': 8})
     # Prevent zoom reset when selecting house on map
     fig.update_layout(uirevision="static")
     fig.update_layout(margin={'l': 0, 'r': 30, 't': 5, 'b': 30})
     # Coloring the selected house red on the map
-    if clickData:
-        fig.add_trace(go.Scattermapbox(lat=[clickData['points'][0]['lat']], 
-                                    lon=[clickData['points'][0]['lon']], 
+    house = clicked_house(clickData, current.sales)
+    if house:
+        fig.add_trace(go.Scattermapbox(lat=[house['latitude']], 
+                                    lon=[house['longitude']], 
                                     mode='markers', 
                                     marker=go.scattermapbox.Marker(color='red', size=12),
                                     hovertemplate="<b>Selected</b><extra></extra>",
                                     showlegend=False,))
+    # Building the figure takes a while: skip sending it when the filters of
+    # the session changed meanwhile
+    coalescer.check(data)
+    return fig
+
+
+def histogram_figure(x, counts, x_title, **bar_options):
+    '''Return a bar chart drawing precomputed bin counts as a histogram'''
+    fig = go.Figure(go.Bar(x=x, y=counts, **bar_options))
+    fig.update_layout(template="simple_white",
+                      height=250,
+                      bargap=0,
+                      xaxis_title=x_title)
+    fig.update_layout(margin={'l': 0, 'r': 0, 't': 0, 'b': 0})
+    fig.update_yaxes({'title': {'text': 'Count'}})
     return fig
 
 
+def binned_histogram_figure(bins, counts, x_title):
+    '''Return a histogram of the counts in the fixed bins'''
+    shown = trim_empty(counts)
+    edges = bins.edges
+    ranges = np.stack([edges[:-1], edges[1:]], axis=1)[shown]
+    return histogram_figure(bins.centers[shown], counts[shown], x_title,
+                            width=bins.width,
+                            customdata=ranges,
+                            hovertemplate='%{customdata[0]:,} - %{customdata[1]:,} kr.'
+                                          '<br>Count %{y}<extra></extra>')
+
+
 @app.callback(
     Output("price-hist-fig", "figure"),
     Input("filtered-data", "data"),
     Input("map-fig", "clickData")
 )
 def update_histogram(data, clickData):
-    filtered_data = pd.read_json(data)
-    fig = px.histogram(filtered_data, 
-                        x='price',
-                        template="simple_white",
-                        height=250,
-                        labels={'price': "Price in DKK"})
-    fig.update_layout(margin={'l': 0, 'r': 0, 't': 0, 'b': 0})
-    fig.update_yaxes({'title': {'text': 'Count'}})
-    if clickData:
-        x = clickData['points'][0]['marker.color']
+    coalescer.check(data)
+    current = search_data.get()
+    counts = current.results.summary(data)['price_counts']
+    fig = binned_histogram_figure(current.price_bins, counts, "Price in DKK")
+    house = clicked_house(clickData, current.sales)
+    if house:
+        x = house['price']
         fig.add_vline(x=x, 
                     line_width=4, 
                     line_dash="dash", 
@@ -519,16 +648,13 @@ def update_histogram(data, clickData):
     Input("map-fig", "clickData")
 )
 def update_histogram_m2_prices(data, clickData):
-    filtered_data = pd.read_json(data)
-    fig = px.histogram(filtered_data, 
-                        x='m2price',
-                        template="simple_white",
-                        height=250,
-                        labels={'m2price': "Price per m2 in DKK"})
-    fig.update_layout(margin={'l': 0, 'r': 0, 't': 0, 'b': 0})
-    fig.update_yaxes({'title': {'text': 'Count'}})
-    if clickData:
-        x = clickData['points'][0]['customdata'][4]
+    coalescer.check(data)
+    current = search_data.get()
+    counts = current.results.summary(data)['m2price_counts']
+    fig = binned_histogram_figure(current.m2price_bins, counts, "Price per m2 in DKK")
+    house = clicked_house(clickData, current.sales)
+    if house:
+        x = house['m2price']
         fig.add_vline(x=x, 
                   line_width=4, 
                   line_dash="dash", 
@@ -543,22 +669,16 @@ def update_histogram_m2_prices(data, clickData):
     Input("map-fig", "clickData")
 )
 def update_histogram_number_of_sales(data, clickData):
-    filtered_data = pd.read_json(data) 
-    x = filtered_data.salesDate
-    y = [1] * len(x)
-    fig = px.histogram(x=x, 
-                        y=y,
-                        template="simple_white",
-                        height=250,
-                        labels={'x': "Time of Sale"})
-    fig.update_traces(xbins=dict(
-                        start='2019-07-01',
-                        end='2021-11-31',
-                        size='M1'))
-    fig.update_layout(margin={'l': 0, 'r': 0, 't': 0, 'b': 0})
-    fig.update_yaxes({'title': {'text': 'Count'}})
-    if clickData:
-        x = clickData['points'][0]['customdata'][0]
+    coalescer.check(data)
+    current = search_data.get()
+    counts = current.results.summary(data)['month_counts']
+    fig = histogram_figure(current.months, counts, "Time of Sale",
+                           xperiod="M1",
+                           xperiodalignment="middle",
+                           hovertemplate='%{x|%B %Y}<br>Count %{y}<extra></extra>')
+    house = clicked_house(clickData, current.sales)
+    if house:
+        x = house['salesDate']
         fig.add_vline(x=x, 
                     line_width=4, 
                     line_dash="dash", 
@@ -567,7 +687,6 @@ def update_histogram_number_of_sales(data, clickData):
     return fig
 
 
-
 @app.callback(
     Output("table-address", "children"),
     Output("table-type", "children"),
@@ -591,16 +710,18 @@ def update_info_card(clickData):
     rooms = ""
     buildYear = ""
     
-    if clickData:
-        house_type = clickData['points'][0]['customdata'][6]
-        rooms = clickData['points'][0]['customdata'][1]
-        lot_size = '{:,}'.format(clickData['points'][0]['customdata'][2]) + " m2"
-        buildYear = clickData['points'][0]['customdata'][3]
-        m2price = "{:,.2f}".format(clickData['points'][0]['customdata'][4]) + " kr."
-        house_size = str(clickData['points'][0]['customdata'][5]) + " m2"
-        address = clickData['points'][0]['text']
-        price = '{:,}'.format(clickData['points'][0]['marker.color']) + " kr."
-        salesDate = clickData['points'][0]['customdata'][0]
+    house = clicked_house(clickData, search_data.get().sales)
+    
+    if house:
+        house_type = house['type']
+        rooms = house['rooms']
+        lot_size = '{:,}'.format(house['lotSize']) + " m2"
+        buildYear = house['buildYear']
+        m2price = "{:,.2f}".format(house['m2price']) + " kr."
+        house_size = str(house['size']) + " m2"
+        address = house['address']
+        price = '{:,}'.format(house['price']) + " kr."
+        salesDate = house['salesDate']
         if type(salesDate) is str:
             salesDate = salesDate[0:10]
 
@@ -616,9 +737,10 @@ def update_info_card_headers(clickData):
     title = "Info"
     subtitle = "Choose House on Map"
     red_dot_image = ""
-    if clickData:
+    house = clicked_house(clickData, search_data.get().sales)
+    if house:
         subtitle = ""
-        address = clickData['points'][0]['text']
+        address = house['address']
         street, city = address.split(",")
         red_dot_image = html.Img(src="assets/red_dot.png", height=24, style={"padding-right": 10, "padding-bottom": 4})
         title = [red_dot_image, street]
@@ -631,5 +753,5 @@ def update_info_card_headers(clickData):
     Input('filtered-data', 'data'),
 )
 def update_num_results(data):
-    filtered_data = pd.read_json(data)
-    return f"Your search gave {len(filtered_data)} results"
\ No newline at end of file
+    coalescer.check(data)
+    return f"Your search gave {search_data.get().results.summary(data)['count']} results"
\ No newline at end of file
@@ -1,176 +1,221 @@
-from dash import Input, Output, State, dcc, html, callback_context
+from dash import ClientsideFunction, Input, Output, State, dcc, html
 import dash_bootstrap_components as dbc
 
-import pandas as pd
-import json
+import numpy as np
 
 import plotly.express as px
-import plotly.graph_objects as go
+import plotly.io as pio
 
 from app import app
+from utils import aggregates, figure_cache, figure_encoding, geometry, ingest, startup
 
 #
 # Loading the data
 #
 
-# Geojson file with the shape of the zip code areas on Fyn with a unique ID pr shape 
-with open('data/zip_code_areas_fyn_with_id.geojson', "r") as f:
-    zip_code_areas = json.load(f)
+class PageData:
+    '''The datasets shown on the page
 
-# Dataset with the number of sales per quarter optimized for the map
-with open('data/total_sales_by_quarter.csv', "r") as f:
-    total_sales = pd.read_csv(f)
+    The number of sales are held as matrices with a row per zip code and a
+    column per quarter, one for each value of the radio items, so the figures
+    slice what they show out of them.
+    '''
 
-# Dataset with the number of sales per quarter optimized for the bar chart
-with open('data/total_sales_by_quarter_for_bar.csv', "r") as f:
-    total_sales_bar = pd.read_csv(f)
+    def __init__(self, datasets, zip_code_areas):
+        # The shape of the zip code areas on Fyn with a unique ID pr shape
+        # (simplified and shared with the other choropleth page)
+        self.zip_code_areas = zip_code_areas
+        # Dataset with the number of sales per zip code and quarter
+        total_sales_bar = datasets['total_sales_by_quarter_for_bar']
+        # A list with the quarters covered in the dataset
+        self.quarters = sorted(total_sales_bar.quarter_name.unique())
+        # The zip codes in the dataset in increasing order, and the row of
+        # each in the matrices
+        self.zip_codes = np.sort(total_sales_bar.zip_code.unique())
+        self.zip_rows = {int(zip_code): row for row, zip_code in enumerate(self.zip_codes)}
+        rows = total_sales_bar.zip_code.map(self.zip_rows).to_numpy()
+        columns = total_sales_bar.quarter_name.map({q: i for i, q in enumerate(self.quarters)}).to_numpy()
+        shape = (len(self.zip_codes), len(self.quarters))
+        self.sales = {'abs_num': np.zeros(shape, dtype=np.int64),
+                      'rel_num': np.zeros(shape)}
+        self.sales['abs_num'][rows, columns] = total_sales_bar.sales.to_numpy()
+        self.sales['rel_num'][rows, columns] = total_sales_bar.rel_sales.to_numpy()
+        # Dataset with the shapes of every zip code (the number of sales per
+        # quarter is repeated for each shape)
+        total_sales = datasets['total_sales_by_quarter']
+        areas = total_sales[total_sales.quarter_name == self.quarters[0]].dropna(subset=['id'])
+        # "zip name" of every zip code, shown in the dropdown and on the map
+        names = dict(zip(total_sales.zip_code, total_sales.name))
+        self.zip_labels = [f"{zip_code} {names[zip_code]}" for zip_code in self.zip_codes]
+        # The ID of every shape, the row of its zip code and its label
+        self.area_ids = areas.id.to_numpy().astype(np.int64)
+        self.area_rows = areas.zip_code.map(self.zip_rows).to_numpy()
+        self.area_labels = [self.zip_labels[row] for row in self.area_rows]
+
+
+def load_page_data(sales):
+    '''Return the data of the page for the sales table'''
+    return PageData(aggregates.load(sales), geometry.zip_code_areas.get().geojson)
+
+
+# Derived from the sales table shared by the pages (see utils/aggregates.py
+# and utils/ingest.py) when the page is first used (see utils/startup.py)
+page_data = startup.Lazy("data: pages.totalsales", lambda: load_page_data(ingest.sales.get()))
 
-#
-#   Helper functions
-#
-def translate_zips_to_ids_and_colors(zips):
-    '''Return a list with the IDs corresponding to the zip codes in zips'''
-    ids = []
-    colors = px.colors.qualitative.Vivid    # 11 colors
-    for i, zip_code in enumerate(zips):
-        color_index = i % 11
-        color = colors[color_index]
-        zip_text = str(zip_code)
-        for item in zip_code_areas['features']:
-            if item['properties']['POSTNR_TXT'] == zip_text:
-                ids.append((item['id'], color))
-    return ids
 
 #
 # Creating the content
 #
 
-# A list with the quarters covered in the dataset
-quarters = list(total_sales.quarter_name.unique())
-# Slider for choosing the month and year
-marks = {i: {'label': label} for i, label in enumerate(quarters)}
-
-total_sales_slider = dcc.Slider(id='month_slider_total_sales',
-                                min=0, 
-                                max=len(quarters)-1, 
-                                value=len(quarters)-1,
-                                step=1,
-                                marks=marks,
-                                included=False)
-
-# Dropdown menu for selecting zip code areas
-zips_and_names = total_sales[['zip_code', 'name']].drop_duplicates()
-zips_and_names.sort_values('zip_code', inplace=True)
-zipped = zip(zips_and_names.zip_code, zips_and_names.name)
-dropdown_options_total_sales = [{'label': str(z) + " " + str(name), 'value': z} for z, name in zipped]
-
-total_sales_dropdown = dcc.Dropdown(id="zip_dropdown_total_sales",
-                                options=dropdown_options_total_sales,
-                                value=[5000, 5900],
-                                multi=True)
-
-
-# The content of the page styled to be two rows
-page0 = [
-        dbc.Container(
-            [   html.H2("Number of Houses Sold"),
-                dbc.RadioItems(options = [{'label': 'Number of Sales', 'value': 'abs_num'},
-                                          {'label': 'Sales per 1000 Residences', 'value': 'rel_num'}],
-                               value = 'abs_num',
-                               labelStyle = {'display': 'inline-block'},
-                               id="rel_abs_radio"),
-                html.Br(),   
-                html.H4(id="total_sales_header", children="2021 - Q4"),      
-                dcc.Graph(id='total_sales_map'),
-                html.Div("Choose Quarter", className="form-label"),
-                total_sales_slider
-            ],
-            style={'width':'50%', 'display':'inline-block', 'vertical-align':'top'}
-        ), 
-        dbc.Container(
-            [   
-                html.H4("Development over Time"),
-                html.Div("Choose Zip Code Areas", className="form-label"),
-                total_sales_dropdown,
-                dcc.Graph(id="total_sales_bar")
-            ], 
-            style={'width':'50%','display':'inline-block', 'vertical-align':'top'}
-        ),
-        dbc.Container(
-            html.P("(*) Note that the data does not cover the last days in 2021-Q4. This can falsely appear as a drop in sales."),
-            style={'font-size': '12px', 'margin-top': '40px', 'color': 'gray'}
-        )
-    ]
+def build_page(data):
+    '''Return the content of the page for data'''
+    quarters = data.quarters
+
+    # Slider for choosing the month and year
+    marks = {i: {'label': label} for i, label in enumerate(quarters)}
+
+    total_sales_slider = dcc.Slider(id='month_slider_total_sales',
+                                    min=0, 
+                                    max=len(quarters)-1, 
+                                    value=len(quarters)-1,
+                                    step=1,
+                                    marks=marks,
+                                    included=False)
+
+    # Dropdown menu for selecting zip code areas
+    zipped = zip(data.zip_codes, data.zip_labels)
+    dropdown_options_total_sales = [{'label': label, 'value': int(z)} for z, label in zipped]
+
+    total_sales_dropdown = dcc.Dropdown(id="zip_dropdown_total_sales",
+                                    options=dropdown_options_total_sales,
+                                    value=[5000, 5900],
+                                    multi=True)
+
+    # The content of the page styled to be two rows
+    return [
+            dbc.Container(
+                [   html.H2("Number of Houses Sold"),
+                    dbc.RadioItems(options = [{'label': 'Number of Sales', 'value': 'abs_num'},
+                                              {'label': 'Sales per 1000 Residences', 'value': 'rel_num'}],
+                                   value = 'abs_num',
+                                   labelStyle = {'display': 'inline-block'},
+                                   id="rel_abs_radio"),
+                    html.Br(),   
+                    # The title of the last quarter, as title_for_quarter in
+                    # assets/clientside.js makes it
+                    html.H4(id="total_sales_header", children=f"{quarters[-1]} (*)"),
+                    dcc.Graph(id='total_sales_map'),
+                    html.Div("Choose Quarter", className="form-label"),
+                    total_sales_slider
+                ],
+                style={'width':'50%', 'display':'inline-block', 'vertical-align':'top'}
+            ), 
+            dbc.Container(
+                [   
+                    html.H4("Development over Time"),
+                    html.Div("Choose Zip Code Areas", className="form-label"),
+                    total_sales_dropdown,
+                    dcc.Graph(id="total_sales_bar")
+                ], 
+                style={'width':'50%','display':'inline-block', 'vertical-align':'top'}
+            ),
+            dbc.Container(
+                html.P(f"(*) Note that the data does not cover the last days in {quarters[-1]}. "
+                       "This can falsely appear as a drop in sales."),
+                style={'font-size': '12px', 'margin-top': '40px', 'color': 'gray'}
+            ),
+            # Labels of the quarter slider, used by the clientside callbacks
+            dcc.Store(id="quarter_labels", data=quarters),
+        ]
+
+
+page0 = startup.Lazy("layout: pages.totalsales", lambda: build_page(page_data.get()))
+
+
+def layout():
+    '''Return the content of the page'''
+    return page0.get()
+
+
+@ingest.on_new_sales
+def add_sales(sales):
+    '''Swap in the data and the content of the page for sales, the sales
+    table with new sales added, and drop the figures of the old data'''
+    page_data.update(lambda data: load_page_data(sales))
+    page0.update(lambda content: build_page(page_data.get()))
+    for figure in (total_sales_base_choropleth, update_choropleth_with_total_sales,
+                   update_bar_chart_with_total_sales):
+        figure.cache.clear()
 
 
 #
 #   Callbacks
 #
 
-@app.callback(
-    Output("total_sales_map", "figure"),
-    Input("rel_abs_radio", "value"),
-    Input("zip_dropdown_total_sales", "value"),
-    Input("month_slider_total_sales", "value"),
-    )
-def update_choropleth_with_total_sales(rel_or_abs, selected_zips, date):
-    '''Create and update the choropleth map of Fyn with number of sold houses'''
-    quarter = "2021-Q4"
+# Titles of the number of sales chosen with the radio items, on the map and
+# on the bar chart
+COLOR_TITLES = {'abs_num': "Number of Sales",
+                'rel_num': "Sales per 1000 Residences"}
+Y_TITLES = {'abs_num': "Number of Sales",
+            'rel_num': "Sales per 1000<br>Residences"}
+
+# One entry per quarter and radio value
+@figure_cache.memoize(max_entries=64)
+def total_sales_base_choropleth(rel_or_abs, date):
+    '''Create the choropleth map of Fyn with number of sold houses in the
+    quarter, without the selected zip code areas'''
+    data = page_data.get()
     if rel_or_abs == "rel_num":
-        color = "rel_sales"
         range_color = [0, 75]
     else:
-        color = "sales"
         range_color = [0, 150]
-    quarter = quarters[date]
-    total_sales_selected_quarter = total_sales[total_sales.quarter_name==quarter]
+    # The number of sales in the quarter for every shape
+    color = data.sales[rel_or_abs][data.area_rows, date]
     # Change the coloring according to the chosen month
-    fig = px.choropleth(total_sales_selected_quarter,
-                geojson=zip_code_areas, 
+    fig = px.choropleth(geojson=data.zip_code_areas, 
                 color=color, 
-                locations='id',
+                locations=data.area_ids,
                 projection="mercator",
                 range_color=range_color,
                 color_continuous_scale=[[0, 'white'], [1, '#222222']],
                 height=450,
                 template='simple_white',
-                labels={"sales": 'Number of Sales',
-                        "rel_sales": "Sales per 1000 Residences"})
+                labels={"color": COLOR_TITLES[rel_or_abs]})
     # Zoom in on Fyn
     fig.update_geos(fitbounds="locations", visible=False)
     # Remove margins and Move colorbar to the left
     fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0},
                       coloraxis_colorbar_x=-0.08)
     # Make the hover data look nice
-    area_zips_and_names = list(total_sales['zip_code'].apply(str) + " " + total_sales['name'].apply(str))
     fig.update_traces(hovertemplate='<b>%{customdata}</b><br>%{z}', 
-                      customdata=area_zips_and_names)
-    # Highlight selected zips on the map
-    id_color_pairs = translate_zips_to_ids_and_colors(selected_zips)
-    for ic in id_color_pairs:
-        fig.add_trace(go.Choropleth(geojson=zip_code_areas,
-                                    locationmode="geojson-id",
-                                    locations=[ic[0]],
-                                    z = [1],
-                                    colorscale = [[0, 'rgba(0,0,0,0)'],[1, 'rgba(0,0,0,0)']],
-                                    colorbar=None,
-                                    showscale =False,
-                                    marker = {"line": {"color": ic[1], "width": 3}},
-                                    hoverinfo='skip'))
-    return  fig
+                      customdata=data.area_labels)
+    return fig.to_plotly_json()
 
 
 @app.callback(
+    Output("total_sales_map", "figure"),
+    Input("rel_abs_radio", "value"),
+    Input("zip_dropdown_total_sales", "value"),
+    Input("month_slider_total_sales", "value"),
+    )
+@figure_cache.memoize()
+@figure_encoding.encoded
+def update_choropleth_with_total_sales(rel_or_abs, selected_zips, date):
+    '''Create and update the choropleth map of Fyn with number of sold houses'''
+    # The map for the quarter is cached separately from the selection, so
+    # changing the selected zips does not recompute it
+    fig = total_sales_base_choropleth(rel_or_abs, date)
+    # Highlight selected zips on the map (one trace outlining all of them)
+    return geometry.with_highlight(fig, selected_zips)
+
+
+# Changing the title happens in the browser (see assets/clientside.js)
+app.clientside_callback(
+    ClientsideFunction(namespace="totalsales", function_name="title_for_quarter"),
     Output("total_sales_header", "children"),
     Input("month_slider_total_sales", "value"),
+    State("quarter_labels", "data")
     )
-def update_title_to_match_chosen_quarter_total_sales(date):
-    '''Change the title to show the chosen month and year.'''
-    quarter = "2021-Q4 (*)"
-    quarter = quarters[date]
-    if date == len(quarters) - 1:
-        quarter = quarters[date] + " (*)"
-    return quarter
 
 
 @app.callback(
@@ -188,48 +233,94 @@ def update_dropdown_total_sales(clickData, selected_zips):
     return selected_zips
 
 
+# Styling of the bar chart, resolved once (the chart is built as a plain
+# dictionary, see bar_chart_figure)
+BAR_TEMPLATE = pio.templates['simple_white'].to_plotly_json()
+BAR_COLORS = px.colors.qualitative.Vivid
+# Space between the rows of the bar chart (like px.bar with facet_row)
+BAR_ROW_SPACING = 0.03
+# The zip code titles take up the right edge of the bar chart
+BAR_TITLE_X = 0.98
+
+
+def bar_chart_figure(quarters, zip_codes, values, y_title, quarter):
+    '''Return the bar chart (as a dictionary) of values, with a row per
+    zip code in zip_codes and a column per quarter in quarters
+
+    Every zip code gets a subplot of its own, the first on top, with quarter
+    highlighted, looking like px.bar with facet_row draws it. Building the
+    dictionary directly takes a fraction of the time plotly takes to build
+    and validate the same figure.
+    '''
+    count = len(zip_codes)
+    spacing = min(BAR_ROW_SPACING, 1 / count)
+    height = (1 - spacing * (count - 1)) / count
+    data = []
+    layout = {'template': BAR_TEMPLATE,
+              'height': 600,
+              'barmode': 'relative',
+              'hovermode': 'x',
+              'legend': {'title': {'text': 'Zip Code'}, 'tracegroupgap': 0},
+              'margin': {'l': 0, 'r': 0, 'b': 0, 't': 20, 'pad': 10},
+              'annotations': [],
+              'shapes': []}
+    for i, (zip_code, zip_values) in enumerate(zip(zip_codes, values)):
+        # The subplots are numbered from the bottom
+        row = count - i
+        suffix = "" if row == 1 else str(row)
+        bottom = (row - 1) * (height + spacing)
+        name = str(zip_code)
+        data.append({'type': 'bar',
+                     'x': quarters,
+                     'y': zip_values,
+                     'name': name,
+                     'legendgroup': name,
+                     'offsetgroup': name,
+                     'alignmentgroup': 'True',
+                     'marker': {'color': BAR_COLORS[i % len(BAR_COLORS)]},
+                     'xaxis': f'x{suffix}',
+                     'yaxis': f'y{suffix}'})
+        layout[f'xaxis{suffix}'] = {'anchor': f'y{suffix}', 'domain': [0.0, BAR_TITLE_X]}
+        layout[f'yaxis{suffix}'] = {'anchor': f'x{suffix}', 'domain': [bottom, bottom + height],
+                                    'title': {'text': y_title, 'font': {'size': 10}}}
+        if row > 1:
+            layout[f'xaxis{suffix}'].update(matches='x', showticklabels=False)
+            layout[f'yaxis{suffix}'].update(matches='y')
+        layout['annotations'].append({'text': f'Zip Code={zip_code}',
+                                      'textangle': 90,
+                                      'showarrow': False,
+                                      'x': BAR_TITLE_X, 'xanchor': 'left', 'xref': 'paper',
+                                      'y': bottom + height / 2, 'yanchor': 'middle', 'yref': 'paper'})
+        # A rectangle highlighting the selected quarter
+        layout['shapes'].append({'type': 'rect',
+                                 'x0': quarter, 'x1': quarter, 'xref': f'x{suffix}',
+                                 'y0': 0, 'y1': 1, 'yref': f'y{suffix} domain',
+                                 'fillcolor': 'green', 'opacity': 0.10, 'line': {'width': 45}})
+    layout['xaxis']['title'] = {'text': 'Quarter'}
+    return {'data': data, 'layout': layout}
+
+
 @app.callback(
     Output("total_sales_bar", "figure"),
     Input("rel_abs_radio", "value"),
     Input("zip_dropdown_total_sales", "value"),
     Input("month_slider_total_sales", "value"),
     )
+@figure_cache.memoize()
 def update_bar_chart_with_total_sales(rel_or_abs, selected_zips, date):
-    '''Create and update the line chart showing the development in m2 prices
+    '''Create and update the bar chart showing the number of sales per quarter
     in the selected zip code areas'''
     if len(selected_zips) == 0:
         return {}
-    if rel_or_abs == "rel_num":
-        y_value = "rel_sales"
-    else:
-        y_value = "sales"
-    total_sales_filtered = total_sales_bar[total_sales_bar.zip_code.isin(selected_zips)]
-    # Draw a line for each of the selected zip code areas
-    fig = px.bar(total_sales_filtered, 
-                  x='quarter_name', 
-                  y=y_value,
-                  color=total_sales_filtered.zip_code.apply(str),
-                  template='simple_white',
-                  color_discrete_sequence=px.colors.qualitative.Vivid,
-                  facet_row='zip_code',
-                  height=600,
-                  labels={'zip_code':   'Zip Code',
-                          'color':      'Zip Code',
-                          'quarter_name':    'Quarter',
-                          'sales':  'Number of Sales',
-                          'rel_sales': "Sales per 1000<br>Residences"})
-    # Smaller text on y-axis
-    fig.update_yaxes(title_font=dict(size=10))
-    # Add a rectangle to highlight the selected quarter
-    quarter = "2021-Q4"
-    quarter = quarters[date]      
-    fig.add_vrect(x0=quarter, x1=quarter, col=1,
-              fillcolor="green", opacity=0.10, line_width=45)
-    # Make hover data look nice
-    fig.update_traces(hovertemplate=None)
-    fig.update_layout(hovermode="x")
-    fig.update_layout(margin=dict(l=0, r=0, b=0, t=20, pad=10))
-    return fig
+    data = page_data.get()
+    # The rows of the selected zip codes, in increasing order
+    rows = sorted({data.zip_rows[z] for z in selected_zips if z in data.zip_rows})
+    if not rows:
+        return {}
+    # Draw the bars for each of the selected zip code areas in a row of their
+    # own, with a rectangle to highlight the selected quarter
+    return bar_chart_figure(data.quarters, data.zip_codes[rows], data.sales[rel_or_abs][rows],
+                            Y_TITLES[rel_or_abs], data.quarters[date])
 
 
 @app.callback(
@@ -237,6 +328,7 @@ def update_bar_chart_with_total_sales(rel_or_abs, selected_zips, date):
     Input("total_sales_bar", "clickData")
 )
 def update_slider_on_plot_click(clickData):
+    quarters = page_data.get().quarters
     selected = len(quarters)-1
     if clickData:
         selected = quarters.index(clickData['points'][0]['x'])
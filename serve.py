@@ -0,0 +1,81 @@
+'''Production server for the app
+
+Serves app.server with gunicorn worker processes:
+
+    python serve.py
+
+The datasets of every page are loaded and preprocessed once in the parent
+process before the workers are forked (instead of on first use, see
+utils/startup.py), so the workers share them copy-on-write instead of each
+loading their own copy. The time every step took is logged. Settings, from the environment:
+
+    WEB_BIND      address to listen on (default 127.0.0.1:8050)
+    WEB_WORKERS   number of worker processes (default: number of CPUs)
+    WEB_THREADS   threads per worker process (default 4)
+    WEB_TIMEOUT   seconds before a stuck worker is restarted (default 120)
+
+With SALES_DROP_DIR set, the sales already dropped there are added before
+the workers are forked, and every worker then polls the directory itself.
+
+The metrics on /metrics are counted per worker process.
+'''
+import gc
+import logging
+import multiprocessing
+import os
+
+from gunicorn.app.base import BaseApplication
+
+
+def options(environ=os.environ):
+    return {
+        'bind': environ.get('WEB_BIND', '127.0.0.1:8050'),
+        'workers': int(environ.get('WEB_WORKERS', multiprocessing.cpu_count())),
+        'threads': int(environ.get('WEB_THREADS', 4)),
+        'worker_class': 'gthread',
+        'timeout': int(environ.get('WEB_TIMEOUT', 120)),
+        'preload_app': True,
+        'post_fork': start_drop_directory,
+    }
+
+
+def start_drop_directory(server, worker):
+    '''Poll the drop directory for new sales in every worker'''
+    from utils import ingest
+    drop_directory = ingest.drop_directory()
+    if drop_directory:
+        drop_directory.start()
+
+
+class Server(BaseApplication):
+    '''gunicorn application loading the app in the parent process'''
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import index  # noqa: F401 (registers the pages)
+        from app import server
+        from plotly.io.json import to_json_plotly
+        from utils import ingest, startup
+        startup.warm_up(background=False)
+        # Import the JSON encoder plotly loads on first use (orjson when it is
+        # installed) now, so the threads of a worker do not race to import it
+        to_json_plotly(None)
+        logging.getLogger("gunicorn.error").info("Startup:\n%s", startup.report())
+        drop_directory = ingest.drop_directory()
+        if drop_directory:
+            drop_directory.poll()
+        # Move everything loaded so far out of reach of the garbage collector,
+        # so collections in the workers do not write to (and copy) its pages
+        gc.freeze()
+        return server
+
+
+if __name__ == "__main__":
+    Server(options()).run()
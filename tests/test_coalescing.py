@@ -0,0 +1,63 @@
+import pytest
+from dash.exceptions import PreventUpdate
+
+from utils.coalescing import Coalescer
+
+
+def handle(session, sequence):
+    return {'key': 'k', 'state': {}, 'session': session, 'sequence': sequence}
+
+
+def test_newer_state_handled_first_wins():
+    # The browser sends A (1) then B (2), the server starts B first
+    coalescer = Coalescer("test-out-of-order")
+    coalescer.begin("s", 2)
+    coalescer.begin("s", 1)
+    coalescer.finish("s", 2)
+    with pytest.raises(PreventUpdate):
+        coalescer.finish("s", 1)
+    coalescer.check(handle("s", 2))
+    with pytest.raises(PreventUpdate):
+        coalescer.check(handle("s", 1))
+    assert coalescer.stats()['published'] == 1
+    assert coalescer.stats()['superseded'] == 1
+
+
+def test_states_in_order():
+    coalescer = Coalescer("test-in-order")
+    coalescer.begin("s", 1)
+    coalescer.finish("s", 1)
+    coalescer.check(handle("s", 1))
+    coalescer.begin("s", 2)
+    # The figures of the first state are no longer needed
+    with pytest.raises(PreventUpdate):
+        coalescer.check(handle("s", 1))
+    coalescer.finish("s", 2)
+    coalescer.check(handle("s", 2))
+
+
+def test_sessions_are_independent():
+    coalescer = Coalescer("test-sessions")
+    coalescer.begin("a", 5)
+    coalescer.begin("b", 1)
+    coalescer.finish("b", 1)
+    coalescer.finish("a", 5)
+
+
+def test_without_session_or_sequence_nothing_is_dropped():
+    coalescer = Coalescer("test-bypass")
+    coalescer.begin("s", 3)
+    for session, sequence in [(None, 1), ("s", None), ("s", True)]:
+        coalescer.begin(session, sequence)
+        coalescer.finish(session, sequence)
+        coalescer.check(handle(session, sequence))
+    coalescer.check(None)
+
+
+def test_forgets_least_recently_active_sessions():
+    coalescer = Coalescer("test-max-sessions", max_sessions=2)
+    for session in ["a", "b", "c"]:
+        coalescer.begin(session, 10)
+    assert coalescer.stats()['sessions'] == 2
+    # "a" was forgotten, so an older state of it is not dropped
+    coalescer.finish("a", 1)
@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.filter_engine import FilterEngine, TYPES, viewport_from_relayout
+from utils.sales_data import SALES_CSV, month_labels
+
+STATES = 300
+
+
+def reference_rows(sales, months, price_range, time_range, house_size_range, lot_size_range,
+                   room_range, build_year_range, type_choices, zoom_range):
+    '''The rows the search filters selected before the filter engine, with
+    the chain of DataFrame filters of the original apply_filters'''
+    df = sales
+
+    # Filter on type of house
+    df = df[df['type'].isin(type_choices)]
+
+    # Filter on price
+    if price_range[1] == 10_000_000:
+        df = df[df.price >= price_range[0]]
+    else:
+        df = df[df.price.between(*price_range)]
+
+    # Filter on time of sale
+    min_time = months[int(time_range[0])]
+    max_time = months[int(time_range[1])]
+    df = df[df['datetimes'].between(min_time, max_time)]
+
+    # Filter on house size
+    if house_size_range[1] == 250:
+        df = df[df['size'] >= house_size_range[0]]
+    else:
+        df = df[df['size'].between(*house_size_range)]
+
+    # Filter on lot size
+    if lot_size_range[1] == 10_000:
+        df = df[df.lotSize >= lot_size_range[0]]
+    else:
+        df = df[df.lotSize.between(*lot_size_range)]
+
+    # Filter on number of rooms
+    if room_range[0] == 0 and room_range[1] == 9:
+        df = df
+    elif room_range[1] == 9:
+        df = df[df.rooms >= room_range[0]]
+    else:
+        df = df[df.rooms.between(*room_range)]
+
+    # Filter on year build
+    if build_year_range[0] == 1900 and build_year_range[1] != 2020:
+        df = df[df.buildYear <= build_year_range[1]]
+    elif build_year_range[1] == 2020 and build_year_range[0] != 1900:
+        df = df[df.buildYear >= build_year_range[0]]
+    else:
+        df = df[df.buildYear.between(*build_year_range)]
+
+    if zoom_range and "mapbox._derived" in zoom_range:
+        min_longitude = zoom_range["mapbox._derived"]['coordinates'][0][0]
+        max_longitude = zoom_range["mapbox._derived"]['coordinates'][1][0]
+        min_latitude = zoom_range["mapbox._derived"]['coordinates'][2][1]
+        max_latitude = zoom_range["mapbox._derived"]['coordinates'][0][1]
+        df = df[df.latitude.between(min_latitude, max_latitude)]
+        df = df[df.longitude.between(min_longitude, max_longitude)]
+
+    return df.index.to_numpy()
+
+
+@pytest.fixture(scope="module")
+def sales():
+    sales = pd.read_csv(SALES_CSV)
+    sales["datetimes"] = pd.to_datetime(sales.salesDate)
+    return sales
+
+
+@pytest.fixture(scope="module")
+def months(sales):
+    return month_labels(sales.datetimes.to_numpy().astype('datetime64[M]').astype(np.int64))
+
+
+@pytest.fixture(scope="module")
+def engine(sales, months):
+    return FilterEngine(sales, months)
+
+
+def slider_range(rng, low, high, step):
+    '''Return a random [low, high] range of a range slider'''
+    values = list(range(low, high, step)) + [high]
+    return sorted(int(value) for value in rng.choice(values, 2))
+
+
+def random_state(rng, months, sales, with_viewport):
+    '''Return random arguments of the filter callback, as the sliders send them'''
+    types = [name for name in TYPES if rng.random() < 0.7]
+    relayout = None
+    if with_viewport:
+        longitudes = sorted(rng.uniform(sales.longitude.min(), sales.longitude.max(), 2))
+        latitudes = sorted(rng.uniform(sales.latitude.min(), sales.latitude.max(), 2))
+        relayout = {"mapbox._derived": {"coordinates": [[longitudes[0], latitudes[1]],
+                                                        [longitudes[1], latitudes[1]],
+                                                        [longitudes[1], latitudes[0]],
+                                                        [longitudes[0], latitudes[0]]]}}
+    return (slider_range(rng, 0, 10_000_000, 500_000),
+            slider_range(rng, 0, len(months) - 1, 1),
+            slider_range(rng, 0, 250, 10),
+            slider_range(rng, 0, 10_000, 500),
+            slider_range(rng, 0, 9, 1),
+            slider_range(rng, 1900, 2021, 10),
+            types,
+            relayout)
+
+
+@pytest.mark.parametrize("with_viewport", [False, True])
+def test_engine_matches_dataframe_filters(sales, months, engine, with_viewport):
+    rng = np.random.default_rng(1)
+    for _ in range(STATES):
+        *filter_state, relayout = random_state(rng, months, sales, with_viewport)
+        expected = reference_rows(sales, months, *filter_state, relayout)
+        rows = engine.query(*filter_state, viewport=viewport_from_relayout(relayout))
+        assert np.array_equal(np.sort(rows), np.sort(expected)), filter_state
+
+
+def test_unfiltered_state_selects_whole_range(sales, months, engine):
+    filter_state = ([0, 10_000_000], [0, len(months) - 1], [0, 250], [0, 10_000], [0, 9],
+                    [1900, 2021], list(TYPES))
+    expected = reference_rows(sales, months, *filter_state, None)
+    assert np.array_equal(np.sort(engine.query(*filter_state)), np.sort(expected))
@@ -0,0 +1,43 @@
+import numpy as np
+
+from utils.geometry import simplify
+
+
+def feature(feature_id, *rings):
+    return {'type': 'Feature', 'id': feature_id, 'properties': {},
+            'geometry': {'type': 'Polygon', 'coordinates': [[list(v) for v in ring] for ring in rings]}}
+
+
+def rings(geojson):
+    return {f['id']: [[tuple(v) for v in ring] for ring in f['geometry']['coordinates']]
+            for f in geojson['features']}
+
+
+def closed(vertices):
+    return list(vertices) + [vertices[0]]
+
+
+def test_hole_and_island_are_simplified_the_same_way():
+    angles = np.linspace(0, 2 * np.pi, 60, endpoint=False)
+    circle = [(round(float(np.cos(a)), 4), round(float(np.sin(a) + 0.001 * np.sin(7 * a)), 4)) for a in angles]
+    square = closed([(-2, -2), (2, -2), (2, 2), (-2, 2)])
+    # The island runs the other way round and starts at another vertex
+    island = circle[::-1][17:] + circle[::-1][:17]
+    result = rings(simplify({'type': 'FeatureCollection',
+                             'features': [feature(1, square, closed(circle)), feature(2, closed(island))]},
+                            tolerance=0.01))
+    assert set(result[1][1]) == set(result[2][0])
+    assert len(result[2][0]) < len(circle)
+
+
+def test_collapsing_ring_keeps_the_arcs_shared_with_its_neighbours():
+    upper = [(0, 0), (1, 0.0001), (2, 0)]
+    lower = [(2, 0), (1, -0.0001), (0, 0)]
+    sliver = closed(upper + lower[1:-1])
+    above = closed(upper[::-1] + [(0, 1), (2, 1)])
+    below = closed(lower[::-1] + [(2, -1), (0, -1)])
+    result = rings(simplify({'type': 'FeatureCollection',
+                             'features': [feature(1, sliver), feature(2, above), feature(3, below)]}))
+    assert set(result[1][0]) == set(sliver)
+    assert (1, 0.0001) in result[2][0]
+    assert (1, -0.0001) in result[3][0]
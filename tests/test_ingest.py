@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.clustering import ClusterLevels
+from utils.filter_engine import TYPES, FilterEngine
+from utils.sales_data import (SALES_CSV, append_cached, encode_columns, month_labels, read_sales_csv,
+                              read_table_cache, write_cache)
+from utils.spatial_index import GridIndex
+
+
+@pytest.fixture(scope="module")
+def csv_sales():
+    return read_sales_csv(SALES_CSV)
+
+
+def new_sales(csv_sales, count=150, seed=0):
+    '''Return sales like those in the CSV, sold in December 2021 and with
+    addresses not seen before'''
+    rng = np.random.default_rng(seed)
+    sales = csv_sales.iloc[rng.choice(len(csv_sales), count)].copy().reset_index(drop=True)
+    sales['datetimes'] = pd.Timestamp('2021-12-01 10:00:00') + pd.to_timedelta(np.arange(count), unit='h')
+    sales['salesDate'] = sales.datetimes.dt.strftime('%Y-%m-%d %H:%M:%S')
+    sales['month'] = sales.datetimes.to_numpy().astype('datetime64[M]').astype(np.int32)
+    sales['address'] = [f"Ny vej {i}, 5000 Odense C" for i in range(count)]
+    sales['latitude'] += rng.normal(0, 0.001, count)
+    return sales
+
+
+@pytest.fixture(scope="module")
+def tables(csv_sales, tmp_path_factory):
+    '''The sales table mapped from a cache, and the same with new sales
+    appended twice'''
+    cache_dir = tmp_path_factory.mktemp("cache")
+    write_cache(*encode_columns(csv_sales), str(cache_dir / "sales"), {'sha1': 'csv'})
+    table = read_table_cache(str(cache_dir / "sales"), {'sha1': 'csv'})
+    batches = [new_sales(csv_sales, seed=1), new_sales(csv_sales, seed=2)]
+    appended = [table]
+    for i, batch in enumerate(batches):
+        appended.append(append_cached(appended[-1], batch, f"batch{i}", str(cache_dir / "ingested")))
+    return appended, pd.concat([csv_sales] + batches, ignore_index=True)
+
+
+def test_appended_table_is_memory_mapped(tables):
+    appended, frame = tables
+    table = appended[-1]
+    assert isinstance(table._arrays['price'], np.memmap)
+    assert len(table) == len(frame)
+    rows = np.r_[0, len(frame) - 200:len(frame)]
+    for name in ['address', 'salesDate', 'type', 'price', 'latitude']:
+        assert list(table.values(name, rows)) == list(frame[name].to_numpy()[rows])
+
+
+def test_updated_engine_matches_new_engine(tables):
+    appended, _ = tables
+    before, after = appended[0], appended[-1]
+    updated = FilterEngine(before, month_labels(before.month))
+    for table in appended[1:]:
+        updated = updated.updated(table, month_labels(table.month))
+    fresh = FilterEngine(after, month_labels(after.month))
+    assert np.array_equal(updated.month_codes, fresh.month_codes)
+    assert np.array_equal(updated.type_codes, fresh.type_codes)
+    rng = np.random.default_rng(0)
+    months = len(fresh.months)
+    for _ in range(200):
+        state = ([0, 10_000_000], sorted(rng.integers(0, months, 2).tolist()), [0, 250], [0, 10_000],
+                 [0, 9], [1900, 2021], [name for name in TYPES if rng.random() < 0.7])
+        longitudes = sorted(rng.uniform(9.7, 10.9, 2))
+        latitudes = sorted(rng.uniform(54.8, 55.6, 2))
+        viewport = (*longitudes, *latitudes)
+        assert np.array_equal(updated.query(*state), fresh.query(*state))
+        assert np.array_equal(updated.query(*state, viewport=viewport), fresh.query(*state, viewport=viewport))
+
+
+def test_updated_grid_answers_like_new_grid(csv_sales):
+    latitude = csv_sales.latitude.to_numpy()
+    longitude = csv_sales.longitude.to_numpy()
+    # Points inside, outside and without coordinates added
+    added_latitude = np.r_[latitude, 55.3, 56.5, 53.0, np.nan]
+    added_longitude = np.r_[longitude, 10.4, 12.5, 8.0, 10.0]
+    updated = GridIndex(latitude, longitude).updated(added_latitude, added_longitude)
+    fresh = GridIndex(added_latitude, added_longitude)
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        min_lon, max_lon = sorted(rng.uniform(7.5, 13, 2))
+        min_lat, max_lat = sorted(rng.uniform(52.5, 57, 2))
+        assert np.array_equal(updated.query(min_lon, max_lon, min_lat, max_lat),
+                              fresh.query(min_lon, max_lon, min_lat, max_lat))
+
+
+def test_updated_clusters_keep_points_sorted_by_cell_and_value(csv_sales):
+    latitude = csv_sales.latitude.to_numpy()
+    longitude = csv_sales.longitude.to_numpy()
+    values = csv_sales.price.to_numpy().astype(np.float64)
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(latitude), 300)
+    added = (np.r_[latitude, latitude[rows] + rng.normal(0, 0.001, 300)],
+             np.r_[longitude, longitude[rows] + rng.normal(0, 0.001, 300)],
+             np.r_[values, values[rows]])
+    clusters = ClusterLevels(latitude, longitude, values)
+    updated = clusters.updated(*added)
+    for level, cell_size in enumerate(clusters.cell_sizes):
+        # Points sorted as if all had been clustered on the same grid
+        cells = (np.floor((added[0] - clusters.min_lat) / (cell_size * clusters.aspect)) * clusters.n_lons[level]
+                 + np.floor((added[1] - clusters.min_lon) / cell_size))
+        order = np.lexsort((added[2], cells))
+        assert np.array_equal(updated.orders[level], order)
+        assert np.array_equal(updated.cells[level], cells[order])
+    # Points outside the grids cluster them all again
+    outside = clusters.updated(np.r_[latitude, 57.0], np.r_[longitude, 13.0], np.r_[values, 1.0])
+    assert outside.size == len(latitude) + 1
+    assert outside.n_lons[0] > clusters.n_lons[0]
@@ -0,0 +1,25 @@
+import numpy as np
+
+from utils.filter_engine import TYPES
+from utils.sales_data import load_sales
+from utils.zip_aggregation import BUILD_YEAR_STEP, SIZE_STEP, ZipMonthAggregator
+
+
+def aggregator():
+    sales = load_sales()
+    return ZipMonthAggregator(sales, np.unique(sales.zipCode.to_numpy()), np.unique(sales.month.to_numpy()))
+
+
+def test_slider_ends_are_reachable_steps():
+    data = aggregator()
+    for (low, high), step in [(data.size_range, SIZE_STEP), (data.build_year_range, BUILD_YEAR_STEP)]:
+        assert (high - low) % step == 0
+    assert data.build_year_range[1] >= np.nanmax(data.build_years)
+
+
+def test_slider_ends_mean_no_limit():
+    data = aggregator()
+    assert data.mask(TYPES, data.size_range, data.build_year_range) is None
+    newest = data.build_year_range[1] - BUILD_YEAR_STEP
+    mask = data.mask(TYPES, data.size_range, [data.build_year_range[0], newest])
+    assert not (data.build_years[mask] > newest).any()
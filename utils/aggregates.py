@@ -0,0 +1,185 @@
+import functools
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils.sales_data import (CACHE_DIR, SALES_CSV, encode_columns, file_hash, load_sales,
+                              month_labels, read_table_cache, write_cache)
+
+#
+#   Datasets of the m2 price and total sales pages
+#
+#   The two choropleth pages show aggregates of the sales, derived here from
+#   data/sales.csv, the number of residences per zip code (data/residences.csv)
+#   and the zip code areas in the geojson:
+#
+#   - m2prices_for_choropleth: the average price per m2 in each month, with a
+#     row per zip code area shape and a column per month,
+#   - m2prices_for_line_chart: the same with a row per month and a column per
+#     zip code, plus the average of all of Fyn ("fyn"),
+#   - total_sales_by_quarter_for_bar: the number of sales per zip code and
+#     quarter, absolute and per 1000 residences,
+#   - total_sales_by_quarter: the same with a row per zip code area shape.
+#
+#   Each granularity (month and quarter) is a single groupby over the sales.
+#   The datasets are cached in data/cache/aggregates, keyed by the hashes of
+#   the input files, and only rebuilt when one of them changes. Sales added
+#   while the app runs (see utils/ingest.py) make a new sales table, whose
+#   datasets are built in memory: they change with every file added, and
+#   building them takes less time than writing and reading the cache.
+#
+#   python -m utils.aggregates rebuilds the datasets and reports the time
+#   taken (and writes them as CSV files with --csv DIRECTORY).
+#
+
+RESIDENCES_CSV = "data/residences.csv"
+ZIP_CODE_AREAS = "data/zip_code_areas_fyn_with_id.geojson"
+AGGREGATES_CACHE = os.path.join(CACHE_DIR, "aggregates")
+
+# Bump when the datasets change, so old caches are rebuilt
+AGGREGATES_VERSION = 1
+
+DATASETS = ['m2prices_for_choropleth', 'm2prices_for_line_chart',
+            'total_sales_by_quarter', 'total_sales_by_quarter_for_bar']
+
+
+def input_hashes(sales_path=SALES_CSV, residences_path=RESIDENCES_CSV, areas_path=ZIP_CODE_AREAS):
+    '''Return the key of the cached datasets: the hashes of the inputs'''
+    return {'version': AGGREGATES_VERSION,
+            'sales': file_hash(sales_path),
+            'residences': file_hash(residences_path),
+            'areas': file_hash(areas_path)}
+
+
+def area_shapes(geojson):
+    '''Return a DataFrame with the id, zip code and name of every shape'''
+    return pd.DataFrame({
+        'id': [feature['id'] for feature in geojson['features']],
+        'zip_code': [int(feature['properties']['POSTNR_TXT']) for feature in geojson['features']],
+        'name': [feature['properties']['POSTBYNAVN'] for feature in geojson['features']],
+    })
+
+
+def quarter_labels(quarters):
+    '''Return the quarters (counted from 1970-Q1) as "YYYY-Qn" labels and as
+    the date of their last day'''
+    quarters = np.asarray(quarters)
+    names = [f"{1970 + q // 4}-Q{q % 4 + 1}" for q in quarters]
+    first_months = (quarters * 3).astype('datetime64[M]')
+    last_days = (first_months + 3).astype('datetime64[D]') - 1
+    return names, [str(day) for day in last_days]
+
+
+def monthly_m2prices(sales, shapes):
+    '''Return the m2 price datasets (choropleth and line chart)'''
+    months = np.asarray(sales.month)
+    labels = month_labels(months)
+    frame = pd.DataFrame({'zip_code': np.asarray(sales.zipCode),
+                          'month': months - months.min(),
+                          'm2price': np.asarray(sales.m2price)})
+    by_zip = frame.groupby(['zip_code', 'month']).m2price.mean().unstack()
+    by_zip = by_zip.reindex(columns=range(len(labels))).round(2)
+    by_zip.columns = labels
+    fyn = frame.groupby('month').m2price.mean().reindex(range(len(labels))).round(2)
+
+    choropleth = shapes.join(by_zip, on='zip_code')
+    choropleth['pretty_name'] = choropleth.zip_code.astype(str) + " " + choropleth.name
+    zip_codes = list(dict.fromkeys(shapes.zip_code))
+    line_chart = by_zip.reindex(zip_codes).T
+    line_chart.columns = [str(zip_code) for zip_code in zip_codes]
+    line_chart.insert(0, 'index', labels)
+    line_chart['fyn'] = fyn.to_numpy()
+    return choropleth, line_chart.reset_index(drop=True)
+
+
+def quarterly_sales(sales, residences, shapes):
+    '''Return the total sales datasets (choropleth and bar chart)'''
+    quarters = np.asarray(sales.month) // 3
+    frame = pd.DataFrame({'zip_code': np.asarray(sales.zipCode), 'quarter': quarters})
+    counts = frame.groupby(['quarter', 'zip_code']).size()
+    all_quarters = np.arange(quarters.min(), quarters.max() + 1)
+    names, last_days = quarter_labels(all_quarters)
+    residences = residences.sort_values('zip_code')
+
+    index = pd.MultiIndex.from_product([all_quarters, residences.zip_code], names=['quarter', 'zip_code'])
+    bar = counts.reindex(index, fill_value=0).rename('sales').reset_index()
+    bar['quarter_name'] = np.repeat(names, len(residences))
+    bar['quarter'] = np.repeat(last_days, len(residences))
+    bar = bar.merge(residences, on='zip_code', how='left')
+    bar['rel_sales'] = (bar.sales / bar.residences * 1000).round(1)
+    bar = bar[['quarter', 'zip_code', 'sales', 'residences', 'rel_sales', 'quarter_name']]
+
+    choropleth = bar.merge(shapes, on='zip_code', how='left').sort_values(['quarter', 'zip_code', 'id'])
+    choropleth = choropleth[['quarter', 'zip_code', 'sales', 'id', 'name', 'residences',
+                             'rel_sales', 'quarter_name']].reset_index(drop=True)
+    return choropleth, bar
+
+
+def build(sales, residences, geojson):
+    '''Return the datasets (by name) derived from the sales table'''
+    shapes = area_shapes(geojson)
+    m2prices_map, m2prices_line_chart = monthly_m2prices(sales, shapes)
+    total_sales, total_sales_bar = quarterly_sales(sales, residences, shapes)
+    return {'m2prices_for_choropleth': m2prices_map,
+            'm2prices_for_line_chart': m2prices_line_chart,
+            'total_sales_by_quarter': total_sales,
+            'total_sales_by_quarter_for_bar': total_sales_bar}
+
+
+def _build_from_files(sales):
+    with open(ZIP_CODE_AREAS, "r") as f:
+        geojson = json.load(f)
+    return build(sales, pd.read_csv(RESIDENCES_CSV), geojson)
+
+
+# The datasets of the last tables asked for: the pages showing them ask for
+# the same table, and the previous one is still in use while a new one is
+# swapped in
+@functools.lru_cache(maxsize=2)
+def load(sales=None, cache_dir=AGGREGATES_CACHE):
+    '''Return the datasets (by name) of the sales table (the one in
+    data/sales.csv if None), from the cache when the inputs have not changed
+    since they were built. The pages share the same DataFrames, which they
+    must not modify'''
+    source = input_hashes()
+    if sales is not None and (sales.source or {}).get('sha1') != source['sales']:
+        # Sales were added to data/sales.csv
+        return _build_from_files(sales)
+    tables = {name: read_table_cache(os.path.join(cache_dir, name), source) for name in DATASETS}
+    if all(table is not None for table in tables.values()):
+        return {name: table.to_frame() for name, table in tables.items()}
+    datasets = _build_from_files(load_sales() if sales is None else sales)
+    for name, frame in datasets.items():
+        try:
+            write_cache(*encode_columns(frame), os.path.join(cache_dir, name), source)
+        except OSError:
+            # A read-only data directory only costs the speed up
+            pass
+    return datasets
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Build the datasets of the choropleth pages")
+    parser.add_argument('--csv', help="also write the datasets as CSV files to this directory")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with open(ZIP_CODE_AREAS, "r") as f:
+        geojson = json.load(f)
+    datasets = build(load_sales(), pd.read_csv(RESIDENCES_CSV), geojson)
+    print(f"Built in {time.perf_counter() - start:.3f} s")
+    source = input_hashes()
+    for name, frame in datasets.items():
+        write_cache(*encode_columns(frame), os.path.join(AGGREGATES_CACHE, name), source)
+        print(f"{name}: {frame.shape[0]} rows x {frame.shape[1]} columns")
+        if args.csv:
+            os.makedirs(args.csv, exist_ok=True)
+            frame.to_csv(os.path.join(args.csv, name + ".csv"), index=False)
+    start = time.perf_counter()
+    load.__wrapped__()
+    print(f"Loaded from the cache in {time.perf_counter() - start:.3f} s")
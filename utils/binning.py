@@ -0,0 +1,59 @@
+import numpy as np
+
+#
+#   Server-side binning for the overview histograms
+#
+#   The histograms on the search page are computed on the server with fixed
+#   bin edges, so the figures only carry the bar heights. The size of a figure
+#   no longer depends on how many sales match the filters.
+#
+
+
+class UniformBins:
+    '''Equally wide bins: bin i covers [start + i*width, start + (i+1)*width)'''
+
+    def __init__(self, start, width, count):
+        self.start = start
+        self.width = width
+        self.count = count
+
+    @classmethod
+    def covering(cls, values, width, start=0):
+        '''Return bins starting at start and covering every finite value'''
+        values = np.asarray(values, dtype=np.float64)
+        top = np.nanmax(values) if len(values) else start
+        count = int((top - start) // width) + 1
+        return cls(start, width, max(count, 1))
+
+    def extended(self, values):
+        '''Return the bins with bins added at the end to cover every finite
+        value in values too'''
+        values = np.asarray(values, dtype=np.float64)
+        top = np.nanmax(values) if np.isfinite(values).any() else self.start
+        count = int((top - self.start) // self.width) + 1
+        return UniformBins(self.start, self.width, max(count, self.count))
+
+    @property
+    def edges(self):
+        return self.start + self.width * np.arange(self.count + 1)
+
+    @property
+    def centers(self):
+        return self.start + self.width * (np.arange(self.count) + 0.5)
+
+    def counts(self, values):
+        '''Return the number of values in each bin. Values outside the bins
+        are counted in the first or last bin'''
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        index = ((values - self.start) // self.width).astype(np.int64)
+        np.clip(index, 0, self.count - 1, out=index)
+        return np.bincount(index, minlength=self.count)
+
+
+def trim_empty(counts):
+    '''Return the slice of counts between the first and last non-empty bin'''
+    nonzero = np.flatnonzero(counts)
+    if len(nonzero) == 0:
+        return slice(0, 0)
+    return slice(nonzero[0], nonzero[-1] + 1)
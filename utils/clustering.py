@@ -0,0 +1,138 @@
+import copy
+import math
+
+import numpy as np
+
+#
+#   Point clustering for the search map
+#
+#   The sales are assigned to grid cells at a number of levels, each level
+#   using cells half the size of the level above it (so every cell nests in a
+#   cell of the level above). For every level the points are presorted by cell
+#   and by value, which means that clustering a subset of the sales is a single
+#   pass over the presorted order: no sorting and no reclustering when the user
+#   zooms, only a switch to another precomputed level.
+#
+#   Points added later are merged into the presorted orders, as long as they
+#   fall inside the grids (otherwise the levels are computed again).
+#
+
+# A 512 pixel mapbox tile spans 360 degrees of longitude at zoom level 0
+DEGREES_PER_PIXEL_AT_ZOOM_0 = 360 / 512
+
+
+def cell_size_for_zoom(zoom, pixels=60):
+    '''Return the width in degrees of longitude of a cell spanning pixels
+    on a map at the given zoom level'''
+    return pixels * DEGREES_PER_PIXEL_AT_ZOOM_0 / 2 ** zoom
+
+
+class ClusterLevels:
+    '''Precomputed grid clusters of points at a range of cell sizes'''
+
+    def __init__(self, latitude, longitude, values, largest_cell=0.4, levels=7):
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.size = len(self.latitude)
+        self.largest_cell = largest_cell
+        self.min_lat = np.nanmin(self.latitude) if self.size else 0.0
+        self.min_lon = np.nanmin(self.longitude) if self.size else 0.0
+        # Make the cells look square on the map: a degree of longitude is
+        # shorter than a degree of latitude away from equator
+        self.aspect = math.cos(math.radians(np.nanmean(self.latitude))) if self.size else 1.0
+        self.cell_sizes = [largest_cell / 2 ** level for level in range(levels)]
+        self.n_lons = []
+        self.orders = []
+        self.cells = []
+        for cell_size in self.cell_sizes:
+            lat_cells = np.floor((self.latitude - self.min_lat) / (cell_size * self.aspect))
+            lon_cells = np.floor((self.longitude - self.min_lon) / cell_size)
+            n_lon = int(np.nanmax(lon_cells)) + 1 if self.size else 1
+            cells = lat_cells * n_lon + lon_cells
+            # Points by cell, and by value within each cell
+            order = np.lexsort((self.values, cells))
+            self.n_lons.append(n_lon)
+            self.orders.append(order)
+            self.cells.append(cells[order])
+        # Merging added points needs every point in a cell and with a value
+        self.mergeable = bool(self.size and np.isfinite(self.latitude).all()
+                              and np.isfinite(self.longitude).all() and np.isfinite(self.values).all())
+
+    def updated(self, latitude, longitude, values):
+        '''Return the clusters of latitude, longitude and values, the points
+        of these clusters with points added at the end
+
+        The added points are merged into the presorted orders of the levels
+        when they fall inside their grids, and the levels are computed again
+        otherwise.
+        '''
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        start = self.size
+        added = (latitude[start:], longitude[start:], values[start:])
+        def rebuild():
+            return ClusterLevels(latitude, longitude, values, self.largest_cell, len(self.cell_sizes))
+
+        if not (self.mergeable and all(np.isfinite(column).all() for column in added)):
+            return rebuild()
+        # The cells of the added points at every level, which must be inside
+        # the grid for the cells to keep their numbers
+        level_cells = []
+        for cell_size, n_lon in zip(self.cell_sizes, self.n_lons):
+            lat_cells = np.floor((added[0] - self.min_lat) / (cell_size * self.aspect))
+            lon_cells = np.floor((added[1] - self.min_lon) / cell_size)
+            if (lat_cells < 0).any() or (lon_cells < 0).any() or (lon_cells >= n_lon).any():
+                return rebuild()
+            level_cells.append(lat_cells * n_lon + lon_cells)
+        clusters = copy.copy(self)
+        clusters.latitude, clusters.longitude, clusters.values = latitude, longitude, values
+        clusters.size = len(latitude)
+        clusters.orders = []
+        clusters.cells = []
+        key = np.dtype([('cell', np.float64), ('value', np.float64)])
+        rows = start + np.arange(len(added[0]))
+        for order, cells, new_cells in zip(self.orders, self.cells, level_cells):
+            # Sort the added points by cell and value, and insert them after
+            # the points with the same cell and value, like a stable sort
+            new_order = np.lexsort((added[2], new_cells))
+            new_keys = np.empty(len(new_order), dtype=key)
+            new_keys['cell'], new_keys['value'] = new_cells[new_order], added[2][new_order]
+            keys = np.empty(len(order), dtype=key)
+            keys['cell'], keys['value'] = cells, self.values[order]
+            positions = np.searchsorted(keys, new_keys, side='right')
+            clusters.orders.append(np.insert(order, positions, rows[new_order]))
+            clusters.cells.append(np.insert(cells, positions, new_keys['cell']))
+        return clusters
+
+    def level_for(self, cell_size):
+        '''Return the level whose cells are closest in size to cell_size'''
+        ratios = [abs(math.log(size / cell_size)) for size in self.cell_sizes]
+        return int(np.argmin(ratios))
+
+    def clusters(self, level, rows):
+        '''Return the clusters of the points at positions rows
+
+        The result holds the mean latitude and longitude, the number of
+        points and the median value of every non-empty cell at the level.
+        '''
+        selected = np.zeros(self.size, dtype=bool)
+        selected[rows] = True
+        keep = selected[self.orders[level]]
+        order = self.orders[level][keep]
+        cells = self.cells[level][keep]
+        if len(order) == 0:
+            empty = np.empty(0)
+            return {'latitude': empty, 'longitude': empty,
+                    'count': np.empty(0, dtype=np.int64), 'median': empty}
+        starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        counts = np.diff(np.r_[starts, len(order)])
+        values = self.values[order]
+        median = (values[starts + (counts - 1) // 2] + values[starts + counts // 2]) / 2
+        return {
+            'latitude': np.add.reduceat(self.latitude[order], starts) / counts,
+            'longitude': np.add.reduceat(self.longitude[order], starts) / counts,
+            'count': counts,
+            'median': median,
+        }
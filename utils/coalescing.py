@@ -0,0 +1,117 @@
+import threading
+from collections import OrderedDict
+
+from dash.exceptions import PreventUpdate
+
+#
+#   Latest-wins coalescing of filter requests
+#
+#   Dragging a slider (or panning the map) on the search page sends a filter
+#   request for every intermediate value, each followed by the requests of
+#   the figures depending on the filter result. Only the last filter state is
+#   ever seen by the user, so the work for the others is dropped:
+#
+#   - every page view gets its own session id (in a dcc.Store),
+#   - the browser numbers every filter state it sends with an increasing
+#     sequence number (a clientside callback, see assets/clientside.js), so
+#     the order is the one the user chose the filters in, whatever order the
+#     server happens to handle the requests in,
+#   - the filter callback records the number with begin() and, once the rows
+#     are computed, publishes it with finish(). If a newer filter state of
+#     the session has been seen in the meantime the result is dropped
+#     (PreventUpdate), so none of the figures depending on it are requested
+#     at all,
+#   - the callbacks depending on the filter result call check() with the
+#     handle they got, which raises PreventUpdate when a newer filter state
+#     of the session has been seen since.
+#
+#   The newest filter state is only known within one process: with several
+#   worker processes, requests of the same session handled by different
+#   workers are not coalesced.
+#
+
+# Sessions remembered (the least recently active are forgotten)
+MAX_SESSIONS = 10_000
+
+# Every coalescer created, by name
+coalescers = {}
+
+
+class Coalescer:
+    '''Newest sequence number seen from every session, with counters of the
+    work done and dropped
+
+    Requests without a session id (a string) or sequence number (an int) are
+    never dropped.
+    '''
+
+    def __init__(self, name, max_sessions=MAX_SESSIONS):
+        self.name = name
+        self.max_sessions = max_sessions
+        self.started = 0
+        self.published = 0
+        self.superseded = 0
+        self.skipped = 0
+        self._latest = OrderedDict()
+        self._lock = threading.Lock()
+        coalescers[name] = self
+
+    def begin(self, session, sequence):
+        '''Record that the filter state numbered sequence by the browser of
+        session is being worked on'''
+        with self._lock:
+            self.started += 1
+            if isinstance(session, str) and _is_sequence(sequence):
+                if sequence > self._latest.get(session, sequence - 1):
+                    self._latest[session] = sequence
+                self._latest.move_to_end(session)
+                while len(self._latest) > self.max_sessions:
+                    self._latest.popitem(last=False)
+
+    def is_latest(self, session, sequence):
+        '''Return False if a newer filter state than sequence has been seen
+        from session'''
+        if not isinstance(session, str) or not _is_sequence(sequence):
+            return True
+        with self._lock:
+            return self._latest.get(session, sequence) <= sequence
+
+    def finish(self, session, sequence):
+        '''Count the filter state numbered sequence as published, or raise
+        PreventUpdate if a newer filter state of session has been seen'''
+        latest = self.is_latest(session, sequence)
+        with self._lock:
+            if latest:
+                self.published += 1
+            else:
+                self.superseded += 1
+        if not latest:
+            raise PreventUpdate
+
+    def check(self, handle):
+        '''Raise PreventUpdate if a newer filter state has been seen from the
+        session of the handle returned by the filter callback'''
+        if not isinstance(handle, dict):
+            return
+        if self.is_latest(handle.get('session'), handle.get('sequence')):
+            return
+        with self._lock:
+            self.skipped += 1
+        raise PreventUpdate
+
+    def stats(self):
+        with self._lock:
+            return {'started': self.started,
+                    'published': self.published,
+                    'superseded': self.superseded,
+                    'skipped': self.skipped,
+                    'sessions': len(self._latest)}
+
+
+def _is_sequence(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def stats():
+    '''Return the counters of every coalescer'''
+    return {name: coalescer.stats() for name, coalescer in coalescers.items()}
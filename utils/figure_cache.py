@@ -0,0 +1,99 @@
+import functools
+import threading
+from collections import OrderedDict
+
+#
+#   Figure cache
+#
+#   The choropleth and chart callbacks only take a handful of discrete inputs
+#   (a slider position, a radio value and a list of zip codes), so the figures
+#   they return are cached in bounded LRU caches keyed by the inputs. Every
+#   cache counts its hits and misses. The pages clear their caches when they
+#   swap in new data; a figure still being built from the old data is then
+#   not stored.
+#
+
+# Every cache created, by name
+caches = {}
+
+
+def freeze(value):
+    '''Return a hashable version of a JSON like callback input'''
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(item)) for key, item in value.items()))
+    return value
+
+
+class FigureCache:
+    '''Bounded LRU cache of figures with hit and miss counters'''
+
+    def __init__(self, name, max_entries=64):
+        self.name = name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Counts the clears, so figures built before one are not stored
+        self._generation = 0
+        caches[name] = self
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, build):
+        '''Return the figure cached for key, building it with build() on a miss'''
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+            generation = self._generation
+        figure = build()
+        with self._lock:
+            if generation != self._generation:
+                return figure
+            self._entries[key] = figure
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return figure
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+
+def memoize(max_entries=64, key=freeze):
+    '''Decorator caching the figures returned by a function
+
+    The cache is keyed by key(args), which by default turns the (JSON like)
+    arguments into tuples. The returned figures are shared between calls, so
+    they must not be changed by the caller.
+    '''
+    def decorator(func):
+        cache = FigureCache(func.__name__, max_entries)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            return cache.get(key(args), lambda: func(*args))
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+def stats():
+    '''Return the statistics of every figure cache'''
+    return {name: cache.stats() for name, cache in caches.items()}
@@ -0,0 +1,168 @@
+import functools
+import json
+import threading
+
+import numpy as np
+from plotly.utils import PlotlyJSONEncoder
+
+#
+#   Compact figure encoding
+#
+#   Dash sends figures as JSON, where every float64 is written out with up to
+#   17 digits: a marker latitude takes 18 bytes and a price of 1,250,000 kr.
+#   (stored as a float) takes 9. compact(figure) returns a copy of the figure
+#   with the numeric arrays of its traces shortened before they are encoded:
+#
+#   - coordinates (lat and lon) are rounded to COORDINATE_DECIMALS decimals,
+#   - other floats (prices, m2 prices, sizes) to VALUE_DECIMALS decimals,
+#   - arrays holding only whole numbers are sent as integers,
+#   - numeric columns of customdata are shortened the same way.
+#
+#   The plotly.js bundled with Dash 2.0 (2.4) cannot read binary (base64
+#   typed array) data, so the figures stay plain JSON arrays.
+#
+#   The @encoded decorator compacts the figures a callback returns and counts
+#   the bytes the compacting saved, per callback (served with the metrics).
+#   Measuring the savings means encoding the arrays both ways, which costs
+#   more than the compacting itself, so only every MEASURE_EVERY-th figure
+#   of a callback is measured.
+#
+
+# 5 decimals of a degree is about 1 meter
+COORDINATE_DECIMALS = 5
+VALUE_DECIMALS = 2
+
+COORDINATE_KEYS = ('lat', 'lon')
+
+# Trace attributes never holding data arrays worth compacting (the geojson
+# of the choropleths is rounded by utils/geometry.py already)
+SKIPPED_KEYS = ('geojson', 'hovertemplate', 'text', 'name', 'type')
+
+MEASURE_EVERY = 10
+
+# The largest integer a float64 (and a JavaScript number) holds exactly
+MAX_EXACT_INTEGER = 2 ** 53
+
+# Savings of every encoded callback, by name
+savings = {}
+_lock = threading.Lock()
+
+
+def _encoded_size(values):
+    return len(json.dumps(values, cls=PlotlyJSONEncoder))
+
+
+def compact_numbers(values, decimals):
+    '''Return the float array values rounded to decimals, as integers if they
+    are all whole numbers'''
+    rounded = np.round(values, decimals)
+    finite = np.isfinite(rounded)
+    if finite.all() and np.all(rounded == np.trunc(rounded)) and np.all(np.abs(rounded) < MAX_EXACT_INTEGER):
+        return rounded.astype(np.int64)
+    return rounded
+
+
+def _numeric_column(column):
+    '''Return the object array column as floats, or None if it holds anything
+    but numbers'''
+    if not all(isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, bool)
+               for value in column):
+        return None
+    return column.astype(np.float64)
+
+
+def compact_array(values, decimals):
+    '''Return the array values shortened, or values itself if it cannot be'''
+    if values.dtype.kind == 'f':
+        return compact_numbers(values, decimals)
+    if values.dtype.kind == 'O' and values.ndim == 2 and len(values):
+        compacted = values.copy()
+        changed = False
+        for column in range(values.shape[1]):
+            numbers = _numeric_column(values[:, column])
+            if numbers is not None:
+                compacted[:, column] = compact_numbers(numbers, decimals).astype(object)
+                changed = True
+        return compacted if changed else values
+    return values
+
+
+def _compact_value(key, value, sizes):
+    if isinstance(value, dict):
+        return _compact_dict(value, sizes)
+    array = value
+    if isinstance(value, (list, tuple)) and value and isinstance(value[0], float):
+        array = np.asarray(value)
+    if not isinstance(array, np.ndarray):
+        return value
+    decimals = COORDINATE_DECIMALS if key in COORDINATE_KEYS else VALUE_DECIMALS
+    compacted = compact_array(array, decimals)
+    if compacted is array:
+        return value
+    if sizes is not None:
+        sizes[0] += _encoded_size(value)
+        sizes[1] += _encoded_size(compacted)
+    return compacted
+
+
+def _compact_dict(trace, sizes):
+    return {key: value if key in SKIPPED_KEYS else _compact_value(key, value, sizes)
+            for key, value in trace.items()}
+
+
+def compact(figure, sizes=None):
+    '''Return figure (as a dictionary) with the numeric arrays of its traces
+    shortened. figure is not changed, so it can be a cached figure.
+
+    With sizes (a list of two numbers) the encoded sizes of the arrays before
+    and after are added to it.
+    '''
+    figure = figure if isinstance(figure, dict) else figure.to_plotly_json()
+    return dict(figure, data=[_compact_dict(trace, sizes) for trace in figure['data']])
+
+
+class Savings:
+    '''Bytes saved in the figures of one callback'''
+
+    def __init__(self):
+        self.figures = 0
+        # Encoded sizes of the compacted arrays in the measured figures
+        self.measured = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    def stats(self):
+        saved = self.bytes_before - self.bytes_after
+        return {'figures': self.figures,
+                'measured': self.measured,
+                'bytes_before': self.bytes_before,
+                'bytes_after': self.bytes_after,
+                'bytes_saved_per_figure': saved / self.measured if self.measured else 0.0}
+
+
+def encoded(func):
+    '''Decorator compacting the figure returned by a callback'''
+    name = func.__name__
+    with _lock:
+        record = savings.setdefault(name, Savings())
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        with _lock:
+            measure = record.figures % MEASURE_EVERY == 0
+            record.figures += 1
+        sizes = [0, 0] if measure else None
+        figure = compact(func(*args), sizes)
+        if measure:
+            with _lock:
+                record.measured += 1
+                record.bytes_before += sizes[0]
+                record.bytes_after += sizes[1]
+        return figure
+    return wrapper
+
+
+def stats():
+    '''Return the bytes saved in the figures of every encoded callback'''
+    with _lock:
+        return {name: record.stats() for name, record in savings.items()}
@@ -0,0 +1,243 @@
+import copy
+
+import numpy as np
+
+from utils.spatial_index import GridIndex
+
+#
+#   Filter engine for the search page
+#
+#   The engine is built once when the sales data is loaded. Every column that
+#   can be filtered on is kept as a contiguous numpy array (type and month as
+#   small integer codes), so a complete filter state is answered with one
+#   combined boolean mask instead of a chain of DataFrame copies. The map
+#   viewport is answered by a spatial grid index first, so the attribute
+#   filters only have to look at the sales inside the visible part of the map.
+#   When sales are added, the codes, ranges and grid of the new rows are
+#   merged into those of the old ones (see FilterEngine.updated).
+#
+
+TYPES = ["House", "Apartment", "Cottage"]
+
+# Slider values meaning "no upper limit" in the search filters
+MAX_PRICE = 10_000_000
+MAX_SIZE = 250
+MAX_LOT_SIZE = 10_000
+MAX_ROOMS = 9
+MIN_BUILD_YEAR = 1900
+MAX_BUILD_YEAR = 2020
+
+# The map viewport is widened to the edges of a grid of tiles this large (in
+# degrees, about 1 km) before filtering, so panning the map a little gives
+# the same filter state
+VIEWPORT_TILE_SIZE = 0.01
+
+RANGES = ['price_range', 'time_range', 'house_size_range', 'lot_size_range',
+          'room_range', 'build_year_range']
+
+
+def viewport_from_relayout(relayout_data):
+    '''Return the (min_lon, max_lon, min_lat, max_lat) of the visible map, or
+    None if the relayout data does not describe the map viewport'''
+    if not relayout_data or "mapbox._derived" not in relayout_data:
+        return None
+    coordinates = relayout_data["mapbox._derived"]['coordinates']
+    min_longitude = coordinates[0][0]
+    max_longitude = coordinates[1][0]
+    min_latitude = coordinates[2][1]
+    max_latitude = coordinates[0][1]
+    return min_longitude, max_longitude, min_latitude, max_latitude
+
+
+def tile_viewport(viewport, tile_size=VIEWPORT_TILE_SIZE):
+    '''Return the viewport (min_lon, max_lon, min_lat, max_lat) widened to
+    the edges of the tiles it overlaps'''
+    min_lon, max_lon, min_lat, max_lat = (float(value) for value in viewport)
+    tiles = [np.floor(min_lon / tile_size), np.ceil(max_lon / tile_size),
+             np.floor(min_lat / tile_size), np.ceil(max_lat / tile_size)]
+    # Rounded to get rid of the float noise of the multiplication
+    return [round(tile * tile_size, 6) for tile in tiles]
+
+
+def canonical_state(state):
+    '''Return the canonical form of a filter state: ranges as pairs of
+    numbers, the known types sorted and the viewport widened to tiles'''
+    canonical = {}
+    for name in RANGES:
+        low, high = state[name]
+        canonical[name] = [_number(low), _number(high)]
+    canonical['type_choices'] = sorted(set(state['type_choices'] or []) & set(TYPES))
+    viewport = state.get('viewport')
+    canonical['viewport'] = tile_viewport(viewport) if viewport else None
+    return canonical
+
+
+def _number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def encode_types(types):
+    '''Return the integer code of every type of house (index into TYPES,
+    -1 if unknown)'''
+    type_codes = np.full(len(types), -1, dtype=np.int8)
+    for code, name in enumerate(TYPES):
+        type_codes[types == name] = code
+    return type_codes
+
+
+def allowed_types(type_choices):
+    '''Return a boolean array telling which type codes (see encode_types,
+    with -1 as the last entry) type_choices allows'''
+    allowed = np.zeros(len(TYPES) + 1, dtype=bool)
+    for name in type_choices or []:
+        if name in TYPES:
+            allowed[TYPES.index(name)] = True
+    return allowed
+
+
+def _extent(column):
+    '''Return the smallest and largest value of column and whether it has
+    missing values'''
+    if len(column) == 0:
+        return (np.inf, -np.inf, False)
+    has_nan = bool(np.isnan(column).any()) if column.dtype.kind == 'f' else False
+    if has_nan and np.isnan(column).all():
+        return (np.inf, -np.inf, True)
+    return (np.nanmin(column), np.nanmax(column), has_nan)
+
+
+def _merge_extents(extent, other):
+    return (min(extent[0], other[0]), max(extent[1], other[1]), extent[2] or other[2])
+
+
+class FilterEngine:
+    '''Columnar index over the sales table answering the search filters'''
+
+    def __init__(self, sales, months):
+        self._set_columns(sales, months)
+        # Integer code of the month of sale (0 is the first month in months)
+        self.month_codes = self._month_codes(self.times)
+        # Integer code of the type of house (index into TYPES, -1 if unknown)
+        self.type_codes = encode_types(sales['type'].to_numpy())
+        # Range of each column, used to skip filters that select everything
+        self._extent = {name: _extent(column) for name, column in self.columns.items()}
+        # Grid over the coordinates answering the map viewport
+        self.spatial = GridIndex(self.columns['latitude'], self.columns['longitude'])
+
+    def _set_columns(self, sales, months):
+        self.size = len(sales)
+        self.months = list(months)
+        self.columns = {
+            'price': sales.price.to_numpy(),
+            'size': sales['size'].to_numpy(),
+            'lotSize': sales.lotSize.to_numpy(),
+            'rooms': sales.rooms.to_numpy(),
+            'buildYear': sales.buildYear.to_numpy(),
+            'latitude': sales.latitude.to_numpy(),
+            'longitude': sales.longitude.to_numpy(),
+        }
+        # The time of sale as nanoseconds, compared against the first instant
+        # of the chosen months
+        self.times = sales.datetimes.to_numpy(dtype='datetime64[ns]').view('i8')
+        self.month_starts = np.array(self.months, dtype='datetime64[M]').astype('datetime64[ns]').view('i8')
+
+    def _month_codes(self, times):
+        first_month = np.datetime64(self.months[0], 'M')
+        return (times.view('datetime64[ns]').astype('datetime64[M]') - first_month).astype(np.int16)
+
+    def updated(self, sales, months):
+        '''Return the engine of sales (covering months), the sales of this
+        engine with rows added at the end, deriving only the added rows'''
+        start = self.size
+        engine = copy.copy(self)
+        engine._set_columns(sales, months)
+        added_times = engine.times[start:]
+        if engine.months[0] == self.months[0]:
+            engine.month_codes = np.concatenate([self.month_codes, engine._month_codes(added_times)])
+        else:
+            # Sales from before the first month renumber every month
+            engine.month_codes = engine._month_codes(engine.times)
+        engine.type_codes = np.concatenate([self.type_codes,
+                                            encode_types(sales['type'].iloc[start:].to_numpy())])
+        engine._extent = {name: _merge_extents(self._extent[name], _extent(column[start:]))
+                          for name, column in engine.columns.items()}
+        engine.spatial = self.spatial.updated(engine.columns['latitude'], engine.columns['longitude'])
+        return engine
+
+    def _apply_range(self, mask, rows, name, low=None, high=None):
+        '''Restrict mask to rows with low <= column <= high (inclusive)'''
+        column_min, column_max, has_nan = self._extent[name]
+        if (not has_nan
+                and (low is None or low <= column_min)
+                and (high is None or high >= column_max)):
+            return
+        column = self.columns[name]
+        if rows is not None:
+            column = column[rows]
+        if low is not None:
+            mask &= column >= low
+        if high is not None:
+            mask &= column <= high
+
+    def mask(self, price_range, time_range, house_size_range, lot_size_range,
+             room_range, build_year_range, type_choices, rows=None):
+        '''Return a boolean mask telling which of rows (all sales if None)
+        match the attribute filters'''
+        mask = np.ones(self.size if rows is None else len(rows), dtype=bool)
+        type_codes = self.type_codes if rows is None else self.type_codes[rows]
+        times = self.times if rows is None else self.times[rows]
+
+        # Filter on type of house
+        mask &= allowed_types(type_choices)[type_codes]
+
+        # Filter on price
+        if price_range[1] == MAX_PRICE:
+            self._apply_range(mask, rows, 'price', low=price_range[0])
+        else:
+            self._apply_range(mask, rows, 'price', *price_range)
+
+        # Filter on time of sale
+        min_time = self.month_starts[int(time_range[0])]
+        max_time = self.month_starts[int(time_range[1])]
+        mask &= (times >= min_time) & (times <= max_time)
+
+        # Filter on house size
+        if house_size_range[1] == MAX_SIZE:
+            self._apply_range(mask, rows, 'size', low=house_size_range[0])
+        else:
+            self._apply_range(mask, rows, 'size', *house_size_range)
+
+        # Filter on lot size
+        if lot_size_range[1] == MAX_LOT_SIZE:
+            self._apply_range(mask, rows, 'lotSize', low=lot_size_range[0])
+        else:
+            self._apply_range(mask, rows, 'lotSize', *lot_size_range)
+
+        # Filter on number of rooms
+        if room_range[0] == 0 and room_range[1] == MAX_ROOMS:
+            pass
+        elif room_range[1] == MAX_ROOMS:
+            self._apply_range(mask, rows, 'rooms', low=room_range[0])
+        else:
+            self._apply_range(mask, rows, 'rooms', *room_range)
+
+        # Filter on year build
+        if build_year_range[0] == MIN_BUILD_YEAR and build_year_range[1] != MAX_BUILD_YEAR:
+            self._apply_range(mask, rows, 'buildYear', high=build_year_range[1])
+        elif build_year_range[1] == MAX_BUILD_YEAR and build_year_range[0] != MIN_BUILD_YEAR:
+            self._apply_range(mask, rows, 'buildYear', low=build_year_range[0])
+        else:
+            self._apply_range(mask, rows, 'buildYear', *build_year_range)
+
+        return mask
+
+    def query(self, *filter_state, viewport=None, **kwargs):
+        '''Return the positions of the sales matching the filter state
+
+        viewport is (min_lon, max_lon, min_lat, max_lat) of the visible map.
+        '''
+        if viewport is None:
+            return np.flatnonzero(self.mask(*filter_state, **kwargs))
+        rows = self.spatial.query(*viewport)
+        return rows[self.mask(*filter_state, rows=rows, **kwargs)]
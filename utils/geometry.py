@@ -0,0 +1,314 @@
+import json
+import os
+
+import numpy as np
+import plotly.graph_objects as go
+import plotly.express as px
+
+from utils import startup
+
+#
+#   Zip code area geometry for the choropleth maps
+#
+#   The geojson shipped in data/ has full precision 3D coordinates (with a
+#   constant -999.0 height on every vertex). Every choropleth figure embeds the
+#   geometry, so it is preprocessed once here and shared by both pages:
+#
+#   1. the height is dropped,
+#   2. the rings are simplified with Douglas-Peucker, keeping the topology:
+#      borders shared by neighbouring areas are simplified exactly the same
+#      way for both areas, so no gaps or overlaps appear between them,
+#   3. the coordinates are rounded to a fixed number of decimals.
+#
+
+ZIP_CODE_AREAS = 'data/zip_code_areas_fyn_with_id.geojson'
+SIMPLIFIED_CACHE = 'data/cache/zip_code_areas_fyn_with_id.simplified.json'
+
+# Bump when the simplification changes, so old caches are rebuilt
+SIMPLIFIED_VERSION = 2
+
+# Largest distance (in degrees) a simplified border may deviate from the
+# original border. 0.0005 degrees is about 30-55 meters on Fyn
+TOLERANCE = 0.0005
+
+# Decimals kept in the coordinates. 4 decimals is about 5-10 meters on Fyn
+PRECISION = 4
+
+
+def _polygons(geometry):
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    return geometry['coordinates']
+
+
+def _douglas_peucker(points, tolerance):
+    '''Return a boolean array telling which of points to keep'''
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = points[first]
+        direction = points[last] - start
+        offsets = points[first + 1:last] - start
+        length = np.hypot(*direction)
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return keep
+
+
+def _arc_key(arc):
+    '''Return arc as a tuple, in the direction every ring sharing it agrees on'''
+    arc = tuple(arc)
+    return min(arc, arc[::-1])
+
+
+def _simplify_arc(key, tolerance):
+    '''Simplify an arc given by its key'''
+    points = np.array(key, dtype=np.float64)
+    return [tuple(point) for point in points[_douglas_peucker(points, tolerance)]]
+
+
+def _farthest(vertices, start):
+    '''Return the index of the (lexicographically smallest) vertex farthest
+    away from the vertex at index start'''
+    points = np.array(vertices)
+    distances = np.hypot(*(points - points[start]).T)
+    return min(np.flatnonzero(distances == distances.max()), key=lambda i: vertices[i])
+
+
+def _ring_arcs(ring, memberships):
+    '''Split a closed ring of (lon, lat) tuples into arcs, or return None if
+    it is too small to simplify
+
+    The arcs are runs of vertices shared by the same set of rings, so a border
+    shared by two rings is the same arc in both of them. A ring with fewer
+    than two such junctions is (also) split at a vertex chosen from the
+    vertices alone, so rings with the same vertices, like a hole and the
+    island filling it, are split the same way.
+    '''
+    vertices = ring[:-1]
+    count = len(vertices)
+    if count < 4:
+        return None
+    members = [memberships[vertex] for vertex in vertices]
+    junctions = [i for i in range(count)
+                 if members[i] != members[i - 1] or members[i] != members[(i + 1) % count]]
+    if len(junctions) < 2:
+        start = junctions[0] if junctions else min(range(count), key=lambda i: vertices[i])
+        junctions = sorted({start, _farthest(vertices, start)})
+    arcs = []
+    for i, start in enumerate(junctions):
+        end = junctions[(i + 1) % len(junctions)]
+        if end <= start:
+            end += count
+        arcs.append([vertices[j % count] for j in range(start, end + 1)])
+    return arcs
+
+
+def _join_arcs(arcs, simplified_arcs):
+    '''Return the vertices of the ring made of the simplified arcs'''
+    vertices = []
+    for arc in arcs:
+        key = _arc_key(arc)
+        simplified = simplified_arcs[key]
+        vertices.extend((simplified if tuple(arc) == key else simplified[::-1])[:-1])
+    return vertices
+
+
+def simplify(geojson, tolerance=TOLERANCE, precision=PRECISION):
+    '''Return a 2D, simplified and quantized copy of a geojson
+    FeatureCollection of Polygons and MultiPolygons'''
+    # Round the coordinates first so vertices shared by neighbouring areas are
+    # identical, then find the rings every vertex is part of
+    rings = []
+    for feature in geojson['features']:
+        for polygon in _polygons(feature['geometry']):
+            for ring in polygon:
+                rings.append([(round(c[0], precision), round(c[1], precision)) for c in ring])
+    memberships = {}
+    for ring_id, ring in enumerate(rings):
+        for vertex in ring[:-1]:
+            memberships.setdefault(vertex, set()).add(ring_id)
+    memberships = {vertex: frozenset(ids) for vertex, ids in memberships.items()}
+
+    # Simplify every arc once, for all the rings sharing it
+    ring_arcs = [_ring_arcs(ring, memberships) for ring in rings]
+    simplified_arcs = {}
+    for arcs in filter(None, ring_arcs):
+        for arc in arcs:
+            key = _arc_key(arc)
+            if key not in simplified_arcs:
+                simplified_arcs[key] = _simplify_arc(key, tolerance)
+    # Keep the original arcs of rings that would collapse. This only adds
+    # vertices to the other rings sharing these arcs, so none of them collapses
+    for arcs in filter(None, ring_arcs):
+        if len(_join_arcs(arcs, simplified_arcs)) < 3:
+            for arc in arcs:
+                simplified_arcs[_arc_key(arc)] = list(_arc_key(arc))
+
+    simplified_rings = []
+    for ring, arcs in zip(rings, ring_arcs):
+        if arcs is None:
+            simplified_rings.append(ring)
+        else:
+            vertices = _join_arcs(arcs, simplified_arcs)
+            simplified_rings.append(vertices + [vertices[0]])
+    simplified_rings = iter(simplified_rings)
+    features = []
+    for feature in geojson['features']:
+        geometry = feature['geometry']
+        polygons = [[[list(vertex) for vertex in next(simplified_rings)] for _ in polygon]
+                    for polygon in _polygons(geometry)]
+        coordinates = polygons[0] if geometry['type'] == 'Polygon' else polygons
+        features.append({'type': 'Feature',
+                         'id': feature['id'],
+                         'properties': feature['properties'],
+                         'geometry': {'type': geometry['type'], 'coordinates': coordinates}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def feature_ids_by_zip(geojson):
+    '''Return a dictionary from zip code (as text) to the IDs of its shapes'''
+    ids = {}
+    for feature in geojson['features']:
+        ids.setdefault(feature['properties']['POSTNR_TXT'], []).append(feature['id'])
+    return ids
+
+
+def payload_size(geojson):
+    '''Return the number of bytes the geojson takes up in a figure'''
+    return len(json.dumps(geojson, separators=(',', ':')))
+
+
+def embedded_geometries(figure):
+    '''Return the geojson embedded in each trace of figure'''
+    figure = figure if isinstance(figure, dict) else figure.to_plotly_json()
+    return [trace['geojson'] for trace in figure['data'] if trace.get('geojson') is not None]
+
+
+def load_zip_code_areas(path=ZIP_CODE_AREAS, cache_path=SIMPLIFIED_CACHE):
+    '''Return the simplified geometry of the zip code areas, read from a
+    cache when it was simplified from the same file with the same settings'''
+    stat = os.stat(path)
+    source = {'version': SIMPLIFIED_VERSION, 'mtime': stat.st_mtime, 'size': stat.st_size,
+              'tolerance': TOLERANCE, 'precision': PRECISION}
+    try:
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+        if cached['source'] == source:
+            return cached['geojson']
+    except (OSError, ValueError, KeyError):
+        pass
+    with open(path, "r") as f:
+        geojson = simplify(json.load(f))
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump({'source': source, 'geojson': geojson}, f, separators=(',', ':'))
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return geojson
+
+
+#
+#   Shared geometry
+#
+
+class ZipCodeAreas:
+    '''The geometry used by the choropleth maps on both pages, with the shapes
+    of each zip code area and each shape by its ID'''
+
+    def __init__(self, geojson):
+        self.geojson = geojson
+        self.feature_ids = feature_ids_by_zip(geojson)
+        self.features_by_id = {feature['id']: feature for feature in geojson['features']}
+
+
+# Loaded when the first choropleth is drawn (or on warm up)
+zip_code_areas = startup.Lazy("data: zip code areas", lambda: ZipCodeAreas(load_zip_code_areas()))
+
+
+def translate_zips_to_ids_and_colors(zips):
+    '''Return a list with the IDs corresponding to the zip codes in zips and
+    the color of each zip code'''
+    colors = px.colors.qualitative.Vivid    # 11 colors
+    feature_ids = zip_code_areas.get().feature_ids
+    return [(feature_id, colors[i % len(colors)])
+            for i, zip_code in enumerate(zips)
+            for feature_id in feature_ids.get(str(zip_code), [])]
+
+
+def highlight_trace(zips):
+    '''Return a single choropleth trace outlining the zip code areas in zips,
+    each in its own color, or None if there is nothing to outline
+
+    The trace only embeds the shapes it outlines, not the whole geometry.
+    '''
+    id_color_pairs = translate_zips_to_ids_and_colors(zips)
+    if not id_color_pairs:
+        return None
+    ids = [feature_id for feature_id, _ in id_color_pairs]
+    colors = [color for _, color in id_color_pairs]
+    features_by_id = zip_code_areas.get().features_by_id
+    outlined = {'type': 'FeatureCollection', 'features': [features_by_id[i] for i in ids]}
+    return go.Choropleth(geojson=outlined,
+                         locationmode="geojson-id",
+                         locations=ids,
+                         z=[1] * len(ids),
+                         colorscale=[[0, 'rgba(0,0,0,0)'], [1, 'rgba(0,0,0,0)']],
+                         colorbar=None,
+                         showscale=False,
+                         marker={"line": {"color": colors, "width": 3}},
+                         hoverinfo='skip')
+
+
+def with_highlight(figure, zips):
+    '''Return figure (as a dictionary) with the zip code areas in zips outlined
+
+    figure is not changed, so it can be a cached figure shared between calls.
+    '''
+    figure = figure if isinstance(figure, dict) else figure.to_plotly_json()
+    highlight = highlight_trace(zips)
+    if highlight is None:
+        return figure
+    return dict(figure, data=list(figure['data']) + [highlight.to_plotly_json()])
+
+
+if __name__ == "__main__":
+    # Report the size of the geometry and how much it saves in each choropleth
+    from pages import m2prices, totalsales
+
+    with open(ZIP_CODE_AREAS, "r") as f:
+        original_zip_code_areas = json.load(f)
+    before = payload_size(original_zip_code_areas)
+    after = payload_size(zip_code_areas.get().geojson)
+    print(f"Geometry: {before:,} bytes -> {after:,} bytes ({after / before:.0%})")
+    aggregator = m2prices.page_data.get().aggregator
+    figures = {
+        'update_choropleth_with_m2_prices': m2prices.update_choropleth_with_m2_prices.__wrapped__(
+            [5000, 5900], 28, m2prices.TYPES, aggregator.size_range, aggregator.build_year_range),
+        'update_choropleth_with_total_sales': totalsales.update_choropleth_with_total_sales.__wrapped__('abs_num', [5000, 5900], 9),
+    }
+    original_by_id = {feature['id']: feature for feature in original_zip_code_areas['features']}
+    for name, figure in figures.items():
+        embedded = embedded_geometries(figure)
+        after = sum(payload_size(geojson) for geojson in embedded)
+        # The same shapes at full precision
+        before = sum(payload_size({'type': 'FeatureCollection',
+                                   'features': [original_by_id[f['id']] for f in geojson['features']]})
+                     for geojson in embedded)
+        print(f"{name}: {len(embedded)} embedded geometries, "
+              f"{before:,} bytes -> {after:,} bytes per figure")
@@ -0,0 +1,151 @@
+import logging
+import os
+import threading
+import time
+
+import pandas as pd
+
+from utils import startup
+from utils.sales_data import CACHE_DIR, append_cached, file_hash, load_sales, read_sales_csv
+
+#
+#   Ingesting new sales
+#
+#   New sales are added without restarting the app by dropping CSV files in
+#   the format of data/sales.csv (the unnamed index column may be left out)
+#   in the directory named by SALES_DROP_DIR. A watcher thread polls the
+#   directory and adds the sales of every new file, in the order of the file
+#   names, to the sales table shared by the pages (sales). The table with the
+#   new sales is written to the binary cache and memory-mapped from there like
+#   data/sales.csv, then passed to the functions registered with on_new_sales.
+#   The pages build a new version of the data they derive from the sales and
+#   swap it in whole, so callbacks running at the same time keep the version
+#   they started with.
+#
+#   Write the files under another name (starting with a dot or not ending in
+#   .csv) and rename them when complete, so no half written file is read.
+#
+#   The files are left in the directory: every process serving the app reads
+#   them itself, and a restarted process adds all of them again on top of
+#   data/sales.csv.
+#
+
+POLL_INTERVAL = 5.0
+
+INDEX_COLUMN = "Unnamed: 0"
+
+# The sales table with the new sales added (replaced with every file)
+INGESTED_CACHE = os.path.join(CACHE_DIR, "sales_ingested")
+
+logger = logging.getLogger(__name__)
+
+# Functions called with the sales table after sales were added to it
+listeners = []
+
+# The sales in data/sales.csv and every file added since the start, loaded
+# when first used (see utils/startup.py)
+sales = startup.Lazy("data: sales", load_sales)
+_sales_lock = threading.Lock()
+
+
+def on_new_sales(func):
+    '''Decorator registering func to be called with the sales table every
+    time sales are added to it'''
+    listeners.append(func)
+    return func
+
+
+def add_sales(new_sales, new_sales_hash):
+    '''Add new_sales (a DataFrame like the sales CSV, whose content has the
+    hash new_sales_hash) to the sales table and pass it to the listeners'''
+    with _sales_lock:
+        table = append_cached(sales.get(), new_sales, new_sales_hash, INGESTED_CACHE)
+        # Swapped in before the listeners run, so data built from now on
+        # includes the new sales
+        sales.set(table)
+        for listener in listeners:
+            try:
+                listener(table)
+            except Exception:
+                logger.exception("Could not add new sales (%s)", listener.__qualname__)
+
+
+def read_new_sales(path):
+    '''Read a file of new sales, like data/sales.csv'''
+    new_sales = read_sales_csv(path)
+    if INDEX_COLUMN not in new_sales.columns:
+        new_sales.insert(0, INDEX_COLUMN, range(len(new_sales)))
+    return new_sales
+
+
+class DropDirectory:
+    '''Directory polled for files of new sales'''
+
+    def __init__(self, path, interval=POLL_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def new_files(self):
+        '''Return the names of the complete files not ingested yet, in order'''
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names
+                      if name.endswith(".csv") and not name.startswith(".") and name not in self._seen)
+
+    def poll(self):
+        '''Ingest the new files. Return the number of sales added'''
+        added = 0
+        with self._lock:
+            for name in self.new_files():
+                self._seen.add(name)
+                path = os.path.join(self.path, name)
+                try:
+                    new_sales = read_new_sales(path)
+                    new_sales_hash = file_hash(path)
+                except (OSError, ValueError, pd.errors.ParserError):
+                    logger.exception("Could not read new sales from %s", name)
+                    continue
+                if new_sales.empty:
+                    continue
+                try:
+                    add_sales(new_sales, new_sales_hash)
+                except (OSError, ValueError):
+                    logger.exception("Could not add the sales in %s", name)
+                    continue
+                added += len(new_sales)
+                logger.info("Added %d sales from %s", len(new_sales), name)
+        return added
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Polling %s failed", self.path)
+
+    def start(self):
+        '''Ingest the files already in the directory, then keep polling it in
+        a background thread'''
+        self.poll()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="sales-drop-directory", daemon=True)
+            self._thread.start()
+
+
+_drop_directory = None
+
+
+def drop_directory():
+    '''Return the drop directory named by SALES_DROP_DIR (the same object on
+    every call), or None if it is not set'''
+    global _drop_directory
+    path = os.environ.get("SALES_DROP_DIR")
+    if path and _drop_directory is None:
+        _drop_directory = DropDirectory(path, float(os.environ.get("SALES_DROP_INTERVAL", POLL_INTERVAL)))
+    return _drop_directory
@@ -0,0 +1,266 @@
+import functools
+import threading
+import time
+from collections import defaultdict
+
+import flask
+from dash.exceptions import PreventUpdate
+
+from utils import coalescing, figure_cache, figure_encoding, result_store, startup
+
+#
+#   Callback metrics
+#
+#   instrument(app) wraps every callback registered with app.callback and
+#   records, per callback: the number of calls, a latency histogram of the
+#   whole request, the size of the responses, the number of exceptions, and
+#   how the time splits into decoding the request JSON, running the callback
+#   (building the figures) and encoding the response JSON. The numbers are
+#   served on /metrics in the Prometheus text format.
+#
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1_000, 10_000, 100_000, 250_000, 500_000, 1_000_000, 2_500_000, 5_000_000)
+
+DISPATCH_PATH = "_dash-update-component"
+
+
+class Histogram:
+    '''Cumulative histogram in the Prometheus style'''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class CallbackMetrics:
+    '''Counters and histograms of one callback'''
+
+    def __init__(self):
+        self.calls = 0
+        self.exceptions = 0
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.response_bytes = Histogram(SIZE_BUCKETS)
+        self.deserialize_seconds = 0.0
+        self.build_seconds = 0.0
+        self.serialize_seconds = 0.0
+
+
+class Registry:
+    '''The metrics of every callback, by callback name'''
+
+    def __init__(self):
+        self.callbacks = defaultdict(CallbackMetrics)
+        self.lock = threading.Lock()
+
+    def update(self, name, change):
+        '''Apply change (a function of the CallbackMetrics) under the lock'''
+        with self.lock:
+            change(self.callbacks[name])
+
+
+registry = Registry()
+
+# Timings of the callback running in the current thread
+_current = threading.local()
+
+
+def callback_name(func):
+    return f"{func.__module__}.{func.__name__}"
+
+
+def _timed_build(func, name):
+    '''Wrap the callback function to time it and count its exceptions'''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except PreventUpdate:
+            raise
+        except Exception:
+            registry.update(name, lambda m: setattr(m, 'exceptions', m.exceptions + 1))
+            raise
+        finally:
+            _current.build_seconds = time.perf_counter() - start
+    return wrapper
+
+
+def _timed_dispatch(registered, name):
+    '''Wrap the function Dash registered for the callback (which runs the
+    callback and encodes the response) to time the encoding'''
+    @functools.wraps(registered)
+    def wrapper(*args, **kwargs):
+        _current.build_seconds = 0.0
+        start = time.perf_counter()
+        response = registered(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        build = _current.build_seconds
+
+        def record(m):
+            m.build_seconds += build
+            m.serialize_seconds += max(elapsed - build, 0.0)
+            m.response_bytes.observe(len(response))
+        registry.update(name, record)
+        return response
+    # Keep pointing at the callback function itself, like Dash does
+    wrapper.__wrapped__ = registered.__wrapped__
+    wrapper.metrics_name = name
+    return wrapper
+
+
+def _before_request():
+    if flask.request.method != "POST" or not flask.request.path.endswith(DISPATCH_PATH):
+        return
+    flask.g.metrics_start = time.perf_counter()
+    # Decoding here is cached by Flask, so Dash does not decode it again
+    body = flask.request.get_json(silent=True) or {}
+    flask.g.metrics_deserialize = time.perf_counter() - flask.g.metrics_start
+    flask.g.metrics_output = body.get("output")
+
+
+def _after_request(app, response):
+    start = flask.g.pop('metrics_start', None)
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    entry = app.callback_map.get(flask.g.pop('metrics_output', None), {})
+    name = getattr(entry.get('callback'), 'metrics_name', None)
+    if name is None:
+        return response
+    deserialize = flask.g.pop('metrics_deserialize', 0.0)
+
+    def record(m):
+        m.calls += 1
+        m.latency.observe(elapsed)
+        m.deserialize_seconds += deserialize
+    registry.update(name, record)
+    return response
+
+
+def _labels(**labels):
+    return ",".join(f'{key}="{value}"' for key, value in labels.items())
+
+
+def _histogram_lines(metric, labels, histogram):
+    lines = []
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {count}')
+    lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+    lines.append(f'{metric}_sum{{{labels}}} {histogram.sum}')
+    lines.append(f'{metric}_count{{{labels}}} {histogram.count}')
+    return lines
+
+
+def render(registry=registry):
+    '''Return the metrics in the Prometheus text exposition format'''
+    with registry.lock:
+        callbacks = sorted(registry.callbacks.items())
+        counters = [
+            ('dash_callback_calls_total', 'counter', 'Requests dispatched to the callback',
+             lambda m: m.calls),
+            ('dash_callback_exceptions_total', 'counter', 'Exceptions raised by the callback',
+             lambda m: m.exceptions),
+            ('dash_callback_deserialize_seconds_total', 'counter', 'Time spent decoding request JSON',
+             lambda m: m.deserialize_seconds),
+            ('dash_callback_build_seconds_total', 'counter', 'Time spent in the callback function',
+             lambda m: m.build_seconds),
+            ('dash_callback_serialize_seconds_total', 'counter', 'Time spent encoding response JSON',
+             lambda m: m.serialize_seconds),
+        ]
+        lines = []
+        for metric, kind, description, value in counters:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, m in callbacks:
+                lines.append(f'{metric}{{{_labels(callback=name)}}} {value(m)}')
+        for metric, description, attribute in [
+                ('dash_callback_latency_seconds', 'Time from receiving to answering the request', 'latency'),
+                ('dash_callback_response_bytes', 'Size of the encoded response', 'response_bytes')]:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} histogram")
+            for name, m in callbacks:
+                lines.extend(_histogram_lines(metric, _labels(callback=name), getattr(m, attribute)))
+    for metric, key, description in [('dash_figure_cache_hits_total', 'hits', 'Figure cache hits'),
+                                     ('dash_figure_cache_misses_total', 'misses', 'Figure cache misses')]:
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} counter")
+        for name, stats in sorted(figure_cache.stats().items()):
+            lines.append(f'{metric}{{{_labels(cache=name)}}} {stats[key]}')
+    for metric, key, description in [
+            ('dash_figure_encoded_total', 'figures', 'Figures compacted before encoding'),
+            ('dash_figure_measured_total', 'measured', 'Compacted figures with measured savings'),
+            ('dash_figure_array_bytes_before_total', 'bytes_before',
+             'Encoded size of the compacted arrays before compacting, in the measured figures'),
+            ('dash_figure_array_bytes_after_total', 'bytes_after',
+             'Encoded size of the compacted arrays after compacting, in the measured figures')]:
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} counter")
+        for name, stats in sorted(figure_encoding.stats().items()):
+            lines.append(f'{metric}{{{_labels(callback=name)}}} {stats[key]}')
+    for metric, key, description in [
+            ('dash_coalescing_started_total', 'started', 'Filter requests started'),
+            ('dash_coalescing_published_total', 'published', 'Filter results sent to the browser'),
+            ('dash_coalescing_superseded_total', 'superseded',
+             'Filter results dropped for a newer filter state of the same session'),
+            ('dash_coalescing_skipped_total', 'skipped',
+             'Requests depending on a filter result skipped for a newer filter state')]:
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} counter")
+        for name, stats in sorted(coalescing.stats().items()):
+            lines.append(f'{metric}{{{_labels(coalescer=name)}}} {stats[key]}')
+    for metric, kind, key, description in [
+            ('dash_result_cache_hits_total', 'counter', 'hits', 'Filter states found in the result cache'),
+            ('dash_result_cache_misses_total', 'counter', 'misses', 'Filter states computed for the result cache'),
+            ('dash_result_cache_recomputed_total', 'counter', 'recomputed',
+             'Results recomputed for a handle no longer in the result cache'),
+            ('dash_result_cache_entries', 'gauge', 'entries', 'Results in the result cache'),
+            ('dash_result_cache_bytes', 'gauge', 'bytes', 'Bytes taken up by the results in the result cache')]:
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, stats in sorted(result_store.stats().items()):
+            lines.append(f'{metric}{{{_labels(store=name)}}} {stats[key]}')
+    lines.append("# HELP dash_startup_seconds Time taken by each step of the startup")
+    lines.append("# TYPE dash_startup_seconds gauge")
+    for step, seconds in list(startup.timings.items()):
+        lines.append(f'dash_startup_seconds{{{_labels(step=step)}}} {seconds}')
+    return "\n".join(lines) + "\n"
+
+
+def instrument(app, path="/metrics", allow_remote=False):
+    '''Record metrics for every callback registered on app from now on and
+    serve them on path (only to local clients unless allow_remote)'''
+    register = app.callback
+
+    @functools.wraps(register)
+    def callback(*args, **kwargs):
+        decorator = register(*args, **kwargs)
+
+        def wrap(func):
+            name = callback_name(func)
+            registered = decorator(_timed_build(func, name))
+            for entry in app.callback_map.values():
+                if entry.get('callback') is registered:
+                    entry['callback'] = _timed_dispatch(registered, name)
+            return registered
+        return wrap
+    app.callback = callback
+
+    server = app.server
+    server.before_request(_before_request)
+    server.after_request(functools.partial(_after_request, app))
+
+    def metrics_view():
+        if not allow_remote and flask.request.remote_addr not in ("127.0.0.1", "::1"):
+            flask.abort(403)
+        return flask.Response(render(), mimetype="text/plain; version=0.0.4")
+    server.add_url_rule(path, "metrics", metrics_view)
@@ -0,0 +1,220 @@
+import argparse
+import cProfile
+import functools
+import heapq
+import logging
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+
+import flask
+
+#
+#   Opt-in callback profiling
+#
+#   Selected callbacks run under cProfile and every invocation is written to
+#   PROFILE_DIR as a pstats dump (<name>.pstats, for pstats or snakeviz). A
+#   dump is turned into collapsed stacks (for flamegraph.pl or speedscope)
+#   afterwards, outside the request:
+#
+#       python -m utils.profiling profiles/<name>.pstats > <name>.collapsed
+#
+#   A callback is profiled when:
+#
+#   - its name is listed in PROFILE_CALLBACKS (comma separated, either the
+#     function name or module.function, or * for every callback), or
+#   - PROFILE_HEADER is set and the request has an "X-Profile: 1" header.
+#
+#   No dump is written that would take the directory past PROFILE_MAX_FILES
+#   dumps or PROFILE_MAX_BYTES bytes, so profiling can be switched on briefly
+#   in production without filling up the disk.
+#
+
+PROFILE_HEADER_NAME = "X-Profile"
+
+logger = logging.getLogger(__name__)
+
+
+class Settings:
+    '''Profiling settings, read from the environment'''
+
+    def __init__(self, environ=os.environ):
+        names = environ.get("PROFILE_CALLBACKS", "")
+        self.callbacks = {name.strip() for name in names.split(",") if name.strip()}
+        self.header = environ.get("PROFILE_HEADER", "") not in ("", "0")
+        self.directory = environ.get("PROFILE_DIR", "profiles")
+        self.max_files = int(environ.get("PROFILE_MAX_FILES", 100))
+        self.max_bytes = int(environ.get("PROFILE_MAX_BYTES", 50_000_000))
+
+    @property
+    def enabled(self):
+        return bool(self.callbacks) or self.header
+
+    def selects(self, name):
+        return "*" in self.callbacks or name in self.callbacks or name.rsplit(".", 1)[-1] in self.callbacks
+
+
+class DumpDirectory:
+    '''Directory of profile dumps, capped by number of dumps and bytes'''
+
+    def __init__(self, path, max_files, max_bytes):
+        self.path = path
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._files = None
+        self._bytes = None
+        self._full = False
+
+    def _scan(self):
+        os.makedirs(self.path, exist_ok=True)
+        names = [name for name in os.listdir(self.path) if name.endswith(".pstats")]
+        self._files = len(names)
+        self._bytes = sum(os.path.getsize(os.path.join(self.path, name))
+                          for name in os.listdir(self.path))
+
+    def write(self, name, profile):
+        '''Write the pstats dump of profile, unless it does not fit in the
+        directory. Return the path of the dump or None'''
+        stats = pstats.Stats(profile)
+        # The same bytes pstats.Stats.dump_stats writes
+        data = marshal.dumps(stats.stats)
+        with self._lock:
+            if self._files is None:
+                self._scan()
+            if self._files >= self.max_files or self._bytes + len(data) > self.max_bytes:
+                if not self._full:
+                    logger.warning("Profile directory %s is full, not writing more profiles", self.path)
+                    self._full = True
+                return None
+            path = os.path.join(self.path, f"{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 10**9:09d}-{name}.pstats")
+            with open(path, "wb") as f:
+                f.write(data)
+            self._files += 1
+            self._bytes += len(data)
+        return path
+
+
+def _frame_name(function):
+    filename, line, name = function
+    if filename == "~":
+        # Built-in functions, like "<method 'join' of 'str' objects>"
+        return name
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def collapsed_stacks(stats, min_microseconds=100, max_stacks=5_000, max_depth=64):
+    '''Return the stacks of a pstats.Stats in the collapsed format
+    ("root;caller;function microseconds" per line)
+
+    cProfile only records caller to callee edges, not whole stacks, so the
+    time of a function called from several places is split between the
+    stacks in proportion to the time of each call edge.
+
+    The number of paths through the call graph grows exponentially with its
+    depth, so the stacks are expanded slowest first and the expansion stops
+    at max_stacks stacks, max_depth frames or stacks faster than
+    min_microseconds. The time below a stack that is not expanded is counted
+    in the stack itself, so the stacks add up to the time profiled.
+    '''
+    entries = stats.stats
+    callees = {}
+    for function, (_, _, _, _, callers) in entries.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((function, edge[3]))
+    roots = [function for function, entry in entries.items()
+             if not entry[4] or all(caller not in entries for caller in entry[4])]
+
+    lines = {}
+    # Max-heap on the time of the stack (the counter breaks ties)
+    order = 0
+    heap = []
+    for root in roots:
+        heapq.heappush(heap, (-entries[root][3], order, root, (_frame_name(root),), {root}))
+        order += 1
+    expanded = 0
+    while heap:
+        negative_cumulative, _, function, names, seen = heapq.heappop(heap)
+        cumulative = -negative_cumulative
+        own_cumulative = entries[function][3]
+        share = cumulative / own_cumulative if own_cumulative else 0.0
+        # The time of the stack not spent in the callees expanded below it
+        own = cumulative
+        expanded += 1
+        if expanded < max_stacks and len(names) < max_depth:
+            below = [(callee, edge_cumulative * share) for callee, edge_cumulative in callees.get(function, [])
+                     if callee not in seen]
+            # The cumulative times of recursive functions count the nested
+            # calls again, so the callees may add up to more than the stack
+            total_below = sum(time for _, time in below)
+            scale = min(1.0, cumulative / total_below) if total_below > 0 else 1.0
+            for callee, time_in_callee in below:
+                time_in_callee *= scale
+                if time_in_callee * 1_000_000 < min_microseconds:
+                    continue
+                heapq.heappush(heap, (-time_in_callee, order, callee,
+                                      names + (_frame_name(callee),), seen | {callee}))
+                order += 1
+                own -= time_in_callee
+        own = max(own, 0.0)
+        microseconds = int(own * 1_000_000)
+        if microseconds >= 1:
+            key = ";".join(names)
+            lines[key] = lines.get(key, 0) + microseconds
+    # Spaces separate the stack from the count in the collapsed format
+    return "".join(f"{key.replace(' ', '_')} {value}\n" for key, value in sorted(lines.items()))
+
+
+def _requested_by_header():
+    return flask.has_request_context() and flask.request.headers.get(PROFILE_HEADER_NAME) == "1"
+
+
+def _profiled(func, name, settings, directory):
+    '''Wrap a callback function to profile the invocations selected by the
+    settings'''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not (settings.selects(name) or (settings.header and _requested_by_header())):
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            try:
+                directory.write(name, profile)
+            except OSError:
+                logger.exception("Could not write the profile of %s", name)
+    return wrapper
+
+
+def instrument(app, settings=None):
+    '''Profile the selected callbacks registered on app from now on. Does
+    nothing unless profiling is switched on in the environment'''
+    settings = settings or Settings()
+    if not settings.enabled:
+        return
+    directory = DumpDirectory(settings.directory, settings.max_files, settings.max_bytes)
+    register = app.callback
+
+    @functools.wraps(register)
+    def callback(*args, **kwargs):
+        decorator = register(*args, **kwargs)
+
+        def wrap(func):
+            name = f"{func.__module__}.{func.__name__}"
+            return decorator(_profiled(func, name, settings, directory))
+        return wrap
+    app.callback = callback
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a pstats dump as collapsed stacks")
+    parser.add_argument('dump', help="pstats dump written by the profiling")
+    parser.add_argument('--min-microseconds', type=int, default=100,
+                        help="do not expand stacks faster than this")
+    parser.add_argument('--max-stacks', type=int, default=5_000, help="stacks to expand at most")
+    args = parser.parse_args()
+    sys.stdout.write(collapsed_stacks(pstats.Stats(args.dump), args.min_microseconds, args.max_stacks))
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+#
+#   Server-side store for filter results
+#
+#   Instead of shipping the filtered rows to the browser through a dcc.Store,
+#   the filter callback keeps the matching row positions here and only sends
+#   a small handle (the hash of the filter state and the state itself) to the
+#   browser. The callbacks depending on the filter result resolve the handle
+#   back to the row positions. A handle that is not in the store (evicted, or
+#   created by another worker process) is recomputed from its filter state.
+#
+#   Every filter control is discrete, so the same filter states come up again
+#   and again, from all users. The store is one LRU cache per process, shared
+#   by all sessions and bounded by the bytes its entries take up. States are
+#   canonicalized before they are looked up (see canonical_state in
+#   utils/filter_engine.py), and every entry also keeps the summary of its
+#   rows the page shows (counts and histograms), computed once.
+#
+
+# Bytes the entries of a store may take up
+MAX_BYTES = 32 * 2**20
+
+# Bytes counted for every entry on top of its arrays (key, dictionaries)
+ENTRY_OVERHEAD = 1_000
+
+# Every store created, by name (a store built for new data replaces the
+# store of the old data)
+stores = {}
+
+
+def state_key(state):
+    '''Return a short hash identifying a JSON serializable filter state'''
+    text = json.dumps(state, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def entry_size(rows, summary):
+    '''Return the bytes an entry with rows and summary is counted as'''
+    arrays = [value for value in summary.values() if isinstance(value, np.ndarray)]
+    return rows.nbytes + sum(array.nbytes for array in arrays) + ENTRY_OVERHEAD
+
+
+class ResultStore:
+    '''Shared LRU cache mapping filter states to the matching row positions
+    and their summary, bounded in bytes
+
+    compute(state) returns the row positions matching a state,
+    summarize(rows) the summary kept with them and canonical(state) the
+    canonical form of a state from the browser.
+    '''
+
+    def __init__(self, compute, summarize=lambda rows: {}, canonical=lambda state: state,
+                 max_bytes=MAX_BYTES, name="results"):
+        self.compute = compute
+        self.summarize = summarize
+        self.canonical = canonical
+        self.max_bytes = max_bytes
+        self.name = name
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.recomputed = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        stores[name] = self
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _insert(self, key, entry):
+        size = entry[2]
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self._entries[key] = entry
+            self.bytes += size
+            # Keep at least the new entry, even if it alone is too large
+            while self.bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+
+    def _build(self, state):
+        rows = np.asarray(self.compute(state))
+        if len(rows) and rows.max() < 2**31:
+            rows = rows.astype(np.int32, copy=False)
+        # Cached results are shared between callbacks and must not be changed
+        rows.setflags(write=False)
+        summary = self.summarize(rows)
+        return rows, summary, entry_size(rows, summary)
+
+    def _entry_for_state(self, state):
+        '''Return the key and entry of a canonical state, and whether it was
+        cached'''
+        key = state_key(state)
+        entry = self._lookup(key)
+        if entry is not None:
+            return key, entry, True
+        entry = self._build(state)
+        self._insert(key, entry)
+        return key, entry, False
+
+    def put(self, state):
+        '''Compute and store the rows for state (unless cached) and return the
+        handle to send to the browser'''
+        state = self.canonical(state)
+        key, _, cached = self._entry_for_state(state)
+        with self._lock:
+            if cached:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return {'key': key, 'state': state}
+
+    def _entry_for_handle(self, handle):
+        entry = self._lookup(handle['key'])
+        if entry is None:
+            # Recompute from the state and key the result by the state itself,
+            # never by a key coming from the browser
+            _, entry, cached = self._entry_for_state(self.canonical(handle['state']))
+            if not cached:
+                with self._lock:
+                    self.recomputed += 1
+        return entry
+
+    def rows(self, handle):
+        '''Return the row positions for a handle created by put'''
+        return self._entry_for_handle(handle)[0]
+
+    def summary(self, handle):
+        '''Return the summary of the rows for a handle created by put'''
+        return self._entry_for_handle(handle)[1]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._entries),
+                    'bytes': self.bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'recomputed': self.recomputed,
+                    'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+
+def stats():
+    '''Return the statistics of every store'''
+    return {name: store.stats() for name, store in stores.items()}
@@ -0,0 +1,421 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+#
+#   Loading the datasets
+#
+#   Parsing the CSVs in data/ (and in particular the dates of sale) is the
+#   slowest part of starting the app. The first load therefore writes a binary
+#   columnar cache next to the data: one .npy file per column with the dates
+#   already converted to datetime64 and every column stored in the smallest
+#   dtype that holds it without loss. Text columns are dictionary encoded:
+#   integer codes into the distinct values, which are stored in meta.json when
+#   there are few of them and as one UTF-8 buffer with offsets otherwise.
+#
+#   Later loads memory-map the .npy files read-only instead of reading them,
+#   so every process serving the app shares the same pages of the operating
+#   system's file cache and starts without parsing anything. The cache is
+#   rebuilt when the modification time of the CSV changes and its content
+#   hash no longer matches.
+#
+
+SALES_CSV = "data/sales.csv"
+CACHE_DIR = "data/cache"
+SALES_CACHE = os.path.join(CACHE_DIR, "sales")
+
+# Bump when the layout of the cache changes, so old caches are rebuilt
+CACHE_VERSION = 2
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Text columns with at most this many distinct values keep them in meta.json
+MAX_CATEGORIES = 255
+
+
+def file_hash(path):
+    '''Return the sha1 hash of the content of the file at path'''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size}
+
+
+def cache_dir_for(path):
+    '''Return the cache directory of the data file at path'''
+    return os.path.join(CACHE_DIR, os.path.splitext(os.path.basename(path))[0])
+
+
+def _smallest_dtype(values):
+    '''Return values in the smallest numeric dtype holding them without loss'''
+    if values.dtype.kind in 'iu':
+        return pd.to_numeric(values, downcast='integer')
+    if values.dtype.kind == 'f':
+        narrow = values.astype(np.float32)
+        if np.array_equal(narrow.astype(values.dtype), values, equal_nan=True):
+            return narrow
+    return values
+
+
+def _file_name(column):
+    return "".join(c if c.isalnum() else "_" for c in column)
+
+
+def read_sales_csv(path=SALES_CSV):
+    '''Read the sales CSV and add the parsed dates of sale
+
+    Adds "datetimes" (datetime64) and "month" (months since 1970-01, which
+    makes it an integer code shared by every month based dataset).
+    '''
+    sales = pd.read_csv(path)
+    sales["datetimes"] = pd.to_datetime(sales.salesDate, format=DATE_FORMAT)
+    sales["month"] = sales.datetimes.to_numpy().astype('datetime64[M]').astype(np.int32)
+    return sales
+
+
+def month_labels(months):
+    '''Return the "YYYY-MM" label of every month from the first to the last
+    of months (months since 1970-01, like the "month" column)'''
+    first, last = int(np.min(months)), int(np.max(months))
+    return [str(month) for month in np.arange(first, last + 1).astype('datetime64[M]')]
+
+
+def encode_strings(values):
+    '''Dictionary encode an array of text as (codes, UTF-8 buffer, offsets):
+    value i of the dictionary is buffer[offsets[i]:offsets[i + 1]]'''
+    words, codes = np.unique(values, return_inverse=True)
+    encoded = [word.encode('utf-8') for word in words]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(word) for word in encoded])
+    buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return pd.to_numeric(codes, downcast='unsigned'), buffer, offsets
+
+
+def decode_strings(codes, buffer, offsets):
+    '''Return the text of the dictionary encoded codes as an object array,
+    decoding each distinct value once'''
+    used, inverse = np.unique(codes, return_inverse=True)
+    words = np.empty(len(used), dtype=object)
+    for i, code in enumerate(used):
+        words[i] = bytes(buffer[offsets[code]:offsets[code + 1]]).decode('utf-8')
+    return words[inverse]
+
+
+def string_index(encoded):
+    '''Return a dictionary from every value of the dictionary encoded text
+    (as made by encode_strings) to its code'''
+    buffer, offsets = bytes(encoded['buffer']), encoded['offsets'].tolist()
+    return {buffer[start:end].decode('utf-8'): code
+            for code, (start, end) in enumerate(zip(offsets[:-1], offsets[1:]))}
+
+
+def _append_strings(encoded, values, index):
+    '''Return the dictionary encoded text (as made by encode_strings) with
+    the text in values appended. index (see string_index) is extended with
+    the values added to the dictionary'''
+    buffer, offsets = encoded['buffer'], encoded['offsets']
+    added = []
+    codes = np.empty(len(values), dtype=np.int64)
+    for i, value in enumerate(values):
+        if value not in index:
+            index[value] = len(index)
+            added.append(value.encode('utf-8'))
+        codes[i] = index[value]
+    added_offsets = offsets[-1] + np.cumsum([len(word) for word in added], dtype=np.int64)
+    return {'codes': pd.to_numeric(np.concatenate([encoded['codes'], codes]), downcast='unsigned'),
+            'buffer': np.concatenate([buffer, np.frombuffer(b"".join(added), dtype=np.uint8)]),
+            'offsets': np.concatenate([offsets, added_offsets])}
+
+
+def encode_columns(table):
+    '''Return the columns of a table as plain numpy arrays (a dictionary of
+    arrays for text) together with the description needed to decode them'''
+    arrays = {}
+    columns = []
+    for name in table.columns:
+        values = table[name]
+        entry = {'name': name, 'file': _file_name(name), 'dtype': str(values.dtype)}
+        if values.dtype.kind == 'M':
+            array = values.to_numpy().astype('datetime64[ns]')
+            entry['kind'] = 'datetime'
+        elif values.dtype == object and values.nunique() <= MAX_CATEGORIES:
+            # Few distinct values: keep them in the description
+            categorical = values.astype('category')
+            array = categorical.cat.codes.to_numpy()
+            entry['kind'] = 'category'
+            entry['categories'] = list(categorical.cat.categories)
+        elif values.dtype == object:
+            codes, buffer, offsets = encode_strings(values.to_numpy().astype(str))
+            array = {'codes': codes, 'buffer': buffer, 'offsets': offsets}
+            entry['kind'] = 'string'
+        else:
+            array = _smallest_dtype(values.to_numpy())
+            entry['kind'] = 'numeric'
+        arrays[name] = array
+        columns.append(entry)
+    return arrays, columns
+
+
+class Table:
+    '''Read-only table over columns encoded by encode_columns
+
+    Numeric and date columns are returned as Series viewing the (possibly
+    memory-mapped) arrays without copying them. Text is only decoded for the
+    rows asked for, so take the rows needed rather than whole text columns.
+    '''
+
+    def __init__(self, arrays, columns, source=None):
+        self._arrays = arrays
+        self._entries = {entry['name']: entry for entry in columns}
+        self.columns = [entry['name'] for entry in columns]
+        # What the table was read from (as given to write_cache), if known
+        self.source = source
+        # The dictionaries of the text columns as {value: code}, built by the
+        # first append and handed on to the table it returns
+        self._string_indexes = {}
+
+    def __len__(self):
+        return len(self._codes(self.columns[0]))
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __getitem__(self, name):
+        return pd.Series(self.values(name), name=name, copy=False)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._entries:
+            raise AttributeError(name)
+        return self[name]
+
+    def _codes(self, name):
+        array = self._arrays[name]
+        return array['codes'] if isinstance(array, dict) else array
+
+    def values(self, name, rows=None):
+        '''Return the values of a column (at rows) as an array or Categorical'''
+        entry = self._entries[name]
+        array = self._arrays[name]
+        if entry['kind'] == 'string':
+            codes = array['codes'] if rows is None else array['codes'][rows]
+            return decode_strings(codes, array['buffer'], array['offsets'])
+        if rows is not None:
+            array = array[rows]
+        if entry['kind'] == 'category':
+            return pd.Categorical.from_codes(array, categories=entry['categories'])
+        return array
+
+    def take(self, rows, columns=None):
+        '''Return the rows (positions) of the table as a DataFrame'''
+        rows = np.asarray(rows)
+        return pd.DataFrame({name: self.values(name, rows) for name in columns or self.columns})
+
+    def row(self, position, columns=None):
+        '''Return the values of the row at position as a dict of Python
+        values'''
+        rows = np.array([position])
+        record = {}
+        for name in columns or self.columns:
+            value = self.values(name, rows)[0]
+            record[name] = value.item() if isinstance(value, np.generic) else value
+        return record
+
+    def append(self, table):
+        '''Return a new Table with the rows of the DataFrame table (with the
+        same columns as this table) added at the end
+
+        The existing rows keep their positions. Only the new rows are encoded,
+        extending the dictionaries of the text columns with new values. The
+        lookup of the dictionaries is built once and moves to the new table,
+        so appending to it again does not decode them.
+        '''
+        missing = [name for name in self.columns if name not in table.columns]
+        if missing:
+            raise ValueError(f"missing columns: {', '.join(missing)}")
+        arrays = {}
+        columns = []
+        indexes = {}
+        for name in self.columns:
+            entry = dict(self._entries[name])
+            array = self._arrays[name]
+            values = table[name]
+            if entry['kind'] == 'string':
+                # Taken from this table, so it never holds values of another
+                index = self._string_indexes.pop(name, None)
+                if index is None:
+                    index = string_index(array)
+                array = _append_strings(array, values.to_numpy().astype(str), index)
+                indexes[name] = index
+            elif entry['kind'] == 'category':
+                categories = list(entry['categories'])
+                codes = {category: code for code, category in enumerate(categories)}
+                new_codes = []
+                for value in values:
+                    if pd.isna(value):
+                        new_codes.append(-1)
+                        continue
+                    if value not in codes:
+                        codes[value] = len(categories)
+                        categories.append(value)
+                    new_codes.append(codes[value])
+                entry['categories'] = categories
+                array = np.concatenate([array, np.array(new_codes, dtype=np.int16)])
+                array = _smallest_dtype(array)
+            elif entry['kind'] == 'datetime':
+                array = np.concatenate([array, pd.to_datetime(values).to_numpy().astype('datetime64[ns]')])
+            else:
+                array = _smallest_dtype(np.concatenate([array, values.to_numpy()]))
+            arrays[name] = array
+            columns.append(entry)
+        appended = Table(arrays, columns)
+        appended._string_indexes = indexes
+        return appended
+
+    def to_frame(self):
+        '''Return the whole table as a DataFrame with the dtypes it was read
+        with (like pd.read_csv returns it)'''
+        return pd.DataFrame({name: pd.Series(self.values(name)).astype(self._entries[name]['dtype'])
+                             for name in self.columns})
+
+
+def _write_meta(meta, directory):
+    tmp_path = os.path.join(directory, f"meta.json.tmp-{os.getpid()}")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp_path, os.path.join(directory, "meta.json"))
+
+
+def _array_files(entry, array):
+    '''Yield (file name, array) for the files storing a column'''
+    if isinstance(array, dict):
+        for part, values in array.items():
+            yield f"{entry['file']}.{part}.npy", values
+    else:
+        yield f"{entry['file']}.npy", array
+
+
+def write_cache(arrays, columns, cache_dir, source):
+    '''Write encoded columns as a binary cache in cache_dir'''
+    tmp_dir = f"{cache_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for entry in columns:
+        for file_name, array in _array_files(entry, arrays[entry['name']]):
+            np.save(os.path.join(tmp_dir, file_name), array, allow_pickle=False)
+    _write_meta({'version': CACHE_VERSION, 'source': source, 'columns': columns}, tmp_dir)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+
+
+def _read_meta(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != CACHE_VERSION:
+        return None
+    return meta
+
+
+def _load(path):
+    # An empty array cannot be memory-mapped
+    array = np.load(path, allow_pickle=False, mmap_mode='r')
+    return array if array.size else np.load(path, allow_pickle=False)
+
+
+def read_cache(cache_dir, meta):
+    '''Return the encoded columns stored in cache_dir, memory-mapped read-only'''
+    arrays = {}
+    for entry in meta['columns']:
+        if entry['kind'] == 'string':
+            arrays[entry['name']] = {part: _load(os.path.join(cache_dir, f"{entry['file']}.{part}.npy"))
+                                     for part in ('codes', 'buffer', 'offsets')}
+        else:
+            arrays[entry['name']] = _load(os.path.join(cache_dir, f"{entry['file']}.npy"))
+    return arrays
+
+
+def read_table_cache(cache_dir, source):
+    '''Return the Table cached in cache_dir if it was built from source (as
+    given to write_cache), otherwise None'''
+    meta = _read_meta(cache_dir)
+    if meta is None or meta['source'] != source:
+        return None
+    return Table(read_cache(cache_dir, meta), meta['columns'], source)
+
+
+def load_table(path, cache_dir=None, read=pd.read_csv):
+    '''Return the table in the CSV at path (as read by read), mapped from the
+    binary cache when the cache matches the CSV and (re)building the cache
+    otherwise'''
+    cache_dir = cache_dir or cache_dir_for(path)
+    stamp = _source_stamp(path)
+    meta = _read_meta(cache_dir)
+    if meta is not None:
+        source = meta['source']
+        if source['mtime'] == stamp['mtime'] and source['size'] == stamp['size']:
+            return Table(read_cache(cache_dir, meta), meta['columns'], source)
+        if source['size'] == stamp['size'] and source['sha1'] == file_hash(path):
+            # Touched but unchanged. Remember the new mtime to skip hashing
+            meta['source'].update(stamp)
+            try:
+                _write_meta(meta, cache_dir)
+            except OSError:
+                pass
+            return Table(read_cache(cache_dir, meta), meta['columns'], source)
+    arrays, columns = encode_columns(read(path))
+    source = dict(stamp, sha1=file_hash(path))
+    try:
+        write_cache(arrays, columns, cache_dir, source)
+    except OSError:
+        # A read-only data directory only costs the speed up (and the sharing)
+        return Table(arrays, columns, source)
+    return Table(read_cache(cache_dir, _read_meta(cache_dir)), columns, source)
+
+
+def load_sales(path=SALES_CSV, cache_dir=SALES_CACHE):
+    '''Return the sales table (with the parsed dates of sale)'''
+    return load_table(path, cache_dir, read=read_sales_csv)
+
+
+def append_cached(table, rows, rows_hash, cache_dir):
+    '''Return table with the rows of the DataFrame rows (whose content has
+    the hash rows_hash) added at the end, memory-mapped from a binary cache
+
+    The appended table is written to cache_dir and mapped from there, so the
+    processes serving the app keep sharing its pages instead of each holding
+    a copy. The cache is keyed by the source of table and rows_hash: the
+    first process to add the rows writes it, the others map what it wrote.
+    Without a source (or a writable cache) the table is kept in memory.
+    '''
+    appended = table.append(rows)
+    if table.source is None:
+        return appended
+    key = hashlib.sha1(f"{table.source['sha1']}+{rows_hash}".encode('utf-8')).hexdigest()
+    source = {'sha1': key, 'rows': len(appended)}
+    try:
+        cached = read_table_cache(cache_dir, source)
+        if cached is None:
+            write_cache(appended._arrays, [appended._entries[name] for name in appended.columns],
+                        cache_dir, source)
+            cached = read_table_cache(cache_dir, source)
+    except (OSError, ValueError):
+        # Another process replacing the cache at the same time
+        cached = None
+    if cached is None:
+        appended.source = source
+        return appended
+    # The codes of the cached table are the ones appended assigned
+    cached._string_indexes = appended._string_indexes
+    return cached
@@ -0,0 +1,94 @@
+import copy
+
+import numpy as np
+
+#
+#   Spatial index for the map viewport filter
+#
+#   The sales are bucketed into a uniform latitude/longitude grid. The row
+#   positions are stored sorted by grid cell (cells numbered row by row), so
+#   the cells of one grid row inside a viewport form one contiguous slice. A
+#   viewport query only touches the points in the grid cells it overlaps
+#   instead of scanning every sale.
+#
+#   Points added later are merged into the grid as it is. Points outside it
+#   go to the nearest edge cell, which a viewport beyond the edge is clipped
+#   to as well, so queries stay exact.
+#
+
+
+class GridIndex:
+    '''Uniform lat/lon grid over a set of points'''
+
+    def __init__(self, latitude, longitude, cell_size=0.01):
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        self.latitude = latitude
+        self.longitude = longitude
+        self.cell_size = cell_size
+        # Points without coordinates can never be inside a viewport
+        valid = np.flatnonzero(np.isfinite(latitude) & np.isfinite(longitude))
+        if len(valid):
+            self.min_lat = latitude[valid].min()
+            self.min_lon = longitude[valid].min()
+            self.n_lat = int((latitude[valid].max() - self.min_lat) // cell_size) + 1
+            self.n_lon = int((longitude[valid].max() - self.min_lon) // cell_size) + 1
+        else:
+            self.min_lat = self.min_lon = 0.0
+            self.n_lat = self.n_lon = 1
+        cells = self._point_cells(latitude[valid], longitude[valid])
+        self.order = valid[np.argsort(cells, kind='stable')]
+        counts = np.bincount(cells, minlength=self.n_lat * self.n_lon)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def _cells(self, values, origin, count):
+        cells = np.floor((values - origin) / self.cell_size).astype(np.int64)
+        return np.clip(cells, 0, count - 1)
+
+    def _point_cells(self, latitude, longitude):
+        lat_cells = self._cells(latitude, self.min_lat, self.n_lat)
+        lon_cells = self._cells(longitude, self.min_lon, self.n_lon)
+        return lat_cells * self.n_lon + lon_cells
+
+    def updated(self, latitude, longitude):
+        '''Return the index of latitude and longitude, the points of this
+        index with points added at the end, placing only the added points'''
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        index = copy.copy(self)
+        index.latitude = latitude
+        index.longitude = longitude
+        start = len(self.latitude)
+        added = start + np.flatnonzero(np.isfinite(latitude[start:]) & np.isfinite(longitude[start:]))
+        cells = self._point_cells(latitude[added], longitude[added])
+        by_cell = np.argsort(cells, kind='stable')
+        # After the points already in their cell, like a stable sort of all
+        index.order = np.insert(self.order, self.offsets[cells[by_cell] + 1], added[by_cell])
+        counts = np.bincount(cells, minlength=self.n_lat * self.n_lon)
+        index.offsets = self.offsets + np.concatenate([[0], np.cumsum(counts)])
+        return index
+
+    def candidates(self, min_lon, max_lon, min_lat, max_lat):
+        '''Return the positions of the points in the grid cells overlapping
+        the viewport (in no particular order)'''
+        if not (min_lat <= max_lat and min_lon <= max_lon):
+            return np.empty(0, dtype=self.order.dtype)
+        lat_cells = self._cells(np.array([min_lat, max_lat]), self.min_lat, self.n_lat)
+        lon_cells = self._cells(np.array([min_lon, max_lon]), self.min_lon, self.n_lon)
+        grid_rows = np.arange(lat_cells[0], lat_cells[1] + 1) * self.n_lon
+        starts = self.offsets[grid_rows + lon_cells[0]]
+        ends = self.offsets[grid_rows + lon_cells[1] + 1]
+        slices = [self.order[start:end] for start, end in zip(starts, ends) if end > start]
+        if not slices:
+            return np.empty(0, dtype=self.order.dtype)
+        return np.concatenate(slices)
+
+    def query(self, min_lon, max_lon, min_lat, max_lat):
+        '''Return the sorted positions of the points inside the viewport
+        (bounds inclusive)'''
+        rows = self.candidates(min_lon, max_lon, min_lat, max_lat)
+        latitude = self.latitude[rows]
+        longitude = self.longitude[rows]
+        inside = ((latitude >= min_lat) & (latitude <= max_lat)
+                  & (longitude >= min_lon) & (longitude <= max_lon))
+        return np.sort(rows[inside])
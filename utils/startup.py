@@ -0,0 +1,124 @@
+import contextlib
+import logging
+import threading
+import time
+
+#
+#   Startup
+#
+#   The pages register their callbacks when they are imported, but derive
+#   their data and build their layout on first use: each keeps them in a
+#   Lazy value, built by the first request needing it (or by warm_up) and
+#   shared by all requests after that. A process serving a single page then
+#   never loads the data of the others.
+#
+#   The time every step of the startup takes (importing each page, building
+#   each Lazy value) is recorded in timings, reported by report() and served
+#   with the metrics. The time of a step does not include the steps nested in
+#   it (like the data built for a layout), so the times add up.
+#
+
+logger = logging.getLogger(__name__)
+
+# Seconds taken by every step of the startup, in the order they finished
+timings = {}
+_timings_lock = threading.Lock()
+
+# Every Lazy value created, in order
+lazy_values = []
+
+# Time taken by the steps nested in the steps running in this thread
+_nested = threading.local()
+
+
+def record(name, seconds):
+    with _timings_lock:
+        timings[name] = seconds
+
+
+@contextlib.contextmanager
+def timed(name):
+    '''Record the time the body of the with statement takes as name, less
+    the time of the steps timed inside it'''
+    stack = _nested.__dict__.setdefault('stack', [])
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        record(name, elapsed - stack.pop())
+        if stack:
+            stack[-1] += elapsed
+
+
+class Lazy:
+    '''A value built by build() on first use
+
+    get() builds the value once, even when called from several threads at the
+    same time, and records the time it took. set() replaces it, to swap in a
+    new version of data derived from it, and update() replaces it only when
+    it has been built.
+    '''
+
+    def __init__(self, name, build):
+        self.name = name
+        self.build = build
+        self._value = None
+        self._built = False
+        self._lock = threading.Lock()
+        lazy_values.append(self)
+
+    @property
+    def built(self):
+        return self._built
+
+    def get(self):
+        if self._built:
+            return self._value
+        with self._lock:
+            if not self._built:
+                with timed(self.name):
+                    self._value = self.build()
+                self._built = True
+        return self._value
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+            self._built = True
+
+    def update(self, func):
+        '''Replace the value with func(value) if it has been built (waiting
+        for a build in progress). A value not built yet is left to be built
+        when first used'''
+        with self._lock:
+            if self._built:
+                self._value = func(self._value)
+
+
+def warm_up(background=True):
+    '''Build every Lazy value not built yet, in a daemon thread or (without
+    background) before returning'''
+    def run():
+        start = time.perf_counter()
+        for value in list(lazy_values):
+            try:
+                value.get()
+            except Exception:
+                logger.exception("Could not build %s", value.name)
+        logger.info("Warmed up in %.1f ms", (time.perf_counter() - start) * 1000)
+    if not background:
+        run()
+        return None
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def report():
+    '''Return the timings of the startup as text, one step per line'''
+    with _timings_lock:
+        steps = list(timings.items())
+    width = max((len(name) for name, _ in steps), default=0)
+    return "\n".join(f"{name:<{width}}  {seconds * 1000:8.1f} ms" for name, seconds in steps)
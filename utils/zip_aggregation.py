@@ -0,0 +1,114 @@
+import numpy as np
+
+from utils.filter_engine import MAX_SIZE, MIN_BUILD_YEAR, TYPES, allowed_types, encode_types
+
+#
+#   Aggregation of the sales per zip code and month
+#
+#   The m2 price choropleth shows the average m2 price of every zip code area
+#   for the sales matching the filters of the page, any combination of which
+#   can be chosen. Instead of a precomputed dataset per combination, the
+#   engine codes the zip code and month of every sale as one integer cell
+#   code once. The sum and count of the m2 prices of a subset of the sales in
+#   every cell are then two np.bincount calls over the subset.
+#
+#   The ends of the filter sliders follow the sales: the house size slider
+#   ends at the largest house (at most MAX_SIZE m2, like on the search page),
+#   and the build year slider at the newest house. Both are rounded up to a
+#   step of their slider, which only stops at multiples of the step from its
+#   lower end.
+#
+
+# Steps of the house size and build year sliders
+SIZE_STEP = 10
+BUILD_YEAR_STEP = 10
+
+
+class ZipMonthAggregator:
+    '''Sum, count and mean of the m2 price per zip code and month, for any
+    subset of the sales chosen with the filters'''
+
+    def __init__(self, sales, zip_codes, months):
+        # The zip codes (rows of the results) and the months since 1970-01
+        # (columns of the results) aggregated over
+        self.zip_codes = np.sort(np.asarray(zip_codes))
+        self.months = np.asarray(months)
+        self.shape = (len(self.zip_codes), len(self.months))
+        cells = self.shape[0] * self.shape[1]
+        # Integer code of the zip code and of the month of every sale
+        zips = sales.zipCode.to_numpy()
+        zip_codes = np.minimum(np.searchsorted(self.zip_codes, zips), len(self.zip_codes) - 1)
+        month_codes = sales.month.to_numpy().astype(np.int64) - self.months[0]
+        m2prices = sales.m2price.to_numpy().astype(np.float64)
+        known = ((self.zip_codes[zip_codes] == zips)
+                 & (month_codes >= 0) & (month_codes < len(self.months))
+                 & ~np.isnan(m2prices))
+        # The cell of every sale, with the sales outside the zip codes and
+        # months (or without an m2 price) in an extra cell left out of the
+        # results
+        self.cells = np.where(known, zip_codes * len(self.months) + month_codes, cells).astype(np.int32)
+        self.m2prices = np.where(known, m2prices, 0.0)
+        # The filtered columns
+        self.sizes = sales['size'].to_numpy()
+        self.build_years = sales.buildYear.to_numpy()
+        self.type_codes = encode_types(sales['type'].to_numpy())
+        # The ends of the house size and build year sliders
+        largest = int(np.ceil(np.nanmax(self.sizes) / SIZE_STEP) * SIZE_STEP) if len(self.sizes) else MAX_SIZE
+        self.size_range = [0, min(largest, MAX_SIZE)]
+        build_years = self.build_years[self.build_years >= MIN_BUILD_YEAR]
+        newest = int(build_years.max()) if len(build_years) else MIN_BUILD_YEAR
+        steps = max(int(np.ceil((newest - MIN_BUILD_YEAR) / BUILD_YEAR_STEP)), 1)
+        self.build_year_range = [MIN_BUILD_YEAR, MIN_BUILD_YEAR + steps * BUILD_YEAR_STEP]
+
+    def mask(self, type_choices, house_size_range, build_year_range):
+        '''Return a boolean mask of the sales matching the filters, or None
+        if they match every sale
+
+        The upper end of the house size slider and the ends of the build year
+        slider (see size_range and build_year_range), or anything beyond
+        them, mean no limit, like on the search page.
+        '''
+        mask = None
+
+        def restrict(condition):
+            nonlocal mask
+            mask = condition if mask is None else mask & condition
+
+        # Filter on type of house
+        allowed = allowed_types(type_choices)
+        if not allowed[:len(TYPES)].all():
+            restrict(allowed[self.type_codes])
+
+        # Filter on house size
+        low, high = house_size_range
+        if low > 0:
+            restrict(self.sizes >= low)
+        if high < self.size_range[1]:
+            restrict(self.sizes <= high)
+
+        # Filter on year build
+        low, high = build_year_range
+        if low > self.build_year_range[0]:
+            restrict(self.build_years >= low)
+        if high < self.build_year_range[1]:
+            restrict(self.build_years <= high)
+        return mask
+
+    def sums_and_counts(self, mask=None):
+        '''Return the sum and the number of the m2 prices of the sales in mask
+        (all sales if None) as matrices with a row per zip code and a column
+        per month'''
+        cells = self.cells if mask is None else self.cells[mask]
+        m2prices = self.m2prices if mask is None else self.m2prices[mask]
+        size = self.shape[0] * self.shape[1] + 1
+        sums = np.bincount(cells, weights=m2prices, minlength=size)[:-1].reshape(self.shape)
+        counts = np.bincount(cells, minlength=size)[:-1].reshape(self.shape)
+        return sums, counts
+
+    def means(self, mask=None):
+        '''Return the average m2 price of the sales in mask (all sales if
+        None) as a matrix with a row per zip code and a column per month, NaN
+        where there are no sales'''
+        sums, counts = self.sums_and_counts(mask)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.round(sums / counts, 2)